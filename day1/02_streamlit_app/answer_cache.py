@@ -0,0 +1,77 @@
+# answer_cache.py
+# chat_history で正確と評価された過去の回答を、同じ質問・ほぼ同じ質問に再利用する回答キャッシュ
+import difflib
+import re
+import unicodedata
+from datetime import datetime, timedelta
+from typing import NamedTuple
+from config import ANSWER_CACHE_ENABLED, ANSWER_CACHE_MAX_AGE_DAYS, ANSWER_CACHE_MIN_CORRECTNESS, ANSWER_CACHE_SIMILARITY
+from database import get_reusable_answers, log_answer_cache_lookup
+
+# 正規化で取り除く空白と句読点・記号（全角は NFKC で半角に揃えてから取り除く）
+_IGNORED_CHARS = re.compile(r"[\s、。・「」『』()\[\]{}!?,.:;\"'`~〜]+")
+
+
+class CachedAnswer(NamedTuple):
+    answer: str
+    match: str  # "exact"（正規化した質問が一致）/ "near"（類似度が閾値以上）
+    similarity: float
+    source_id: int  # 再利用した元の回答のchat_historyのid（保存時に記録し、再利用の評価が低ければ以後は使わない）
+    timestamp: str
+
+
+def normalize_question(text):
+    """全角・半角、大文字・小文字、空白と句読点の違いを無視するために質問文を正規化する"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return _IGNORED_CHARS.sub("", text)
+
+
+def _similarity(a, b):
+    matcher = difflib.SequenceMatcher(None, a, b)
+    # 上限値が閾値に届かない組み合わせは正確な類似度を計算しない
+    if matcher.real_quick_ratio() < ANSWER_CACHE_SIMILARITY or matcher.quick_ratio() < ANSWER_CACHE_SIMILARITY:
+        return 0.0
+    return matcher.ratio()
+
+
+def lookup_answer(question):
+    """再利用できる回答を探す。完全一致を優先し、なければほぼ同じ質問の中で最も類似度が高いものを返す
+
+    検索結果は answer_cache_log に記録され、履歴閲覧ページのヒット率に使われます。
+    """
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    normalized = normalize_question(question)
+    since = (datetime.now() - timedelta(days=ANSWER_CACHE_MAX_AGE_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    candidates = get_reusable_answers(ANSWER_CACHE_MIN_CORRECTNESS, since)
+
+    best = None
+    for source_id, timestamp, candidate_question, answer in candidates:
+        candidate = normalize_question(candidate_question or "")
+        if candidate == normalized:
+            # 新しい順に並んでいるため、最初に一致したものが最新の回答
+            best = CachedAnswer(answer, "exact", 1.0, source_id, timestamp)
+            break
+        if ANSWER_CACHE_SIMILARITY > 0:
+            similarity = _similarity(normalized, candidate)
+            if similarity >= ANSWER_CACHE_SIMILARITY and (best is None or similarity > best.similarity):
+                best = CachedAnswer(answer, "near", similarity, source_id, timestamp)
+
+    if best is None:
+        log_answer_cache_lookup(question, "miss")
+    else:
+        log_answer_cache_lookup(question, best.match, best.similarity, best.source_id)
+    return best
+
+
+def record_bypass(question):
+    """ユーザーが再生成を指定してキャッシュを使わなかったことを記録する"""
+    if ANSWER_CACHE_ENABLED:
+        log_answer_cache_lookup(question, "bypass")
+
+
+def hit_rate(stats):
+    """get_answer_cache_stats() の結果からヒット率を計算する（再生成の指定はキャッシュを検索していないため除く）"""
+    hits = stats.get("exact", 0) + stats.get("near", 0)
+    lookups = hits + stats.get("miss", 0)
+    return hits / lookups if lookups else None
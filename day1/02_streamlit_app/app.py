@@ -2,48 +2,21 @@
 import streamlit as st
 import ui                   # UIモジュール
 import llm                  # LLMモジュール
-import database             # データベースモジュール
-import metrics              # 評価指標モジュール
-import data                 # データモジュール
-import torch
-from transformers import pipeline
-from config import MODEL_NAME
-from huggingface_hub import HfFolder
+from bootstrap import RerunTimer, bootstrap, display_timing_panel
+
+rerun_timer = RerunTimer()
 
 # --- アプリケーション設定 ---
 st.set_page_config(page_title="Gemma Chatbot", layout="wide")
 
 # --- 初期化処理 ---
-# NLTKデータのダウンロード（初回起動時など）
-metrics.initialize_nltk()
-
-# データベースの初期化（テーブルが存在しない場合、作成）
-database.init_db()
-
-# データベースが空ならサンプルデータを投入
-data.ensure_initial_data()
+# NLTKデータ・データベース・初期サンプルデータの準備はプロセスごとに1回だけ行う
+with rerun_timer.phase("bootstrap"):
+    bootstrap_timings = bootstrap()
 
 # LLMモデルのロード（キャッシュを利用）
-# モデルをキャッシュして再利用
-@st.cache_resource
-def load_model():
-    """LLMモデルをロードする"""
-    try:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        st.info(f"Using device: {device}") # 使用デバイスを表示
-        pipe = pipeline(
-            "text-generation",
-            model=MODEL_NAME,
-            model_kwargs={"torch_dtype": torch.bfloat16},
-            device=device
-        )
-        st.success(f"モデル '{MODEL_NAME}' の読み込みに成功しました。")
-        return pipe
-    except Exception as e:
-        st.error(f"モデル '{MODEL_NAME}' の読み込みに失敗しました: {e}")
-        st.error("GPUメモリ不足の可能性があります。不要なプロセスを終了するか、より小さいモデルの使用を検討してください。")
-        return None
-pipe = llm.load_model()
+with rerun_timer.phase("load_model"):
+    pipe = llm.load_model()
 
 # --- Streamlit アプリケーション ---
 st.title("🤖 Gemma 2 Chatbot with Feedback")
@@ -66,16 +39,20 @@ page = st.sidebar.radio(
 
 
 # --- メインコンテンツ ---
-if st.session_state.page == "チャット":
-    if pipe:
-        ui.display_chat_page(pipe)
-    else:
-        st.error("チャット機能を利用できません。モデルの読み込みに失敗しました。")
-elif st.session_state.page == "履歴閲覧":
-    ui.display_history_page()
-elif st.session_state.page == "サンプルデータ管理":
-    ui.display_data_page()
+with rerun_timer.phase("page"):
+    if st.session_state.page == "チャット":
+        if pipe:
+            ui.display_chat_page(pipe)
+        else:
+            st.error("チャット機能を利用できません。モデルの読み込みに失敗しました。")
+    elif st.session_state.page == "履歴閲覧":
+        ui.display_history_page()
+    elif st.session_state.page == "サンプルデータ管理":
+        ui.display_data_page()
 
 # --- フッターなど（任意） ---
 st.sidebar.markdown("---")
-st.sidebar.info("開発者: [Your Name]")
\ No newline at end of file
+st.sidebar.info("開発者: [Your Name]")
+
+# --- デバッグパネル（今回の再実行の所要時間の内訳） ---
+display_timing_panel(rerun_timer, bootstrap_timings)
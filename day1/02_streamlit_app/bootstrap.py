@@ -0,0 +1,69 @@
+# bootstrap.py
+# プロセスごとに1回だけ行う初期化と、再実行ごとの所要時間の計測
+# Streamlitはウィジェットを操作するたびにapp.pyを先頭から再実行するが、importしたモジュールはプロセス内で保持される
+import threading
+import time
+from contextlib import contextmanager
+import pandas as pd
+import streamlit as st
+import database
+import metrics
+import data
+
+_lock = threading.Lock()
+_bootstrap_timings = None  # 初期化済みなら各処理の所要時間(秒)
+
+
+class RerunTimer:
+    """1回の再実行の処理ごとの所要時間を記録する"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.timings = {}
+
+    @contextmanager
+    def phase(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start_time
+
+    def total(self):
+        return time.perf_counter() - self.started_at
+
+
+def bootstrap():
+    """NLTKデータ・データベース・初期データの準備をプロセスごとに1回だけ行う
+
+    2回目以降の再実行では何もせずに返ります。各処理の所要時間(秒)の辞書を返します。
+    """
+    global _bootstrap_timings
+    if _bootstrap_timings is not None:
+        return _bootstrap_timings
+    # 複数のセッションが同時に最初の再実行を行っても1回だけ初期化する
+    with _lock:
+        if _bootstrap_timings is None:
+            timer = RerunTimer()
+            # NLTKデータのダウンロード（データがあればネットワークにアクセスしない）
+            with timer.phase("initialize_nltk"):
+                metrics.initialize_nltk()
+            # データベースの初期化（テーブルが存在しない場合、作成）
+            with timer.phase("init_db"):
+                database.init_db()
+            # データベースが空ならサンプルデータを投入
+            with timer.phase("ensure_initial_data"):
+                data.ensure_initial_data()
+            _bootstrap_timings = timer.timings
+    return _bootstrap_timings
+
+
+def display_timing_panel(rerun_timer, bootstrap_timings):
+    """サイドバーのデバッグパネルに今回の再実行の所要時間の内訳を表示する（スクリプトの最後に呼び出す）"""
+    with st.sidebar.expander("デバッグ: 再実行の所要時間"):
+        timings = dict(rerun_timer.timings)
+        timings["合計"] = rerun_timer.total()
+        st.dataframe(pd.DataFrame({"秒": timings}).round(4))
+        st.caption("プロセスの初回のみ実行した初期化: " + ", ".join(
+            f"{name} {seconds:.3f}秒" for name, seconds in bootstrap_timings.items()
+        ))
@@ -1,3 +1,24 @@
 # config.py
+import os
+
 DB_FILE = "chat_feedback.db"
-MODEL_NAME = "google/gemma-2-2b-jpn-it"
\ No newline at end of file
+MODEL_NAME = "google/gemma-2-2b-jpn-it"
+# CPU推論時の量子化（"int8"でLinear層を動的量子化。空ならbf16のまま）
+QUANTIZATION = os.environ.get("QUANTIZATION", "")
+QUANTIZED_CACHE_DIR = os.environ.get("QUANTIZED_CACHE_DIR", "quantized_models")  # 量子化済みモデルの保存先
+# 回答を生成するバックエンド（"local": このプロセスでモデルを読み込む / "http": 共有の生成サーバーを使う / "stub": テスト用）
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "local")
+LLM_API_URL = os.environ.get("LLM_API_URL", "http://localhost:8501")  # httpバックエンドの生成サーバー（day1/03_FastAPI など）
+LLM_API_CONNECT_TIMEOUT = float(os.environ.get("LLM_API_CONNECT_TIMEOUT", "5"))  # 接続のタイムアウト(秒)
+LLM_API_READ_TIMEOUT = float(os.environ.get("LLM_API_READ_TIMEOUT", "300"))  # 応答（ストリーミングでは次のデータ）を待つタイムアウト(秒)
+LLM_API_POOL_SIZE = int(os.environ.get("LLM_API_POOL_SIZE", "10"))  # 生成サーバーへの接続プールの大きさ
+LLM_STUB_TOKEN_MS = float(os.environ.get("LLM_STUB_TOKEN_MS", "20"))  # stubバックエンドの1トークンあたりの待ち時間(ミリ秒)
+# 生成ワーカー（全セッションで共有し、同時に生成する数を制限する）
+# localバックエンドではCPU/GPUを奪い合うため既定は1。httpバックエンドでは生成サーバーのバッチに合わせて増やせる
+GENERATION_WORKERS = int(os.environ.get("GENERATION_WORKERS", "1"))
+GENERATION_POLL_INTERVAL = float(os.environ.get("GENERATION_POLL_INTERVAL", "0.5"))  # 生成の進み具合を画面に反映する間隔(秒)
+# 回答キャッシュ（chat_historyで正確と評価された過去の回答を同じ・ほぼ同じ質問に再利用する）
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_MAX_AGE_DAYS = float(os.environ.get("ANSWER_CACHE_MAX_AGE_DAYS", "30"))  # この日数より古い回答は再利用しない
+ANSWER_CACHE_MIN_CORRECTNESS = float(os.environ.get("ANSWER_CACHE_MIN_CORRECTNESS", "1.0"))  # 再利用する回答の正確性スコアの下限
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", "0.9"))  # ほぼ同じ質問とみなす類似度（0で完全一致のみ）
@@ -21,7 +21,32 @@ CREATE TABLE IF NOT EXISTS {TABLE_NAME}
  bleu_score REAL,
  similarity_score REAL,
  word_count INTEGER,
- relevance_score REAL)
+ relevance_score REAL,
+ ttft REAL,                 -- 最初のトークンまでの時間(秒)
+ completion_tokens INTEGER, -- 生成したトークン数
+ tokens_per_sec REAL,       -- デコードの速度
+ answer_source TEXT,        -- 回答の出所（model / cache_exact / cache_near）
+ source_id INTEGER)         -- 回答キャッシュで再利用した元の回答のid（再利用の評価が低ければ元の回答を再利用しない）
+'''
+# 既存のデータベースに後から追加した列（init_dbでALTER TABLEする）
+ADDED_COLUMNS = {
+    "ttft": "REAL",
+    "completion_tokens": "INTEGER",
+    "tokens_per_sec": "REAL",
+    "answer_source": "TEXT",
+    "source_id": "INTEGER",
+}
+
+# 回答キャッシュの検索結果（ヒット率の集計用）
+CACHE_LOG_TABLE = "answer_cache_log"
+CACHE_LOG_SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS {CACHE_LOG_TABLE}
+(id INTEGER PRIMARY KEY AUTOINCREMENT,
+ timestamp TEXT,
+ question TEXT,
+ result TEXT,       -- exact / near / miss / bypass（再生成を指定してキャッシュを使わなかった）
+ similarity REAL,
+ source_id INTEGER) -- 再利用したchat_historyのid
 '''
 
 # --- データベース初期化 ---
@@ -31,6 +56,12 @@ def init_db():
         conn = sqlite3.connect(DB_FILE)
         c = conn.cursor()
         c.execute(SCHEMA)
+        c.execute(CACHE_LOG_SCHEMA)
+        # 列を追加する前に作成されたテーブルに不足している列を追加する
+        existing_columns = {row[1] for row in c.execute(f"PRAGMA table_info({TABLE_NAME})")}
+        for column, column_type in ADDED_COLUMNS.items():
+            if column not in existing_columns:
+                c.execute(f"ALTER TABLE {TABLE_NAME} ADD COLUMN {column} {column_type}")
         conn.commit()
         conn.close()
         print(f"Database '{DB_FILE}' initialized successfully.")
@@ -39,8 +70,9 @@ def init_db():
         raise e # エラーを再発生させてアプリの起動を止めるか、適切に処理する
 
 # --- データ操作関数 ---
-def save_to_db(question, answer, feedback, correct_answer, is_correct, response_time):
-    """チャット履歴と評価指標をデータベースに保存する"""
+def save_to_db(question, answer, feedback, correct_answer, is_correct, response_time,
+               ttft=None, completion_tokens=None, tokens_per_sec=None, answer_source=None, source_id=None):
+    """チャット履歴と評価指標をデータベースに保存する（ストリーミングで計測した値と回答キャッシュの情報は任意）"""
     conn = None
     try:
         conn = sqlite3.connect(DB_FILE)
@@ -54,10 +86,12 @@ def save_to_db(question, answer, feedback, correct_answer, is_correct, response_
 
         c.execute(f'''
         INSERT INTO {TABLE_NAME} (timestamp, question, answer, feedback, correct_answer, is_correct,
-                                 response_time, bleu_score, similarity_score, word_count, relevance_score)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                                 response_time, bleu_score, similarity_score, word_count, relevance_score,
+                                 ttft, completion_tokens, tokens_per_sec, answer_source, source_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (timestamp, question, answer, feedback, correct_answer, is_correct,
-             response_time, bleu_score, similarity_score, word_count, relevance_score))
+             response_time, bleu_score, similarity_score, word_count, relevance_score,
+             ttft, completion_tokens, tokens_per_sec, answer_source, source_id))
         conn.commit()
         print("Data saved to DB successfully.") # デバッグ用
     except sqlite3.Error as e:
@@ -84,6 +118,66 @@ def get_chat_history():
         if conn:
             conn.close()
 
+def get_reusable_answers(min_correctness, since):
+    """正確性スコアが min_correctness 以上で、since（"%Y-%m-%d %H:%M:%S"）以降に保存された回答を新しい順に返す
+
+    各行は (元の回答のid, timestamp, question, answer) です。再利用した回答を保存した行は元の回答のidを返し、
+    再利用した回答が min_correctness 未満と評価された元の回答（とその再利用）は返しません。
+    """
+    conn = None
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        c = conn.cursor()
+        c.execute(f'''
+        SELECT COALESCE(h.source_id, h.id), h.timestamp, h.question, h.answer FROM {TABLE_NAME} h
+        WHERE h.is_correct >= ? AND h.timestamp >= ? AND h.answer IS NOT NULL AND h.answer != ''
+          AND NOT EXISTS (
+            SELECT 1 FROM {TABLE_NAME} r
+            WHERE r.source_id = COALESCE(h.source_id, h.id) AND r.is_correct < ?
+          )
+        ORDER BY h.timestamp DESC
+        ''', (min_correctness, since, min_correctness))
+        return c.fetchall()
+    except sqlite3.Error as e:
+        st.error(f"回答キャッシュの検索中にエラーが発生しました: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+def log_answer_cache_lookup(question, result, similarity=None, source_id=None):
+    """回答キャッシュの検索結果を記録する"""
+    conn = None
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        c = conn.cursor()
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        c.execute(f'''
+        INSERT INTO {CACHE_LOG_TABLE} (timestamp, question, result, similarity, source_id)
+        VALUES (?, ?, ?, ?, ?)
+        ''', (timestamp, question, result, similarity, source_id))
+        conn.commit()
+    except sqlite3.Error as e:
+        st.error(f"回答キャッシュの記録中にエラーが発生しました: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+def get_answer_cache_stats():
+    """回答キャッシュの検索結果ごとの件数を返す（例: {"exact": 3, "near": 1, "miss": 10}）"""
+    conn = None
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        c = conn.cursor()
+        c.execute(f"SELECT result, COUNT(*) FROM {CACHE_LOG_TABLE} GROUP BY result")
+        return dict(c.fetchall())
+    except sqlite3.Error as e:
+        st.error(f"回答キャッシュの統計の取得中にエラーが発生しました: {e}")
+        return {}
+    finally:
+        if conn:
+            conn.close()
+
 def get_db_count():
     """データベース内のレコード数を取得する"""
     conn = None
@@ -114,6 +208,7 @@ def clear_db():
         conn = sqlite3.connect(DB_FILE)
         c = conn.cursor()
         c.execute(f"DELETE FROM {TABLE_NAME}")
+        c.execute(f"DELETE FROM {CACHE_LOG_TABLE}")
         conn.commit()
         st.success("データベースが正常にクリアされました。")
         st.session_state.confirm_clear = False # 確認状態をリセット
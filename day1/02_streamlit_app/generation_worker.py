@@ -0,0 +1,110 @@
+# generation_worker.py
+# 回答の生成を、全てのセッション（ブラウザのタブ）で共有するワーカースレッドで行う
+# 生成はスクリプトのスレッドの外で進むため、生成中にウィジェットを操作しても生成はやり直されず、同時に生成する数は GENERATION_WORKERS までに制限される
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
+from config import GENERATION_WORKERS
+from llm import generate_response_stream
+
+# ジョブの状態
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+CANCELLED = "cancelled"
+
+
+class GenerationJob:
+    """1件の生成ジョブ（ワーカースレッドが書き込み、スクリプトのスレッドが定期的に読み取る）"""
+
+    def __init__(self, job_id, question):
+        self.id = job_id
+        self.question = question
+        self.status = QUEUED
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.stats = {}  # generate_response_stream が設定する計測値（生成の終了後に読む）
+        self._chunks = []
+        self._cancel_event = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in (DONE, CANCELLED)
+
+    @property
+    def cancel_requested(self):
+        return self._cancel_event.is_set()
+
+    def cancel(self):
+        """次のテキストの断片を受け取った時点で生成を打ち切る（順番待ちの場合は生成しない）"""
+        self._cancel_event.set()
+
+    def text(self):
+        """これまでに生成されたテキスト"""
+        return "".join(self._chunks)
+
+
+class GenerationWorker:
+    """プロセス全体で共有する生成のワーカープール（max_workers件を超えるジョブは順番待ちになる）"""
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="generation")
+        self._lock = threading.Lock()
+        self._queued = []  # 順番待ちのジョブ（投入順）
+        self._running = 0
+        self._ids = itertools.count(1)
+
+    def submit(self, backend, question):
+        """生成ジョブを投入してすぐに返る"""
+        job = GenerationJob(next(self._ids), question)
+        with self._lock:
+            self._queued.append(job)
+        self._executor.submit(self._run, backend, job)
+        return job
+
+    def _run(self, backend, job):
+        with self._lock:
+            self._queued.remove(job)
+            if job.cancel_requested:
+                # 順番待ちの間に中止されたジョブは生成しない
+                job.status = CANCELLED
+                job.finished_at = time.time()
+                return
+            self._running += 1
+        job.started_at = time.time()
+        job.status = RUNNING
+        stream = generate_response_stream(backend, job.question, job.stats)
+        try:
+            for text in stream:
+                if job.cancel_requested:
+                    break
+                job._chunks.append(text)
+        except Exception as e:
+            job.stats["error"] = str(e)
+        finally:
+            # バックエンドの生成が実際に止まるまで待ってから枠を空ける（中止した生成がCPUを使い続けないように）
+            stream.close()
+            job.stats["queue_wait"] = job.started_at - job.submitted_at
+            job.finished_at = time.time()
+            job.status = CANCELLED if job.cancel_requested else DONE
+            with self._lock:
+                self._running -= 1
+
+    def queue_position(self, job):
+        """順番待ちのジョブが何番目か（順番待ちでなければ0）"""
+        with self._lock:
+            return self._queued.index(job) + 1 if job in self._queued else 0
+
+    def snapshot(self):
+        with self._lock:
+            return {"max_workers": self.max_workers, "running": self._running, "queued": len(self._queued)}
+
+
+@st.cache_resource
+def get_generation_worker():
+    """プロセスで1つのワーカープールを返す"""
+    return GenerationWorker(GENERATION_WORKERS)
@@ -1,29 +1,66 @@
 # llm.py
+# 回答の生成はバックエンド（config.LLM_BACKEND）に任せる
+#   local: このプロセスでtransformersのパイプラインを読み込む（従来どおり）
+#   http:  共有の生成サーバー（day1/03_FastAPI など）にHTTPで問い合わせる。モデルを読み込まないため、複数のアプリで1つのモデルを共有できる
+#   stub:  モデルなしで決定的な回答を返す（テスト用）
 import os
-import torch
-from transformers import pipeline
+import json
+import hashlib
+import threading
 import streamlit as st
 import time
-from config import MODEL_NAME
-from huggingface_hub import login
+from functools import lru_cache
+from config import (
+    MODEL_NAME, QUANTIZATION, QUANTIZED_CACHE_DIR,
+    LLM_BACKEND, LLM_API_URL, LLM_API_CONNECT_TIMEOUT, LLM_API_READ_TIMEOUT, LLM_API_POOL_SIZE, LLM_STUB_TOKEN_MS,
+)
+
+# 生成のパラメータ（全てのバックエンドで共通）
+GENERATION_KWARGS = {"max_new_tokens": 512, "do_sample": True, "temperature": 0.7, "top_p": 0.9}
 
 # モデルをキャッシュして再利用
 @st.cache_resource
 def load_model():
-    """LLMモデルをロードする"""
+    """設定されたバックエンドを作成する（localの場合はLLMモデルをロードする）"""
+    if LLM_BACKEND == "http":
+        st.info(f"生成サーバー {LLM_API_URL} を使用します")
+        return HTTPBackend(LLM_API_URL, (LLM_API_CONNECT_TIMEOUT, LLM_API_READ_TIMEOUT), LLM_API_POOL_SIZE)
+    if LLM_BACKEND == "stub":
+        st.info("スタブのバックエンドを使用します（モデルは読み込みません）")
+        return StubBackend(LLM_STUB_TOKEN_MS)
+    pipe = load_pipeline()
+    return LocalBackend(pipe) if pipe is not None else None
+
+def load_pipeline():
+    """このプロセスでLLMモデルをロードする"""
+    # torch / transformers は local バックエンドでのみ読み込む
+    import torch
+    from transformers import pipeline
     try:
 
         # アクセストークンを保存
         hf_token = st.secrets["huggingface"]["token"]
-        
+
         device = "cuda" if torch.cuda.is_available() else "cpu"
         st.info(f"Using device: {device}") # 使用デバイスを表示
-        pipe = pipeline(
-            "text-generation",
-            model=MODEL_NAME,
-            model_kwargs={"torch_dtype": torch.bfloat16},
-            device=device
-        )
+        if QUANTIZATION and device == "cpu":
+            # CPUではLinear層をint8に量子化して推論を高速化する（変換結果はディスクにキャッシュ）
+            from transformers import AutoTokenizer
+            from quantization import load_quantized_model
+            st.info(f"{QUANTIZATION}量子化モデルを使用します")
+            pipe = pipeline(
+                "text-generation",
+                model=load_quantized_model(MODEL_NAME, QUANTIZATION, QUANTIZED_CACHE_DIR),
+                tokenizer=AutoTokenizer.from_pretrained(MODEL_NAME),
+                device=device
+            )
+        else:
+            pipe = pipeline(
+                "text-generation",
+                model=MODEL_NAME,
+                model_kwargs={"torch_dtype": torch.bfloat16},
+                device=device
+            )
         st.success(f"モデル '{MODEL_NAME}' の読み込みに成功しました。")
         return pipe
     except Exception as e:
@@ -31,49 +68,14 @@ def load_model():
         st.error("GPUメモリ不足の可能性があります。不要なプロセスを終了するか、より小さいモデルの使用を検討してください。")
         return None
 
-def generate_response(pipe, user_question):
+def generate_response(backend, user_question):
     """LLMを使用して質問に対する回答を生成する"""
-    if pipe is None:
+    if backend is None:
         return "モデルがロードされていないため、回答を生成できません。", 0
 
     try:
         start_time = time.time()
-        messages = [
-            {"role": "user", "content": user_question},
-        ]
-        # max_new_tokensを調整可能にする（例）
-        outputs = pipe(messages, max_new_tokens=512, do_sample=True, temperature=0.7, top_p=0.9)
-
-        # Gemmaの出力形式に合わせて調整が必要な場合がある
-        # 最後のassistantのメッセージを取得
-        assistant_response = ""
-        if outputs and isinstance(outputs, list) and outputs[0].get("generated_text"):
-           if isinstance(outputs[0]["generated_text"], list) and len(outputs[0]["generated_text"]) > 0:
-               # messages形式の場合
-               last_message = outputs[0]["generated_text"][-1]
-               if last_message.get("role") == "assistant":
-                   assistant_response = last_message.get("content", "").strip()
-           elif isinstance(outputs[0]["generated_text"], str):
-               # 単純な文字列の場合（古いtransformers？） - プロンプト部分を除く処理が必要かも
-               # この部分はモデルやtransformersのバージョンによって調整が必要
-               full_text = outputs[0]["generated_text"]
-               # 簡単な方法：ユーザーの質問以降の部分を取得
-               prompt_end = user_question
-               response_start_index = full_text.find(prompt_end) + len(prompt_end)
-               # 応答部分のみを抽出（より堅牢な方法が必要な場合あり）
-               possible_response = full_text[response_start_index:].strip()
-               # 特定の開始トークンを探すなど、モデルに合わせた調整
-               if "<start_of_turn>model" in possible_response:
-                    assistant_response = possible_response.split("<start_of_turn>model\n")[-1].strip()
-               else:
-                    assistant_response = possible_response # フォールバック
-
-        if not assistant_response:
-             # 上記で見つからない場合のフォールバックやデバッグ
-             print("Warning: Could not extract assistant response. Full output:", outputs)
-             assistant_response = "回答の抽出に失敗しました。"
-
-
+        assistant_response = backend.generate(user_question)
         end_time = time.time()
         response_time = end_time - start_time
         print(f"Generated response in {response_time:.2f}s") # デバッグ用
@@ -84,4 +86,246 @@ def generate_response(pipe, user_question):
         # エラーの詳細をログに出力
         import traceback
         traceback.print_exc()
-        return f"エラーが発生しました: {str(e)}", 0
\ No newline at end of file
+        return f"エラーが発生しました: {str(e)}", 0
+
+def generate_response_stream(backend, user_question, stats):
+    """LLMの回答を生成しながらテキストの断片を順に返すジェネレーター（st.write_streamに渡す）
+
+    生成が終わると stats に response_time、ttft（最初のトークンまでの秒数）、completion_tokens、tokens_per_sec を設定します。
+    生成ワーカー（generation_worker.py）のスレッドから呼ばれるため画面には表示せず、エラーは stats["error"] に設定します。
+    """
+    stats.update(response_time=0, ttft=None, completion_tokens=0, tokens_per_sec=None)
+    if backend is None:
+        yield "モデルがロードされていないため、回答を生成できません。"
+        return
+
+    start_time = time.time()
+    first_token_at = None
+    stream = backend.stream(user_question, stats)
+    try:
+        for text in stream:
+            if first_token_at is None:
+                first_token_at = time.time()
+            yield text
+    except Exception as e:
+        stats["error"] = str(e)
+        yield f"\n\nエラーが発生しました: {str(e)}"
+        return
+    finally:
+        # 途中で閉じられた場合も、バックエンドの生成を止めてから返る
+        stream.close()
+
+    end_time = time.time()
+    stats["response_time"] = end_time - start_time
+    # バックエンドが最初のトークンの時刻を記録しない場合は、最初のテキストを受け取った時刻を使う
+    first_token_at = stats.pop("first_token_at", None) or first_token_at
+    if first_token_at is not None:
+        stats["ttft"] = first_token_at - start_time
+        # デコード（2トークン目以降）の速度。プレフィルの時間はttftに含まれる
+        decode_time = end_time - first_token_at
+        if stats["completion_tokens"] > 1 and decode_time > 0:
+            stats["tokens_per_sec"] = (stats["completion_tokens"] - 1) / decode_time
+
+def _extract_assistant_response(outputs, user_question):
+    """パイプラインの出力から最後のassistantのメッセージを取得する"""
+    # Gemmaの出力形式に合わせて調整が必要な場合がある
+    assistant_response = ""
+    if outputs and isinstance(outputs, list) and outputs[0].get("generated_text"):
+       if isinstance(outputs[0]["generated_text"], list) and len(outputs[0]["generated_text"]) > 0:
+           # messages形式の場合
+           last_message = outputs[0]["generated_text"][-1]
+           if last_message.get("role") == "assistant":
+               assistant_response = last_message.get("content", "").strip()
+       elif isinstance(outputs[0]["generated_text"], str):
+           # 単純な文字列の場合（古いtransformers？） - プロンプト部分を除く処理が必要かも
+           # この部分はモデルやtransformersのバージョンによって調整が必要
+           full_text = outputs[0]["generated_text"]
+           # 簡単な方法：ユーザーの質問以降の部分を取得
+           prompt_end = user_question
+           response_start_index = full_text.find(prompt_end) + len(prompt_end)
+           # 応答部分のみを抽出（より堅牢な方法が必要な場合あり）
+           possible_response = full_text[response_start_index:].strip()
+           # 特定の開始トークンを探すなど、モデルに合わせた調整
+           if "<start_of_turn>model" in possible_response:
+                assistant_response = possible_response.split("<start_of_turn>model\n")[-1].strip()
+           else:
+                assistant_response = possible_response # フォールバック
+
+    if not assistant_response:
+         # 上記で見つからない場合のフォールバックやデバッグ
+         print("Warning: Could not extract assistant response. Full output:", outputs)
+         assistant_response = "回答の抽出に失敗しました。"
+    return assistant_response
+
+@lru_cache(maxsize=None)
+def counting_text_streamer_class():
+    """CountingTextStreamerクラスを返す（transformersは local バックエンドでのみ読み込む）"""
+    from transformers import TextIteratorStreamer
+
+    class CountingTextStreamer(TextIteratorStreamer):
+        """生成されたテキストを順に返しつつ、最初のトークンの時刻と生成トークン数を記録するストリーマー"""
+
+        def __init__(self, tokenizer, **kwargs):
+            super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True, **kwargs)
+            self.first_token_at = None
+            self.completion_tokens = 0
+
+        def put(self, value):
+            # 最初の呼び出しはプロンプトのトークン列（skip_promptで読み飛ばされる）
+            if not self.next_tokens_are_prompt:
+                if self.first_token_at is None:
+                    self.first_token_at = time.time()
+                self.completion_tokens += value.numel()
+            super().put(value)
+
+    return CountingTextStreamer
+
+@lru_cache(maxsize=None)
+def event_stopping_criteria_class():
+    """EventStoppingCriteriaクラスを返す（transformersは local バックエンドでのみ読み込む）"""
+    import torch
+    from transformers import StoppingCriteria
+
+    class EventStoppingCriteria(StoppingCriteria):
+        """threading.Event がセットされたら次のステップで生成を止める"""
+
+        def __init__(self, event):
+            self.event = event
+
+        def __call__(self, input_ids, scores, **kwargs):
+            return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+    return EventStoppingCriteria
+
+class LocalBackend:
+    """このプロセスで読み込んだtransformersのパイプラインで生成する"""
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def generate(self, user_question):
+        messages = [
+            {"role": "user", "content": user_question},
+        ]
+        outputs = self.pipe(messages, **GENERATION_KWARGS)
+        return _extract_assistant_response(outputs, user_question)
+
+    def stream(self, user_question, stats):
+        """生成したテキストの断片を順に返し、stats に completion_tokens と first_token_at を設定する
+
+        途中で閉じられた場合は、生成のスレッドを次のステップで止めて終了を待ってから返ります。
+        """
+        streamer = counting_text_streamer_class()(self.pipe.tokenizer)
+        stop_event = threading.Event()
+        messages = [
+            {"role": "user", "content": user_question},
+        ]
+        errors = []
+
+        def run():
+            try:
+                self.pipe(
+                    messages,
+                    streamer=streamer,
+                    stopping_criteria=[event_stopping_criteria_class()(stop_event)],
+                    **GENERATION_KWARGS,
+                )
+            except Exception as e:
+                errors.append(e)
+                streamer.end()  # 例外時もストリームを終了させる
+
+        # 生成は別スレッドで行い、このスレッドではデコードされたテキストを受け取って画面に送る
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            for text in streamer:
+                if text:
+                    yield text
+        finally:
+            stop_event.set()  # 最後まで生成した場合は何もしない
+            thread.join()
+        if errors:
+            raise errors[0]
+        stats["completion_tokens"] = streamer.completion_tokens
+        stats["first_token_at"] = streamer.first_token_at
+
+class HTTPBackend:
+    """共有の生成サーバー（day1/03_FastAPI の /generate と /generate/stream）で生成する
+
+    requests.Session の接続プールを全てのセッション（ブラウザのタブ）で共有し、接続と読み取りにタイムアウトを設定します。
+    localバックエンドと同じ回答になるよう、質問文を messages として送り、サーバー側でチャットテンプレートを適用させます。
+    """
+
+    def __init__(self, api_url, timeout=(5, 300), pool_size=10):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.api_url = api_url.rstrip("/")
+        self.timeout = timeout  # (接続, 読み取り) の秒数
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _raise_for_status(self, response):
+        if response.status_code != 200:
+            try:
+                detail = response.json().get("detail", response.text)
+            except ValueError:
+                detail = response.text
+            raise RuntimeError(f"生成サーバーがエラーを返しました (HTTP {response.status_code}): {detail}")
+
+    def _payload(self, user_question):
+        return {"messages": [{"role": "user", "content": user_question}], **GENERATION_KWARGS}
+
+    def generate(self, user_question):
+        response = self.session.post(
+            f"{self.api_url}/generate", json=self._payload(user_question), timeout=self.timeout
+        )
+        self._raise_for_status(response)
+        return response.json()["generated_text"]
+
+    def stream(self, user_question, stats):
+        """Server-Sent Eventsでテキストの断片を受け取り、done イベントの completion_tokens を stats に設定する"""
+        with self.session.post(
+            f"{self.api_url}/generate/stream",
+            json=self._payload(user_question),
+            stream=True,
+            timeout=self.timeout,
+        ) as response:
+            self._raise_for_status(response)
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    data = json.loads(line[len("data:"):].strip())
+                    if event == "token":
+                        yield data["text"]
+                    elif event == "done":
+                        stats["completion_tokens"] = data.get("completion_tokens") or 0
+                    elif event == "error":
+                        raise RuntimeError(data.get("detail"))
+
+class StubBackend:
+    """モデルなしで質問から決定的な回答を作り、1語ずつ token_ms の間隔で返す（テスト用）"""
+
+    WORDS = ["これは", "スタブ", "の", "回答", "です", "。", "テスト", "用", "に", "生成", "しました", "、"]
+
+    def __init__(self, token_ms=20.0, num_tokens=24):
+        self.token_ms = token_ms
+        self.num_tokens = num_tokens
+
+    def _tokens(self, user_question):
+        digest = hashlib.sha256(user_question.encode("utf-8")).digest()
+        return [self.WORDS[digest[i % len(digest)] % len(self.WORDS)] for i in range(self.num_tokens)]
+
+    def generate(self, user_question):
+        time.sleep(self.token_ms * self.num_tokens / 1000)
+        return "".join(self._tokens(user_question))
+
+    def stream(self, user_question, stats):
+        for token in self._tokens(user_question):
+            time.sleep(self.token_ms / 1000)
+            stats["completion_tokens"] = stats.get("completion_tokens", 0) + 1
+            yield token
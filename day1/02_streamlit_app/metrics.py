@@ -6,9 +6,18 @@ import re
 from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.feature_extraction.text import TfidfVectorizer
 
+def ensure_nltk_data(resource="tokenizers/punkt", package="punkt"):
+    """NLTKのデータがなければダウンロードする（既にあればネットワークにアクセスしない）"""
+    try:
+        nltk.data.find(resource)
+        return False
+    except LookupError:
+        nltk.download(package, quiet=True)
+        return True
+
 # NLTKのヘルパー関数（エラー時フォールバック付き）
 try:
-    nltk.download('punkt', quiet=True)
+    ensure_nltk_data()
     from nltk.translate.bleu_score import sentence_bleu as nltk_sentence_bleu
     from nltk.tokenize import word_tokenize as nltk_word_tokenize
     print("NLTK loaded successfully.") # デバッグ用
@@ -27,10 +36,10 @@ except Exception as e:
         return f1 # F1スコアを返す（簡易的な代替）
 
 def initialize_nltk():
-    """NLTKのデータダウンロードを試みる関数"""
+    """NLTKのデータダウンロードを試みる関数（データが既にあればダウンロードしない）"""
     try:
-        nltk.download('punkt', quiet=True)
-        print("NLTK Punkt data checked/downloaded.") # デバッグ用
+        if ensure_nltk_data():
+            print("NLTK Punkt data downloaded.") # デバッグ用
     except Exception as e:
         st.error(f"NLTKデータのダウンロードに失敗しました: {e}")
 
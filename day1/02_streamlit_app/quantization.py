@@ -0,0 +1,63 @@
+# quantization.py
+# CPU推論用にLinear層をint8へ動的量子化したモデルを作成し、変換結果をディスクにキャッシュする
+import os
+
+# 対応している量子化モード（"int8": Linear層の重みをint8で保持し、活性化は推論時に動的に量子化する）
+QUANTIZATION_MODES = ("int8",)
+
+
+def quantized_cache_path(cache_dir, model_name, mode):
+    """量子化済みモデルのキャッシュファイルのパスを返す
+
+    pickleした量子化モジュールはtorch / transformersのバージョンに依存するため、バージョンをファイル名に含めます。
+    """
+    import torch
+    import transformers
+
+    safe_name = model_name.strip("/").replace("/", "--")
+    return os.path.join(cache_dir, f"{safe_name}.{mode}.torch-{torch.__version__}.tf-{transformers.__version__}.pt")
+
+
+def quantize_model(model, mode="int8"):
+    """float32のモデルのLinear層を動的量子化したモデルを返す"""
+    import torch
+
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"未対応の量子化モードです: {mode} (対応: {QUANTIZATION_MODES})")
+    # lm_headは語彙数が大きく出力の精度への影響が大きいため、量子化しない
+    linear_names = {
+        name for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and not name.endswith("lm_head")
+    }
+    return torch.ao.quantization.quantize_dynamic(model, linear_names, dtype=torch.qint8)
+
+
+def load_quantized_model(model_name, mode="int8", cache_dir="quantized_models", source=None, **load_kwargs):
+    """量子化済みのCausalLMモデルを返す。キャッシュがあれば変換せずに読み込む
+
+    source には読み込み元（ローカルのスナップショットなど）を指定でき、省略時は model_name を使用します。
+    動的量子化はfloat32の重みから行うため、初回の変換時は一時的にfloat32のモデルがメモリに載ります。
+    """
+    import torch
+    from transformers import AutoModelForCausalLM
+
+    path = quantized_cache_path(cache_dir, model_name, mode)
+    if os.path.isfile(path):
+        print(f"量子化済みモデルのキャッシュを読み込みます: {path}")
+        model = torch.load(path, weights_only=False)
+        model.eval()
+        return model
+
+    print(f"モデル '{model_name}' を{mode}に量子化しています（初回のみ）...")
+    model = AutoModelForCausalLM.from_pretrained(
+        source or model_name, torch_dtype=torch.float32, low_cpu_mem_usage=True, **load_kwargs
+    )
+    model.eval()
+    model = quantize_model(model, mode)
+    # 書き込み途中のファイルを読み込まないよう、一時ファイルに保存してから置き換える
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    torch.save(model, tmp_path)
+    os.replace(tmp_path, path)
+    print(f"量子化済みモデルを保存しました: {path}")
+    return model
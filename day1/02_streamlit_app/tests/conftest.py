@@ -0,0 +1,37 @@
+import importlib.util
+import os
+import sys
+import types
+
+# テスト対象のモジュール（02_streamlit_app直下）をimportできるようにする
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+
+def _noop(*args, **kwargs):
+    return None
+
+
+def _stub_module(name, **attrs):
+    """テストで使う属性だけを持つモジュールを登録する"""
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+
+
+# streamlitはスクリプトの実行環境の外では使わないため、インストールの有無にかかわらず代わりのモジュールを使う
+_stub_module(
+    "streamlit",
+    cache_resource=lambda func: func,
+    error=_noop,
+    warning=_noop,
+    info=_noop,
+    success=_noop,
+    session_state={},
+    secrets={},
+)
+
+# database.py がimportする pandas と metrics.py（nltk・janome・scikit-learn）は、テストする関数では使わない
+if importlib.util.find_spec("pandas") is None:
+    _stub_module("pandas")
+if any(importlib.util.find_spec(name) is None for name in ("nltk", "janome", "sklearn")):
+    _stub_module("metrics", calculate_metrics=_noop)
@@ -0,0 +1,73 @@
+# answer_cache.py の正規化・類似度と、chat_history を使った検索
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+import answer_cache
+import database
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_FILE", str(tmp_path / "chat.db"))
+    monkeypatch.setattr(answer_cache, "ANSWER_CACHE_ENABLED", True)
+    monkeypatch.setattr(answer_cache, "ANSWER_CACHE_MIN_CORRECTNESS", 1.0)
+    monkeypatch.setattr(answer_cache, "ANSWER_CACHE_SIMILARITY", 0.8)
+    monkeypatch.setattr(answer_cache, "ANSWER_CACHE_MAX_AGE_DAYS", 30)
+    database.init_db()
+    return database.DB_FILE
+
+
+def insert(db, question, answer, is_correct, days_ago=0, source_id=None):
+    timestamp = (datetime.now() - timedelta(days=days_ago)).strftime("%Y-%m-%d %H:%M:%S")
+    with sqlite3.connect(db) as conn:
+        cursor = conn.execute(
+            f"INSERT INTO {database.TABLE_NAME} (timestamp, question, answer, is_correct, source_id) VALUES (?, ?, ?, ?, ?)",
+            (timestamp, question, answer, is_correct, source_id),
+        )
+        return cursor.lastrowid
+
+
+def test_normalize_question_ignores_width_case_spaces_and_punctuation():
+    assert answer_cache.normalize_question("ＡＩ とは？") == answer_cache.normalize_question("ai とは?")
+    assert answer_cache.normalize_question("日本の首都は、どこですか。") == "日本の首都はどこですか"
+
+
+def test_exact_match_is_preferred(db):
+    insert(db, "日本の首都はどこですか", "東京です", 1.0, days_ago=2)
+    source_id = insert(db, "日本の首都はどこですか？", "東京です。", 1.0, days_ago=1)
+    cached = answer_cache.lookup_answer("日本の首都は どこですか")
+    assert cached.match == "exact"
+    assert cached.source_id == source_id  # 新しい方の回答
+    assert cached.answer == "東京です。"
+
+
+def test_near_match_above_threshold(db):
+    insert(db, "日本の首都はどこですか", "東京です", 1.0)
+    cached = answer_cache.lookup_answer("日本の首都はどこでしょうか")
+    assert cached is not None
+    assert cached.match == "near"
+    assert cached.similarity >= 0.8
+
+
+def test_miss_for_unrelated_incorrect_or_old_answers(db):
+    insert(db, "富士山の高さは", "3776mです", 0.5)
+    insert(db, "日本の首都はどこですか", "東京です", 1.0, days_ago=60)
+    assert answer_cache.lookup_answer("富士山の高さは") is None
+    assert answer_cache.lookup_answer("日本の首都はどこですか") is None
+    assert answer_cache.lookup_answer("機械学習とは") is None
+    assert database.get_answer_cache_stats() == {"miss": 3}
+
+
+def test_answer_rejected_on_reuse_is_not_reused_again(db):
+    source_id = insert(db, "日本の首都はどこですか", "大阪です", 1.0)
+    assert answer_cache.lookup_answer("日本の首都はどこですか").source_id == source_id
+    # 再利用した回答が「不正確」と評価された
+    insert(db, "日本の首都はどこですか", "大阪です", 0.0, source_id=source_id)
+    assert answer_cache.lookup_answer("日本の首都はどこですか") is None
+
+
+def test_hit_rate_excludes_bypass():
+    assert answer_cache.hit_rate({"exact": 1, "near": 1, "miss": 2, "bypass": 5}) == 0.5
+    assert answer_cache.hit_rate({}) is None
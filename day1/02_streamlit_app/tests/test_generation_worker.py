@@ -0,0 +1,50 @@
+# generation_worker.py の同時実行数の上限と中止
+import time
+
+from generation_worker import CANCELLED, DONE, QUEUED, GenerationWorker
+from llm import StubBackend
+
+
+def wait_finished(*jobs, timeout=5):
+    deadline = time.time() + timeout
+    while not all(job.finished for job in jobs):
+        assert time.time() < deadline, "ジョブが終了しませんでした"
+        time.sleep(0.005)
+
+
+def test_jobs_beyond_max_workers_are_queued():
+    worker = GenerationWorker(1)
+    backend = StubBackend(token_ms=5, num_tokens=10)
+    first = worker.submit(backend, "q1")
+    second = worker.submit(backend, "q2")
+    time.sleep(0.02)
+    assert worker.snapshot() == {"max_workers": 1, "running": 1, "queued": 1}
+    assert second.status == QUEUED
+    assert worker.queue_position(second) == 1
+    wait_finished(first, second)
+    assert first.status == second.status == DONE
+    assert first.text() == backend.generate("q1")
+    assert second.stats["completion_tokens"] == 10
+    assert second.stats["queue_wait"] > 0
+
+
+def test_cancelled_queued_job_is_not_generated():
+    worker = GenerationWorker(1)
+    backend = StubBackend(token_ms=5, num_tokens=10)
+    first = worker.submit(backend, "q1")
+    second = worker.submit(backend, "q2")
+    second.cancel()
+    wait_finished(first, second)
+    assert second.status == CANCELLED
+    assert second.text() == ""
+    assert second.started_at is None
+
+
+def test_cancelled_running_job_frees_slot():
+    worker = GenerationWorker(1)
+    job = worker.submit(StubBackend(token_ms=5, num_tokens=1000), "q")
+    time.sleep(0.05)
+    job.cancel()
+    wait_finished(job, timeout=1)
+    assert job.status == CANCELLED
+    assert worker.snapshot()["running"] == 0
@@ -2,8 +2,10 @@
 import streamlit as st
 import pandas as pd
 import time
-from database import save_to_db, get_chat_history, get_db_count, clear_db
-from llm import generate_response
+from database import save_to_db, get_chat_history, get_db_count, clear_db, get_answer_cache_stats
+from config import GENERATION_POLL_INTERVAL
+from generation_worker import QUEUED, CANCELLED, get_generation_worker
+from answer_cache import lookup_answer, record_bypass, hit_rate
 from data import create_sample_evaluation_data
 from metrics import get_metrics_descriptions
 
@@ -12,7 +14,11 @@ def display_chat_page(pipe):
     """チャットページのUIを表示する"""
     st.subheader("質問を入力してください")
     user_question = st.text_area("質問", key="question_input", height=100, value=st.session_state.get("current_question", ""))
-    submit_button = st.button("質問を送信")
+    # 生成中は次の質問を送信できない（生成はワーカーで続いているため、他のウィジェットは操作できる）
+    generating = st.session_state.get("generation_job") is not None
+    submit_button = st.button("質問を送信", disabled=generating)
+    # 正確と評価された過去の回答があっても、モデルで新しく生成する
+    force_regenerate = st.checkbox("過去の回答を再利用せずに生成する", key="force_regenerate")
 
     # セッション状態の初期化（安全のため）
     if "current_question" not in st.session_state:
@@ -21,8 +27,12 @@ def display_chat_page(pipe):
         st.session_state.current_answer = ""
     if "response_time" not in st.session_state:
         st.session_state.response_time = 0.0
+    if "generation_stats" not in st.session_state:
+        st.session_state.generation_stats = {}
     if "feedback_given" not in st.session_state:
         st.session_state.feedback_given = False
+    if "generation_job" not in st.session_state:
+        st.session_state.generation_job = None
 
     # 質問が送信された場合
     if submit_button and user_question:
@@ -30,18 +40,48 @@ def display_chat_page(pipe):
         st.session_state.current_answer = "" # 回答をリセット
         st.session_state.feedback_given = False # フィードバック状態もリセット
 
-        with st.spinner("モデルが回答を生成中..."):
-            answer, response_time = generate_response(pipe, user_question)
-            st.session_state.current_answer = answer
-            st.session_state.response_time = response_time
-            # ここでrerunすると回答とフィードバックが一度に表示される
-            st.rerun()
+        if force_regenerate:
+            record_bypass(user_question)
+            cached = None
+        else:
+            start_time = time.time()
+            cached = lookup_answer(user_question)
+        if cached is None:
+            start_generation(pipe, user_question)
+        else:
+            # 過去の回答を再利用する場合はモデルを呼び出さない
+            st.session_state.current_answer = cached.answer
+            st.session_state.response_time = time.time() - start_time
+            st.session_state.generation_stats = {
+                "answer_source": f"cache_{cached.match}",
+                "similarity": cached.similarity,
+                "cached_at": cached.timestamp,
+                "source_id": cached.source_id,
+            }
+        st.rerun()
+
+    # 生成中の場合は進み具合だけを表示する
+    if st.session_state.generation_job is not None:
+        display_generation_progress()
+        return
 
     # 回答が表示されるべきか判断 (質問があり、回答が生成済みで、まだフィードバックされていない)
     if st.session_state.current_question and st.session_state.current_answer:
         st.subheader("回答:")
         st.markdown(st.session_state.current_answer) # Markdownで表示
-        st.info(f"応答時間: {st.session_state.response_time:.2f}秒")
+        stats = st.session_state.generation_stats
+        if stats.get("error"):
+            st.error(f"回答生成中にエラーが発生しました: {stats['error']}")
+        if stats.get("answer_source", "").startswith("cache_"):
+            st.success(
+                f"正確と評価された過去の回答を再利用しました（質問の類似度: {stats['similarity']:.2f}, 保存日時: {stats['cached_at']}）"
+            )
+            if st.button("モデルで再生成"):
+                record_bypass(st.session_state.current_question)
+                st.session_state.feedback_given = False
+                start_generation(pipe, st.session_state.current_question)
+                st.rerun()
+        st.info(format_generation_stats(st.session_state.response_time, stats))
 
         # フィードバックフォームを表示 (まだフィードバックされていない場合)
         if not st.session_state.feedback_given:
@@ -53,10 +93,59 @@ def display_chat_page(pipe):
                   st.session_state.current_question = ""
                   st.session_state.current_answer = ""
                   st.session_state.response_time = 0.0
+                  st.session_state.generation_stats = {}
                   st.session_state.feedback_given = False
                   st.rerun() # 画面をクリア
 
 
+def start_generation(pipe, user_question):
+    """共有の生成ワーカーにジョブを投入する（生成の終了は待たない）"""
+    st.session_state.current_answer = ""
+    st.session_state.generation_job = get_generation_worker().submit(pipe, user_question)
+
+@st.fragment(run_every=GENERATION_POLL_INTERVAL)
+def display_generation_progress():
+    """生成ジョブの進み具合を表示する（GENERATION_POLL_INTERVAL秒ごとにこの部分だけが再実行される）"""
+    job = st.session_state.generation_job
+    if job is None:
+        return
+    if job.finished:
+        # 結果をセッション状態に移し、アプリ全体を再実行して回答とフィードバックを表示する
+        st.session_state.generation_job = None
+        if job.status != CANCELLED:
+            st.session_state.current_answer = job.text()
+            st.session_state.response_time = job.stats.get("response_time", 0.0)
+            st.session_state.generation_stats = {**job.stats, "answer_source": "model"}
+        st.rerun()
+
+    st.subheader("回答:")
+    if job.status == QUEUED:
+        worker = get_generation_worker().snapshot()
+        st.info(
+            f"生成の順番を待っています（{get_generation_worker().queue_position(job)}番目 / "
+            f"生成中 {worker['running']}件・同時に生成できる数 {worker['max_workers']}件）"
+        )
+    else:
+        st.markdown(job.text() + " ▌")
+        st.caption(f"モデルが回答を生成中... {time.time() - job.started_at:.1f}秒")
+    if st.button("生成を中止"):
+        job.cancel()
+        st.session_state.generation_job = None
+        st.rerun()
+
+def format_generation_stats(response_time, stats):
+    """応答時間と、計測できた場合は最初のトークンまでの時間・生成トークン数・tokens/secを1行にまとめる"""
+    text = f"応答時間: {response_time:.2f}秒"
+    if stats.get("ttft") is not None:
+        text += f" / 最初のトークンまで: {stats['ttft']:.2f}秒"
+    if stats.get("completion_tokens"):
+        text += f" / 生成トークン数: {stats['completion_tokens']}"
+    if stats.get("tokens_per_sec") is not None:
+        text += f" / {stats['tokens_per_sec']:.1f} tokens/sec"
+    if stats.get("queue_wait"):
+        text += f" / 生成の順番待ち: {stats['queue_wait']:.2f}秒"
+    return text
+
 def display_feedback_form():
     """フィードバック入力フォームを表示する"""
     with st.form("feedback_form"):
@@ -75,13 +164,20 @@ def display_feedback_form():
             if feedback_comment:
                 combined_feedback += f": {feedback_comment}"
 
+            stats = st.session_state.generation_stats
             save_to_db(
                 st.session_state.current_question,
                 st.session_state.current_answer,
                 combined_feedback,
                 correct_answer,
                 is_correct,
-                st.session_state.response_time
+                # 再利用した回答は生成していないため、応答時間の統計に含めない
+                None if stats.get("source_id") is not None else st.session_state.response_time,
+                ttft=stats.get("ttft"),
+                completion_tokens=stats.get("completion_tokens"),
+                tokens_per_sec=stats.get("tokens_per_sec"),
+                answer_source=stats.get("answer_source"),
+                source_id=stats.get("source_id"),
             )
             st.session_state.feedback_given = True
             st.success("フィードバックが保存されました！")
@@ -93,6 +189,7 @@ def display_feedback_form():
 def display_history_page():
     """履歴閲覧ページのUIを表示する"""
     st.subheader("チャット履歴と評価指標")
+    display_answer_cache_stats()
     history_df = get_chat_history()
 
     if history_df.empty:
@@ -108,6 +205,16 @@ def display_history_page():
     with tab2:
         display_metrics_analysis(history_df)
 
+def display_answer_cache_stats():
+    """回答キャッシュのヒット率と検索結果の内訳を表示する"""
+    stats = get_answer_cache_stats()
+    rate = hit_rate(stats)
+    cols = st.columns(4)
+    cols[0].metric("回答キャッシュのヒット率", f"{rate:.1%}" if rate is not None else "-")
+    cols[1].metric("完全一致", stats.get("exact", 0))
+    cols[2].metric("類似した質問", stats.get("near", 0))
+    cols[3].metric("ミス / 再生成の指定", f"{stats.get('miss', 0)} / {stats.get('bypass', 0)}")
+
 def display_history_list(history_df):
     """履歴リストを表示する"""
     st.write("#### 履歴リスト")
@@ -159,7 +266,7 @@ def display_history_list(history_df):
             st.markdown("---")
             cols = st.columns(3)
             cols[0].metric("正確性スコア", f"{row['is_correct']:.1f}")
-            cols[1].metric("応答時間(秒)", f"{row['response_time']:.2f}")
+            cols[1].metric("応答時間(秒)", f"{row['response_time']:.2f}" if pd.notna(row['response_time']) else "-")
             cols[2].metric("単語数", f"{row['word_count']}")
 
             cols = st.columns(3)
@@ -168,6 +275,12 @@ def display_history_list(history_df):
             cols[1].metric("類似度", f"{row['similarity_score']:.4f}" if pd.notna(row['similarity_score']) else "-")
             cols[2].metric("関連性", f"{row['relevance_score']:.4f}" if pd.notna(row['relevance_score']) else "-")
 
+            # ストリーミングで計測した値（列の追加前に保存された履歴やサンプルデータは "-"）
+            cols = st.columns(3)
+            cols[0].metric("最初のトークンまで(秒)", f"{row['ttft']:.2f}" if pd.notna(row.get('ttft')) else "-")
+            cols[1].metric("生成トークン数", f"{int(row['completion_tokens'])}" if pd.notna(row.get('completion_tokens')) else "-")
+            cols[2].metric("tokens/sec", f"{row['tokens_per_sec']:.1f}" if pd.notna(row.get('tokens_per_sec')) else "-")
+
     st.caption(f"{total_items} 件中 {start_idx+1} - {min(end_idx, total_items)} 件を表示")
 
 
@@ -222,7 +335,8 @@ def display_metrics_analysis(history_df):
 
     # 全体の評価指標の統計
     st.write("##### 評価指標の統計")
-    stats_cols = ['response_time', 'bleu_score', 'similarity_score', 'word_count', 'relevance_score']
+    stats_cols = ['response_time', 'ttft', 'completion_tokens', 'tokens_per_sec',
+                  'bleu_score', 'similarity_score', 'word_count', 'relevance_score']
     valid_stats_cols = [c for c in stats_cols if c in analysis_df.columns and analysis_df[c].notna().any()]
     if valid_stats_cols:
         metrics_stats = analysis_df[valid_stats_cols].describe()
@@ -230,6 +344,18 @@ def display_metrics_analysis(history_df):
     else:
         st.info("統計情報を計算できる評価指標データがありません。")
 
+    # 最初のトークンまでの時間（プレフィル）とそれ以降（デコード）の内訳
+    st.write("##### 応答時間の内訳（最初のトークンまで / デコード）")
+    if 'ttft' in analysis_df.columns and analysis_df['ttft'].notna().any():
+        timing_df = analysis_df.dropna(subset=['ttft', 'response_time'])
+        timing_df = pd.DataFrame({
+            '最初のトークンまで': timing_df['ttft'],
+            'デコード': timing_df['response_time'] - timing_df['ttft'],
+        }, index=timing_df['id'] if 'id' in timing_df.columns else timing_df.index)
+        st.bar_chart(timing_df)
+    else:
+        st.info("ストリーミングで計測した応答時間の内訳データがありません。")
+
     # 正確性レベル別の平均スコア
     st.write("##### 正確性レベル別の平均スコア")
     if valid_stats_cols and '正確性' in analysis_df.columns:
@@ -246,11 +372,12 @@ def display_metrics_analysis(history_df):
     st.write("##### 効率性スコア (正確性 / (応答時間 + 0.1))")
     if 'response_time' in analysis_df.columns and analysis_df['response_time'].notna().any():
         # ゼロ除算を避けるために0.1を追加
-        analysis_df['efficiency_score'] = analysis_df['is_correct'] / (analysis_df['response_time'].fillna(0) + 0.1)
+        # 応答時間のない行（回答キャッシュで再利用した回答）は除く
+        analysis_df['efficiency_score'] = analysis_df['is_correct'] / (analysis_df['response_time'] + 0.1)
         # IDカラムが存在するか確認
         if 'id' in analysis_df.columns:
             # 上位10件を表示
-            top_efficiency = analysis_df.sort_values('efficiency_score', ascending=False).head(10)
+            top_efficiency = analysis_df.dropna(subset=['efficiency_score']).sort_values('efficiency_score', ascending=False).head(10)
             # id をインデックスにする前に存在確認
             if not top_efficiency.empty:
                 st.bar_chart(top_efficiency.set_index('id')['efficiency_score'])
@@ -258,7 +385,7 @@ def display_metrics_analysis(history_df):
                 st.info("効率性スコアデータがありません。")
         else:
             # IDがない場合は単純にスコアを表示
-             st.bar_chart(analysis_df.sort_values('efficiency_score', ascending=False).head(10)['efficiency_score'])
+             st.bar_chart(analysis_df.dropna(subset=['efficiency_score']).sort_values('efficiency_score', ascending=False).head(10)['efficiency_score'])
 
     else:
         st.info("効率性スコアを計算するための応答時間データがありません。")
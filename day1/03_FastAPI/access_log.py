@@ -0,0 +1,129 @@
+# access_log.py
+# リクエストごとの構造化アクセスログ（JSONL）。ファイルへの書き込みはバックグラウンドのスレッドで行い、リクエストの処理をブロックしない
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+import uuid
+
+# クライアントが受け取るリクエストID（クライアントが指定した場合はその値を使う）
+REQUEST_ID_HEADER = "X-Request-ID"
+
+
+def new_request_id():
+    return uuid.uuid4().hex
+
+
+class _JsonLineFormatter(logging.Formatter):
+    """LogRecordのaccess属性（辞書）を1行のJSONにする"""
+
+    def format(self, record):
+        return json.dumps(record.access, ensure_ascii=False, default=str)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """キューが満杯のときはレコードを捨てて件数だけを数える（書き込みが追いつかなくてもリクエストを待たせない）"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # JSONへの変換は書き込みスレッドのフォーマッタで行う
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class AccessLogger:
+    """1リクエスト1行のJSONLでアクセスログを書く
+
+    log() はキューにレコードを入れるだけで、JSONへの変換と書き込みは QueueListener のスレッドで行います。
+    プロンプトと応答の本文は body_sample_rate の割合のリクエストだけ、max_body_chars 文字までを記録します。
+    path が空の場合は何も記録しません。"-" の場合は標準出力に書きます。
+    """
+
+    def __init__(self, path, body_sample_rate=0.0, max_body_chars=2000, queue_size=10000):
+        self.path = path
+        self.body_sample_rate = body_sample_rate
+        self.max_body_chars = max_body_chars
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._queue_handler = _DroppingQueueHandler(self._queue)
+        self._logger = logging.getLogger("llm_api.access")
+        self._logger.setLevel(logging.INFO)
+        self._logger.propagate = False  # ルートロガーの出力（標準出力など）には流さない
+        self._handler = None
+        self._listener = None
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def start(self):
+        if not self.enabled or self._listener is not None:
+            return
+        if self.path == "-":
+            self._handler = logging.StreamHandler(sys.stdout)
+        else:
+            self._handler = logging.FileHandler(self.path, encoding="utf-8")
+        self._handler.setFormatter(_JsonLineFormatter())
+        self._listener = logging.handlers.QueueListener(self._queue, self._handler)
+        self._listener.start()
+        self._logger.addHandler(self._queue_handler)
+
+    def stop(self):
+        """キューに残ったレコードを書き出してから停止する"""
+        if self._listener is None:
+            return
+        self._logger.removeHandler(self._queue_handler)
+        self._listener.stop()
+        self._handler.close()
+        self._listener = self._handler = None
+
+    def sample_body(self):
+        """このリクエストのプロンプトと応答の本文を記録するかを決める"""
+        return self.body_sample_rate > 0 and random.random() < self.body_sample_rate
+
+    def _truncate(self, text):
+        if len(text) <= self.max_body_chars:
+            return text
+        return text[:self.max_body_chars]
+
+    def body_fields(self, sampled, **bodies):
+        """本文の文字数と、サンプリングされた場合は切り詰めた本文を返す
+
+        例: body_fields(sampled, prompt="...", response="...")
+        -> {"prompt_chars": 3, "response_chars": 3, "prompt": "...", "response": "..."}
+        """
+        fields = {}
+        for name, text in bodies.items():
+            if text is None:
+                continue
+            fields[f"{name}_chars"] = len(text)
+            if sampled:
+                fields[name] = self._truncate(text)
+                if len(text) > self.max_body_chars:
+                    fields[f"{name}_truncated"] = True
+        return fields
+
+    def log(self, fields):
+        """1件のレコードをキューに入れる（ファイルへの書き込みは待たない）"""
+        if self._listener is None:
+            return
+        self._logger.info("", extra={"access": {"ts": time.time(), **fields}})
+
+    def snapshot(self):
+        return {
+            "path": self.path or None,
+            "body_sample_rate": self.body_sample_rate,
+            "max_body_chars": self.max_body_chars,
+            "queued": self._queue.qsize(),
+            "dropped": self._queue_handler.dropped,
+        }
@@ -0,0 +1,106 @@
+# admission.py
+# 推論キューに受け付けるリクエスト数を制限し、満杯の場合は早期に拒否するためのアドミッション制御
+import math
+from contextlib import contextmanager
+
+
+class ServerBusyError(Exception):
+    """推論キューが満杯でリクエストを受け付けられない場合の例外"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"推論キューが満杯です。{retry_after}秒後に再試行してください。")
+        self.retry_after = retry_after
+
+
+class DeadlineUnreachableError(Exception):
+    """推定待ち時間がリクエストの締め切りを超えていて、時間内に応答できない場合の例外"""
+
+    def __init__(self, estimated_wait, budget):
+        super().__init__(
+            f"推定待ち時間 {estimated_wait:.2f}秒 がリクエストの締め切り {budget:.2f}秒 を超えているため受け付けられません。"
+        )
+        self.estimated_wait = estimated_wait
+        self.budget = budget
+
+
+class AdmissionSlot:
+    """acquireで確保した枠。release()は何度呼び出しても1回だけ解放する"""
+
+    def __init__(self, controller, n):
+        self.controller = controller
+        self.n = n
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller.release(self.n)
+
+
+class AdmissionController:
+    """推論待ち・推論中のリクエスト数を上限内に保つ
+
+    イベントループのスレッドからのみ呼び出される前提のため、ロックは使用しません。
+    """
+
+    def __init__(self, max_pending, estimate_wait=None, min_retry_after=1):
+        self.max_pending = max_pending
+        self.estimate_wait = estimate_wait  # 新しいリクエストの推論が始まるまでの推定秒数を返す関数
+        self.min_retry_after = min_retry_after
+        self.pending = 0
+        self.admitted_total = 0
+        self.rejected_total = 0
+        self.deadline_rejected_total = 0
+
+    def retry_after(self):
+        """クライアントに返すRetry-Afterの秒数を計算する"""
+        wait = self.estimate_wait() if self.estimate_wait else 0.0
+        return max(self.min_retry_after, math.ceil(wait))
+
+    def acquire(self, n=1):
+        """n件分の枠を確保する。空きがなければServerBusyErrorを送出する"""
+        if self.pending + n > self.max_pending:
+            self.rejected_total += n
+            raise ServerBusyError(self.retry_after())
+        self.pending += n
+        self.admitted_total += n
+
+    def check_deadline(self, budget):
+        """推定待ち時間（キューで待つ時間。生成時間は含まない）が締め切りまでの時間(秒)を超えていればDeadlineUnreachableErrorを送出する
+
+        受け付けたリクエストは締め切りで生成を打ち切って途中までの応答を返すため、生成時間は判定に含めません。
+        """
+        if budget is None or self.estimate_wait is None:
+            return
+        wait = self.estimate_wait()
+        if wait >= budget:
+            self.deadline_rejected_total += 1
+            raise DeadlineUnreachableError(wait, budget)
+
+    def release(self, n=1):
+        """acquireで確保した枠を解放する"""
+        self.pending -= n
+
+    def slot(self, n=1):
+        """n件分の枠を確保し、解放の経路が複数ある場合（ストリーミングなど）に使うAdmissionSlotを返す"""
+        self.acquire(n)
+        return AdmissionSlot(self, n)
+
+    @contextmanager
+    def admit(self, n=1):
+        """with文の間だけn件分の枠を確保する"""
+        self.acquire(n)
+        try:
+            yield
+        finally:
+            self.release(n)
+
+    def snapshot(self):
+        """統計を辞書形式で返す"""
+        return {
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "admitted_total": self.admitted_total,
+            "rejected_total": self.rejected_total,
+            "deadline_rejected_total": self.deadline_rejected_total,
+        }
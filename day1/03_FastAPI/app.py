@@ -1,15 +1,34 @@
+from coldstart import StartupTimer, find_snapshot
+startup_timer = StartupTimer()  # 起動時間の計測はモジュールの読み込み開始から行う
+
 import os
-import torch
-from transformers import pipeline
+import asyncio
 import time
 import traceback
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, Response, JSONResponse
 from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
-import uvicorn
-import nest_asyncio
-from pyngrok import ngrok
+from typing import Optional, List, Dict, Any, Union, NamedTuple
+# torch / transformers / uvicorn / pyngrok は使用する関数の中で読み込む（/health だけを使う場合やテストで起動を速くするため）
+from batching import BatchScheduler
+from admission import AdmissionController, ServerBusyError, DeadlineUnreachableError
+from streaming import stream_generation, sse_event, PhaseTimer
+from response_cache import ResponseCache
+from prefix_cache import PrefixCache
+from metrics import MetricsRegistry
+from model_registry import ModelRegistry
+from model_loader import FAILED, NOT_LOADED, ModelLoader
+from assisted import AssistedStats, count_forward_passes
+from chat_sessions import ChatSessionStore, SessionBusyError
+from seeding import RandomStateLock
+from access_log import AccessLogger, REQUEST_ID_HEADER, new_request_id
+from cancellation import (
+    CancellationToken, CancellationCriteria, CancellationRegistry, CLIENT_DISCONNECTED, DEADLINE_EXCEEDED,
+)
 
 # --- 設定 ---
 # モデル名を設定
@@ -20,6 +39,59 @@ print(f"モデル名を設定: {MODEL_NAME}")
 class Config:
     def __init__(self, model_name=MODEL_NAME):
         self.MODEL_NAME = model_name
+        # リクエストの model フィールドで指定できるモデル（カンマ区切り）。先頭は常にデフォルトモデル
+        extra_models = [name.strip() for name in os.environ.get("AVAILABLE_MODELS", "").split(",") if name.strip()]
+        self.AVAILABLE_MODELS = [model_name] + [name for name in extra_models if name != model_name]
+        self.MODEL_MEMORY_BUDGET_MB = float(os.environ.get("MODEL_MEMORY_BUDGET_MB", "0"))  # 常駐させるモデルの合計サイズ上限(MB)。0なら無制限
+        # マイクロバッチングの設定（環境変数で上書き可能）
+        self.BATCH_WINDOW_MS = float(os.environ.get("BATCH_WINDOW_MS", "10"))  # リクエストを集める時間窓(ミリ秒)
+        self.MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "8"))  # 1回の推論にまとめる最大リクエスト数
+        # 推論キューの設定
+        self.INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", "1"))  # 推論専用スレッド数（/generate のバッチもこの数まで同時に実行する）
+        self.MAX_QUEUE_SIZE = int(os.environ.get("MAX_QUEUE_SIZE", "64"))  # 推論待ち・推論中の最大リクエスト数
+        self.MAX_BATCH_PROMPTS = int(os.environ.get("MAX_BATCH_PROMPTS", "64"))  # /generate/batch の1リクエストあたりの最大プロンプト数
+        # 応答キャッシュの設定（CACHE_MAX_BYTES=0で無効化）
+        self.CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # メモリ上のキャッシュ容量(バイト)
+        self.CACHE_TTL_SECONDS = float(os.environ.get("CACHE_TTL_SECONDS", "0"))  # 有効期限(秒)。0なら無期限
+        self.CACHE_DIR = os.environ.get("CACHE_DIR", "")  # 再起動後も残すディスクキャッシュの保存先。空ならディスクを使わない
+        # プレフィックスKVキャッシュの設定（PREFIX_CACHE_MB=0で無効）
+        self.PREFIX_CACHE_MB = float(os.environ.get("PREFIX_CACHE_MB", "0"))  # KVキャッシュを保持するメモリ容量(MB)
+        self.PREFIX_CACHE_MIN_TOKENS = int(os.environ.get("PREFIX_CACHE_MIN_TOKENS", "16"))  # 再利用する最小の一致トークン数
+        # モデル読み込みの設定
+        self.WARMUP_MAX_NEW_TOKENS = int(os.environ.get("WARMUP_MAX_NEW_TOKENS", "8"))  # ウォームアップで生成するトークン数(0で無効)
+        self.MODEL_LOADING_RETRY_AFTER = int(os.environ.get("MODEL_LOADING_RETRY_AFTER", "10"))  # 準備中に返すRetry-After(秒)
+        # coldstart.py で作成したモデルのスナップショットの保存先。あればハブのキャッシュを解決せずに読み込む
+        self.MODEL_SNAPSHOT_DIR = os.environ.get("MODEL_SNAPSHOT_DIR", "")
+        # マルチプロセス実行の設定（WORKERS>1でモデルをfork前に読み込み、ワーカー間で重みを共有する）
+        self.WORKERS = int(os.environ.get("WORKERS", "1"))
+        self.TORCH_THREADS_PER_WORKER = int(os.environ.get("TORCH_THREADS_PER_WORKER", "0"))  # 0ならCPUコア数をワーカー数で等分
+        # CPU推論時の量子化（"int8"でLinear層を動的量子化。空ならbf16のまま）
+        self.QUANTIZATION = os.environ.get("QUANTIZATION", "")
+        self.QUANTIZED_CACHE_DIR = os.environ.get("QUANTIZED_CACHE_DIR", "quantized_models")  # 量子化済みモデルの保存先
+        # 支援付き生成（speculative decoding）の設定。ドラフトモデルを指定すると有効になる
+        self.DRAFT_MODEL_NAME = os.environ.get("DRAFT_MODEL_NAME", "")  # メインモデルより小さいモデル（同じトークナイザーが望ましい）
+        self.ASSISTED_DECODING = os.environ.get("ASSISTED_DECODING", "1") == "1"  # リクエストで指定がない場合に使用するか
+        # スタブモデルの設定（STUB_MODEL=1でモデルを読み込まず、一定の遅延で決定的な応答を返す。負荷試験用）
+        self.STUB_MODEL = os.environ.get("STUB_MODEL", "0") == "1"
+        self.STUB_PREFILL_MS = float(os.environ.get("STUB_PREFILL_MS", "20"))  # プレフィルの遅延(ミリ秒)
+        self.STUB_TOKEN_MS = float(os.environ.get("STUB_TOKEN_MS", "5"))  # 1トークンあたりの遅延(ミリ秒)
+        self.STUB_MAX_TOKENS = int(os.environ.get("STUB_MAX_TOKENS", "32"))  # 生成するトークン数の上限
+        if self.STUB_MODEL:
+            # スタブはトークナイザーを持たないため、トークン列を使う機能は無効にする
+            self.PREFIX_CACHE_MB = 0
+            self.DRAFT_MODEL_NAME = ""
+        # クライアントの切断を確認する間隔(ミリ秒)。切断されたリクエストの生成はデコードのステップの間で打ち切る
+        self.DISCONNECT_POLL_MS = float(os.environ.get("DISCONNECT_POLL_MS", "500"))
+        # ?profile=trace（または X-Profile: trace）で保存するtorch profilerのトレースの出力先
+        self.PROFILE_TRACE_DIR = os.environ.get("PROFILE_TRACE_DIR", "profiles")
+        # 構造化アクセスログ（JSONL）の設定。ACCESS_LOG_PATH を空にすると無効、"-" なら標準出力
+        self.ACCESS_LOG_PATH = os.environ.get("ACCESS_LOG_PATH", "-")
+        self.ACCESS_LOG_BODY_SAMPLE_RATE = float(os.environ.get("ACCESS_LOG_BODY_SAMPLE_RATE", "0.01"))  # 本文を記録するリクエストの割合
+        self.ACCESS_LOG_MAX_BODY_CHARS = int(os.environ.get("ACCESS_LOG_MAX_BODY_CHARS", "2000"))  # 記録する本文の最大文字数
+        # /chat のセッションの設定
+        self.CHAT_SESSION_TTL_SECONDS = float(os.environ.get("CHAT_SESSION_TTL_SECONDS", "600"))  # この時間使われないセッションを破棄
+        self.CHAT_MAX_SESSIONS = int(os.environ.get("CHAT_MAX_SESSIONS", "256"))  # 保持する最大セッション数
+        self.CHAT_SESSION_KV = os.environ.get("CHAT_SESSION_KV", "1") == "1"  # セッションごとにKVキャッシュを保持するか
 
 config = Config(MODEL_NAME)
 
@@ -39,6 +111,151 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# --- メトリクス定義 ---
+# /metrics でPrometheusのテキスト形式として公開する
+metrics_registry = MetricsRegistry()
+http_requests_counter = metrics_registry.counter(
+    "llm_http_requests_total", "HTTPリクエスト数（エンドポイント・ステータスコード別）", ["path", "status"]
+)
+http_latency_histogram = metrics_registry.histogram(
+    "llm_http_request_duration_seconds", "HTTPリクエストの処理時間（レスポンスヘッダー送信まで）", ["path"]
+)
+phase_latency_histogram = metrics_registry.histogram(
+    "llm_generation_phase_seconds",
+    "生成のフェーズ別所要時間 (queue_wait, tokenization, prefill, decode, extraction)",
+    ["phase"],
+)
+generated_tokens_counter = metrics_registry.counter("llm_generated_tokens_total", "生成したトークン数の合計")
+prompt_tokens_counter = metrics_registry.counter("llm_prompt_tokens_total", "入力プロンプトのトークン数の合計")
+tokens_per_second_histogram = metrics_registry.histogram(
+    "llm_generation_tokens_per_second",
+    "1回の推論あたりの生成速度 (tokens/sec)",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+inflight_gauge = metrics_registry.gauge("llm_inflight_requests", "推論待ち・推論中のリクエスト数")
+queue_depth_gauge = metrics_registry.gauge("llm_batch_queue_depth", "バッチングキューで待機中のリクエスト数")
+model_load_gauge = metrics_registry.gauge("llm_model_load_duration_seconds", "直近のモデル読み込みにかかった時間", ["model"])
+model_ready_gauge = metrics_registry.gauge("llm_model_ready", "モデルがリクエストを受け付けられる状態なら1", ["model"])
+model_resident_bytes_gauge = metrics_registry.gauge("llm_model_resident_bytes", "常駐しているモデルのメモリ使用量", ["model"])
+model_events_counter = metrics_registry.counter("llm_model_events_total", "モデルの読み込み・追い出し回数", ["model", "event"])
+model_latency_histogram = metrics_registry.histogram(
+    "llm_model_request_duration_seconds", "モデル別の推論リクエストの処理時間（キュー待ちを含む）", ["model"]
+)
+aborted_generations_counter = metrics_registry.counter(
+    "llm_aborted_generations_total", "取り消された生成の数（client_disconnected / server_cancelled）", ["reason"]
+)
+aborted_tokens_counter = metrics_registry.counter(
+    "llm_aborted_tokens_total", "取り消されるまでに生成して破棄したトークン数"
+)
+draft_tokens_counter = metrics_registry.counter(
+    "llm_assisted_draft_tokens_total", "支援付き生成でドラフトモデルが提案したトークン数（受理・棄却別）", ["result"]
+)
+
+def observe_generation(timer, extracted_at, n_requests=1, prompt_tokens=None, completion_tokens=None):
+    """PhaseTimerで計測したフェーズ別の時間と生成トークン数をメトリクスに記録し、プロファイル用の内訳を返す
+
+    パディングしたバッチでは、PhaseTimerのトークン数がパディングを含むため、
+    パディングを除いたトークン数の合計を prompt_tokens / completion_tokens に指定します。
+    """
+    phases = timer.phases(extracted_at)
+    for phase, seconds in phases.items():
+        for _ in range(n_requests):
+            phase_latency_histogram.observe(seconds, phase=phase)
+    if prompt_tokens is None:
+        prompt_tokens = timer.prompt_tokens
+    if completion_tokens is None:
+        completion_tokens = timer.completion_tokens
+    prompt_tokens_counter.inc(prompt_tokens)
+    generated_tokens_counter.inc(completion_tokens)
+    generation_time = phases["prefill"] + phases["decode"]
+    if completion_tokens and generation_time > 0:
+        tokens_per_second_histogram.observe(completion_tokens / generation_time)
+    return {
+        "phases": phases,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "batch_size": n_requests,
+        "started_at": timer.started_at,  # キュー待ち時間の計算用（レスポンスには含めない）
+    }
+
+def observe_aborted(token, completion_tokens=0):
+    """取り消されたリクエストの生成をメトリクスに記録する。取り消されていなければFalseを返す"""
+    if not token.cancelled:
+        return False
+    aborted_generations_counter.inc(reason=token.reason)
+    aborted_tokens_counter.inc(completion_tokens)
+    return True
+
+def observe_queue_waits(params, queue_waits):
+    """バッチ実行直前に各リクエストのキュー待ち時間を記録する"""
+    for wait in queue_waits:
+        phase_latency_histogram.observe(wait, phase="queue_wait")
+
+# リクエストごとの構造化アクセスログ（起動時に書き込みスレッドを開始）
+access_log = AccessLogger(
+    config.ACCESS_LOG_PATH,
+    body_sample_rate=config.ACCESS_LOG_BODY_SAMPLE_RATE,
+    max_body_chars=config.ACCESS_LOG_MAX_BODY_CHARS,
+)
+
+def annotate(http_request, **fields):
+    """アクセスログのレコードにエンドポイント固有の項目を追加する"""
+    http_request.state.access.update(fields)
+
+def write_access_log(request, status):
+    """1件のリクエストのアクセスログを書く（書き込みはバックグラウンドで行う）"""
+    route = request.scope.get("route")
+    access_log.log({
+        "request_id": request.state.request_id,
+        "method": request.method,
+        "path": route.path if route is not None else request.url.path,
+        "status": status,
+        "duration_ms": (time.perf_counter() - request.state.started_at) * 1000,
+        "client": request.client.host if request.client else None,
+        **request.state.access,
+    })
+
+@app.middleware("http")
+async def log_access(request: Request, call_next):
+    """リクエストIDを割り当ててレスポンスヘッダーで返し、リクエストごとにアクセスログを1行書く
+
+    ストリーミングのように本文の送信が終わってから書く場合は、ハンドラで request.state.access_deferred を設定します。
+    """
+    if request.url.path == "/metrics":
+        return await call_next(request)
+    request.state.request_id = request.headers.get(REQUEST_ID_HEADER) or new_request_id()
+    request.state.started_at = time.perf_counter()
+    request.state.access = {}
+    request.state.sample_body = access_log.sample_body()
+    request.state.access_deferred = False
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers[REQUEST_ID_HEADER] = request.state.request_id
+        return response
+    finally:
+        if not request.state.access_deferred or status != 200:
+            write_access_log(request, status)
+
+@app.middleware("http")
+async def record_http_metrics(request: Request, call_next):
+    """エンドポイント・ステータス別のリクエスト数と処理時間を記録する"""
+    if request.url.path == "/metrics":
+        return await call_next(request)
+    start_time = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # パスパラメータで系列が増えないよう、ルートのテンプレートをラベルに使う
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        http_requests_counter.inc(path=path, status=str(status))
+        http_latency_histogram.observe(time.perf_counter() - start_time, path=path)
+
 # --- データモデル定義 ---
 class Message(BaseModel):
     role: str
@@ -46,37 +263,149 @@ class Message(BaseModel):
 
 # 直接プロンプトを使用した簡略化されたリクエスト
 class SimpleGenerationRequest(BaseModel):
-    prompt: str
+    prompt: Optional[str] = None
+    # promptの代わりに指定すると、モデルのチャットテンプレートを適用したプロンプトで生成する（promptとはどちらか一方）
+    messages: Optional[List[Message]] = None
+    model: Optional[str] = None  # 使用するモデル名（省略時はデフォルトモデル）
     max_new_tokens: Optional[int] = 512
     do_sample: Optional[bool] = True
     temperature: Optional[float] = 0.7
     top_p: Optional[float] = 0.9
+    seed: Optional[int] = None  # サンプリング時に指定すると結果が再現可能になり、キャッシュ対象になる
+    assisted: Optional[bool] = None  # ドラフトモデルによる支援付き生成を使うか（省略時はサーバーの設定に従う）
+    # 応答までの時間の上限。超えた時点で生成を打ち切り、途中までのテキストを返す（両方指定した場合は短い方）
+    deadline_ms: Optional[float] = None
+    max_time: Optional[float] = None  # 秒単位（transformersのgenerate()と同じ名前）
 
 class GenerationResponse(BaseModel):
     generated_text: str
     response_time: float
+    cached: bool = False
+    # 生成の終了理由: length（max_new_tokensに到達）/ stop（EOSで終了）/ deadline（締め切りで打ち切り）/ cancelled
+    # キャッシュから返した場合はNone
+    finish_reason: Optional[str] = None
+    # ?profile=1 または X-Profile ヘッダーを指定した場合のみ、フェーズ別の時間とトークン数を返す
+    profile: Optional[Dict[str, Any]] = None
+
+# セッションを使ったチャットのリクエスト（messagesにはこのターンで追加するメッセージのみを指定する）
+class ChatRequest(BaseModel):
+    messages: List[Message]
+    session_id: Optional[str] = None  # 省略時は新しいセッションを作成する
+    model: Optional[str] = None
+    max_new_tokens: Optional[int] = 512
+    do_sample: Optional[bool] = True
+    temperature: Optional[float] = 0.7
+    top_p: Optional[float] = 0.9
+
+class ChatResponse(BaseModel):
+    session_id: str
+    generated_text: str
+    response_time: float
+    prompt_tokens: int
+    reused_tokens: int  # 前のターンのKVキャッシュを再利用したトークン数
+    completion_tokens: int
+    turns: int
+
+# 複数プロンプトをまとめて処理するリクエスト（項目ごとの指定がなければ共通パラメータを使用）
+class BatchGenerationItem(BaseModel):
+    prompt: str
+    max_new_tokens: Optional[int] = None
+    do_sample: Optional[bool] = None
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    seed: Optional[int] = None
+
+class BatchGenerationRequest(BaseModel):
+    prompts: List[Union[str, BatchGenerationItem]]
+    model: Optional[str] = None
+    max_new_tokens: Optional[int] = 512
+    do_sample: Optional[bool] = True
+    temperature: Optional[float] = 0.7
+    top_p: Optional[float] = 0.9
+    seed: Optional[int] = None
+    assisted: Optional[bool] = None
+
+class BatchGenerationResult(BaseModel):
+    index: int
+    generated_text: str
+    response_time: float
+    cached: bool = False
+    finish_reason: Optional[str] = None
+
+class BatchGenerationResponse(BaseModel):
+    results: List[BatchGenerationResult]
+    response_time: float
 
 # --- モデル関連の関数 ---
-# モデルのグローバル変数
-model = None
+# fork前に親プロセスで読み込んだモデル（各ワーカーの最初の読み込みで使用する）
+preloaded_models = {}
+
+def preload_models():
+    """マルチプロセス実行時に、fork前にデフォルトモデルを読み込んでおく（CPUのみ）"""
+    if config.STUB_MODEL:
+        return
+    import torch
+    if torch.cuda.is_available():
+        # CUDAのコンテキストはforkした子プロセスでは使えないため、各ワーカーで読み込む
+        print("GPUが利用可能なため、モデルは各ワーカーで個別に読み込みます")
+        return
+    pipe = load_model(config.MODEL_NAME)
+    if pipe is not None:
+        preloaded_models[config.MODEL_NAME] = pipe
+
+def load_model(model_name=None):
+    """推論用のLLMモデルを読み込む
 
-def load_model():
-    """推論用のLLMモデルを読み込む"""
-    global model  # グローバル変数を更新するために必要
+    スナップショットがあればローカルのファイルのみから読み込み、safetensorsの重みはメモリマップで読み込みます。
+    各フェーズの所要時間は起動時間のレポート (/startup) に記録します。
+    """
+    model_name = model_name or config.MODEL_NAME
+    if model_name in preloaded_models:
+        # 親プロセスで読み込んだ重みをそのまま使う（ページはコピーオンライトで共有される）
+        return preloaded_models.pop(model_name)
+    if config.STUB_MODEL:
+        from stub_model import StubPipeline
+        print(f"スタブモデルを使用します (prefill={config.STUB_PREFILL_MS}ms, token={config.STUB_TOKEN_MS}ms)")
+        return StubPipeline(config.STUB_PREFILL_MS, config.STUB_TOKEN_MS, config.STUB_MAX_TOKENS)
     try:
+        load_start = time.perf_counter()
+        with startup_timer.phase(f"{model_name}: import torch/transformers"):
+            import torch
+            from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
         device = "cuda" if torch.cuda.is_available() else "cpu"
         print(f"使用デバイス: {device}")
-        pipe = pipeline(
-            "text-generation",
-            model=config.MODEL_NAME,
-            model_kwargs={"torch_dtype": torch.bfloat16},
-            device=device
-        )
-        print(f"モデル '{config.MODEL_NAME}' の読み込みに成功しました")
-        model = pipe  # グローバル変数を更新
+
+        snapshot = find_snapshot(config.MODEL_SNAPSHOT_DIR, model_name)
+        source = snapshot or model_name
+        # スナップショットはsafetensorsで保存済みのため、ハブへの問い合わせを行わない
+        load_kwargs = {"local_files_only": True, "use_safetensors": True} if snapshot else {}
+        print(f"モデルの読み込み元: {source}")
+        with startup_timer.phase(f"{model_name}: tokenizer/config"):
+            tokenizer = AutoTokenizer.from_pretrained(source, **load_kwargs)
+        with startup_timer.phase(f"{model_name}: weights"):
+            if config.QUANTIZATION and device == "cpu":
+                from quantization import load_quantized_model
+                llm = load_quantized_model(
+                    model_name, config.QUANTIZATION, config.QUANTIZED_CACHE_DIR, source=source, **load_kwargs
+                )
+            else:
+                # low_cpu_mem_usage=Trueで、重みを一時的な初期化済みテンソルにコピーせず直接読み込む
+                llm = AutoModelForCausalLM.from_pretrained(
+                    source, torch_dtype=torch.bfloat16, low_cpu_mem_usage=True, **load_kwargs
+                )
+        with startup_timer.phase(f"{model_name}: to {device}"):
+            llm.to(device)
+            llm.eval()
+            pipe = pipeline("text-generation", model=llm, tokenizer=tokenizer, device=device)
+        model_load_gauge.set(time.perf_counter() - load_start, model=model_name)
+        # バッチ推論でパディングできるように設定（デコーダのみのモデルは左詰めパディング）
+        if pipe.tokenizer.pad_token is None:
+            pipe.tokenizer.pad_token = pipe.tokenizer.eos_token
+        pipe.tokenizer.padding_side = "left"
+        print(f"モデル '{model_name}' の読み込みに成功しました")
         return pipe
     except Exception as e:
-        error_msg = f"モデル '{config.MODEL_NAME}' の読み込みに失敗: {e}"
+        error_msg = f"モデル '{model_name}' の読み込みに失敗: {e}"
         print(error_msg)
         traceback.print_exc()  # 詳細なエラー情報を出力
         return None
@@ -130,15 +459,584 @@ def extract_assistant_response(outputs, user_prompt):
 
     return assistant_response
 
+# バッチにまとめられる生成パラメータの組（バッチングのグループ分けとキャッシュキーに使用）
+class GenerationParams(NamedTuple):
+    model_name: str
+    max_new_tokens: int
+    do_sample: bool
+    temperature: float
+    top_p: float
+    seed: Optional[int] = None
+    assisted: bool = False  # ドラフトモデルで候補を提案し、メインモデルでまとめて検証する
+
+# 共通プレフィックスのKVキャッシュ（モデルごとに保持し、推論スレッドから使用）
+prefix_caches = {
+    name: PrefixCache(int(config.PREFIX_CACHE_MB * 1024 * 1024), min_tokens=config.PREFIX_CACHE_MIN_TOKENS)
+    for name in config.AVAILABLE_MODELS
+}
+
+def tokenize_prompt(pipe, prompt):
+    """パイプラインと同じ方法でプロンプトをトークン化する"""
+    return pipe.tokenizer(prompt, return_tensors="pt").to(pipe.model.device)
+
+# 推論の結果（バッチングスケジューラからリクエストごとに返す）
+class GenerationResult(NamedTuple):
+    text: str
+    finish_reason: str
+    profile: Optional[Dict[str, Any]] = None  # observe_generation() が返すフェーズ別の内訳
+
+def finish_reason_for(token, completion_tokens, max_new_tokens):
+    """生成の終了理由を返す。生成が終わった直後に呼び出す"""
+    if token.cancelled:
+        return "deadline" if token.reason == DEADLINE_EXCEEDED else "cancelled"
+    if completion_tokens is not None and completion_tokens >= max_new_tokens:
+        return "length"
+    return "stop"
+
+def set_global_seed(seed):
+    """transformersの乱数のシードを設定する（スタブモデルは乱数を使わないため何もしない）"""
+    if config.STUB_MODEL:
+        return
+    from transformers import set_seed
+    set_seed(seed)
+
+# シード指定の生成の結果を推論スレッドが複数あっても再現できるよう、乱数を使う生成を排他制御する
+random_state = RandomStateLock(set_global_seed)
+
+def with_cancellation(generate_kwargs, tokens):
+    """取り消されたリクエストの生成をステップの間で止めるstopping_criteriaを加えた引数を返す"""
+    return dict(generate_kwargs, stopping_criteria=[CancellationCriteria(tokens)])
+
+def run_single_generation(pipe, prefix_cache, prompt, generate_kwargs, token):
+    """1件のプロンプトを推論する。プレフィックスキャッシュが有効ならKVを再利用する"""
+    timer = PhaseTimer()
+    generate_kwargs = with_cancellation(generate_kwargs, [token])
+    if not prefix_cache.enabled:
+        outputs = pipe(prompt, streamer=timer, **generate_kwargs)
+        finish_reason = finish_reason_for(token, timer.completion_tokens, generate_kwargs["max_new_tokens"])
+        assistant_response = extract_assistant_response(outputs, prompt)
+        profile = observe_generation(timer, time.perf_counter())
+        observe_aborted(token, timer.completion_tokens)
+        return GenerationResult(assistant_response, finish_reason, profile)
+
+    inputs = tokenize_prompt(pipe, prompt)
+    input_ids = inputs["input_ids"][0].tolist()
+    past_key_values, _ = prefix_cache.checkout(input_ids)
+    output_ids = pipe.model.generate(**inputs, past_key_values=past_key_values, streamer=timer, **generate_kwargs)
+    finish_reason = finish_reason_for(token, timer.completion_tokens, generate_kwargs["max_new_tokens"])
+    prefix_cache.commit(input_ids, past_key_values)
+    # 出力はプロンプトに続けて生成されるため、トークン位置で切り出す
+    assistant_response = pipe.tokenizer.decode(output_ids[0, len(input_ids):], skip_special_tokens=True).strip()
+    profile = observe_generation(timer, time.perf_counter())
+    observe_aborted(token, timer.completion_tokens)
+    return GenerationResult(assistant_response or "応答を生成できませんでした。", finish_reason, profile)
+
+# 支援付き生成の受理率の集計
+assisted_stats = AssistedStats()
+# ドラフトモデルとメインモデルの語彙が一致するか（モデル名ごとに1回だけ確認する）
+draft_vocab_matches = {}
+
+def assistant_kwargs(pipe, model_name, draft_pipe):
+    """generate()に渡すドラフトモデルの引数を返す。語彙が異なる場合は両方のトークナイザーを渡す"""
+    if model_name not in draft_vocab_matches:
+        draft_vocab_matches[model_name] = draft_pipe.tokenizer.get_vocab() == pipe.tokenizer.get_vocab()
+    kwargs = {"assistant_model": draft_pipe.model}
+    if not draft_vocab_matches[model_name]:
+        kwargs.update(tokenizer=pipe.tokenizer, assistant_tokenizer=draft_pipe.tokenizer)
+    return kwargs
+
+def run_assisted_generation(pipe, model_name, draft_pipe, prompt, generate_kwargs, token):
+    """ドラフトモデルによる支援付き生成で1件のプロンプトを推論し、受理率を記録する
+
+    メインモデルが候補を検証するため、貪欲法では通常のデコードと同じ出力になります。
+    """
+    timer = PhaseTimer()
+    inputs = tokenize_prompt(pipe, prompt)
+    prompt_length = inputs["input_ids"].shape[1]
+    with count_forward_passes(pipe.model) as target_passes, count_forward_passes(draft_pipe.model) as draft_passes:
+        output_ids = pipe.model.generate(
+            **inputs,
+            streamer=timer,
+            **assistant_kwargs(pipe, model_name, draft_pipe),
+            **with_cancellation(generate_kwargs, [token]),
+        )
+    generated_tokens = output_ids.shape[1] - prompt_length
+    finish_reason = finish_reason_for(token, generated_tokens, generate_kwargs["max_new_tokens"])
+    accepted = assisted_stats.record(generated_tokens, target_passes["calls"], draft_passes["calls"])
+    draft_tokens_counter.inc(accepted, result="accepted")
+    draft_tokens_counter.inc(draft_passes["calls"] - accepted, result="rejected")
+    assistant_response = pipe.tokenizer.decode(output_ids[0, prompt_length:], skip_special_tokens=True).strip()
+    profile = observe_generation(timer, time.perf_counter())
+    observe_aborted(token, generated_tokens)
+    return GenerationResult(assistant_response or "応答を生成できませんでした。", finish_reason, profile)
+
+def row_completion_tokens(timer, row, batch_size):
+    """バッチ内の1行の生成トークン数を返す
+
+    ストリーマー（PhaseTimer）が行ごとに数えた、パディングを除く生成トークンの数です。
+    トークナイザーのないスタブモデルは全ての行が同じステップ数を生成するため、ステップ数を返します。
+    """
+    if timer.row_completion_tokens is None:
+        return timer.completion_tokens // batch_size
+    return timer.row_completion_tokens[row]
+
+def run_generation_batch(params, payloads):
+    """同じ生成パラメータを持つプロンプトをまとめて1回のパイプライン呼び出しで推論する
+
+    payloads は (プロンプト, CancellationToken) の組のリストで、結果はGenerationResultのリストです。
+    キューで待つ間に取り消された・締め切りを過ぎたものは推論せず、空のテキストを返します。
+    """
+    prompts = [prompt for prompt, _ in payloads]
+    tokens = [token for _, token in payloads]
+    results = [None] * len(prompts)
+    active_indexes = []
+    for index, token in enumerate(tokens):
+        if token.cancelled:
+            results[index] = GenerationResult("", finish_reason_for(token, 0, params.max_new_tokens))
+            observe_aborted(token)
+        else:
+            active_indexes.append(index)
+    pipe = model_registry.get(params.model_name)
+    prefix_cache = prefix_caches[params.model_name]
+    generate_kwargs = {
+        "max_new_tokens": params.max_new_tokens,
+        "do_sample": params.do_sample,
+        "temperature": params.temperature,
+        "top_p": params.top_p,
+    }
+
+    draft_pipe = draft_loader.model if params.assisted else None
+    if params.assisted and draft_pipe is None:
+        print("ドラフトモデルの準備ができていないため、通常のデコードで推論します")
+
+    # 1件ずつ推論するプロンプトと、パディングしてまとめて推論するプロンプトに分ける
+    if params.seed is not None or draft_pipe is not None:
+        # 支援付き生成はバッチサイズ1のみ対応のため1件ずつ推論する
+        # シード指定のリクエストも結果を再現できるよう1件ずつ推論する
+        single_indexes, batch_indexes = active_indexes, []
+    elif prefix_cache.enabled and len(active_indexes) > 1:
+        # プレフィックスキャッシュにヒットするものは1件ずつ推論してKVを再利用する
+        # ヒットしないもののうち互いに共通プレフィックスを持つものは、最初の1件を先に1件ずつ推論してKVを登録し
+        # （パディングしたバッチの推論ではKVを登録できないため）、残りはそのKVを再利用する
+        hit_indexes, miss_indexes, miss_input_ids = [], [], []
+        for index in active_indexes:
+            input_ids = tokenize_prompt(pipe, prompts[index])["input_ids"][0].tolist()
+            if prefix_cache.match_length(input_ids):
+                hit_indexes.append(index)
+            else:
+                miss_indexes.append(index)
+                miss_input_ids.append(input_ids)
+        leaders, followers, others = prefix_cache.plan_warmup(miss_input_ids)
+        single_indexes = [miss_indexes[i] for i in leaders] + sorted(hit_indexes + [miss_indexes[i] for i in followers])
+        batch_indexes = [miss_indexes[i] for i in others]
+        if len(batch_indexes) == 1:
+            single_indexes, batch_indexes = single_indexes + batch_indexes, []
+    elif len(active_indexes) == 1:
+        single_indexes, batch_indexes = active_indexes, []
+    else:
+        single_indexes, batch_indexes = [], active_indexes
+
+    for index in single_indexes:
+        with random_state.guard(params.do_sample, params.seed):
+            if draft_pipe is not None:
+                results[index] = run_assisted_generation(
+                    pipe, params.model_name, draft_pipe, prompts[index], generate_kwargs, tokens[index]
+                )
+            else:
+                results[index] = run_single_generation(pipe, prefix_cache, prompts[index], generate_kwargs, tokens[index])
+
+    if batch_indexes:
+        batch_prompts = [prompts[index] for index in batch_indexes]
+        timer = PhaseTimer(pad_token_id=pipe.tokenizer.pad_token_id if pipe.tokenizer is not None else None)
+        # 取り消されたリクエストの行だけ生成を終了し、他の行の生成は続ける
+        batch_kwargs = with_cancellation(generate_kwargs, [tokens[index] for index in batch_indexes])
+        with random_state.guard(params.do_sample):
+            outputs = pipe(batch_prompts, batch_size=len(batch_prompts), streamer=timer, **batch_kwargs)
+        # リスト入力の場合、出力はプロンプトごとのリストになる
+        rows = []
+        for row, (index, output) in enumerate(zip(batch_indexes, outputs)):
+            assistant_response = extract_assistant_response(output, prompts[index])
+            # トークン数はパディングを除いた行ごとの値（トークナイザーのないスタブモデルではプロンプトのトークン数は分からない）
+            prompt_tokens = len(tokenize_prompt(pipe, prompts[index])["input_ids"][0]) if pipe.tokenizer else None
+            completion_tokens = row_completion_tokens(timer, row, len(batch_prompts))
+            finish_reason = finish_reason_for(tokens[index], completion_tokens, params.max_new_tokens)
+            rows.append((index, assistant_response, finish_reason, prompt_tokens, completion_tokens))
+            observe_aborted(tokens[index], completion_tokens)
+        batch_profile = observe_generation(
+            timer,
+            time.perf_counter(),
+            n_requests=len(batch_prompts),
+            prompt_tokens=sum(row[3] for row in rows) if pipe.tokenizer else None,
+            completion_tokens=sum(row[4] for row in rows),
+        )
+        for index, assistant_response, finish_reason, prompt_tokens, completion_tokens in rows:
+            # フェーズの時間はバッチ全体で共通
+            profile = dict(batch_profile, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+            results[index] = GenerationResult(assistant_response, finish_reason, profile)
+    return results
+
+def run_traced_generation(params, prompt, token, trace_path):
+    """1件のプロンプトをバッチにまとめずに推論し、torch profilerのトレースをChrome trace形式で保存する"""
+    import torch
+    from torch.profiler import profile, ProfilerActivity
+
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    with profile(activities=activities, record_shapes=True) as profiler:
+        result = run_generation_batch(params, [(prompt, token)])[0]
+    os.makedirs(os.path.dirname(trace_path) or ".", exist_ok=True)
+    profiler.export_chrome_trace(trace_path)
+    return result
+
+# /chat のセッション（会話のトークン列とKVキャッシュ）
+chat_sessions = ChatSessionStore(
+    idle_ttl_seconds=config.CHAT_SESSION_TTL_SECONDS,
+    max_sessions=config.CHAT_MAX_SESSIONS,
+    keep_kv=config.CHAT_SESSION_KV,
+)
+
+def run_chat_turn(pipe, session, new_messages, generate_kwargs, token):
+    """セッションの会話に新しいメッセージを加えて応答を生成する
+
+    会話の差分だけをトークン化し、前のターンのKVキャッシュがあれば一致する部分のプレフィルを省略します。
+    応答はプロンプトのトークン数の位置で出力を切り出して取得します。
+    途中で取り消された場合は会話を更新せず、Noneを返します。
+    """
+    import torch
+
+    timer = PhaseTimer()
+    timer.start()
+    messages, prompt_text, prompt_ids, incremental = session.prepare_prompt(pipe.tokenizer, new_messages)
+    input_ids = torch.tensor([prompt_ids], device=pipe.model.device)
+    kv_kwargs, reused = {}, 0
+    if chat_sessions.keep_kv:
+        past_key_values, reused = session.checkout_kv(prompt_ids)
+        kv_kwargs["past_key_values"] = past_key_values
+    with random_state.guard(generate_kwargs["do_sample"]):
+        output_ids = pipe.model.generate(
+            input_ids=input_ids, attention_mask=torch.ones_like(input_ids), streamer=timer, **kv_kwargs,
+            **with_cancellation(generate_kwargs, [token]),
+        )
+    observe_generation(timer, time.perf_counter())
+    if observe_aborted(token, output_ids.shape[1] - len(prompt_ids)):
+        # 途中までの応答は会話に残さない（KVキャッシュも途中の状態のため破棄する）
+        return None
+    reply = pipe.tokenizer.decode(output_ids[0, len(prompt_ids):], skip_special_tokens=True).strip()
+    session.commit(
+        pipe.tokenizer, messages, prompt_text, prompt_ids, reply,
+        output_ids=output_ids[0].tolist() if chat_sessions.keep_kv else None,
+        past_key_values=kv_kwargs.get("past_key_values"),
+    )
+    chat_sessions.record(len(prompt_ids), reused, incremental)
+    return {
+        "generated_text": reply,
+        "prompt_tokens": len(prompt_ids),
+        "reused_tokens": reused,
+        "completion_tokens": output_ids.shape[1] - len(prompt_ids),
+    }
+
+# 推論専用のExecutor（イベントループをブロックしないよう、推論は全てここで実行する）
+inference_executor = ThreadPoolExecutor(
+    max_workers=config.INFERENCE_WORKERS,
+    thread_name_prefix="inference",
+)
+
+# バッチングスケジューラ（起動時に開始）
+scheduler = BatchScheduler(
+    run_generation_batch,
+    window_ms=config.BATCH_WINDOW_MS,
+    max_batch_size=config.MAX_BATCH_SIZE,
+    executor=inference_executor,
+    on_dispatch=observe_queue_waits,
+    max_concurrent_batches=config.INFERENCE_WORKERS,
+)
+
+# 処理中のリクエストの取り消し（クライアントの切断を監視し、サーバーの停止時は全て取り消す）
+cancellations = CancellationRegistry(poll_interval=config.DISCONNECT_POLL_MS / 1000)
+
+# 推論キューのアドミッション制御（満杯なら429とRetry-Afterを返す）
+admission = AdmissionController(config.MAX_QUEUE_SIZE, estimate_wait=scheduler.estimate_wait)
+
+# 決定的な生成結果の応答キャッシュ
+response_cache = ResponseCache(
+    config.CACHE_MAX_BYTES,
+    ttl_seconds=config.CACHE_TTL_SECONDS,
+    disk_dir=config.CACHE_DIR,
+)
+
+def response_cache_key(params, prompt):
+    """キャッシュ可能なリクエストのキャッシュキーを返す。サンプリングでシード指定がない場合はNone"""
+    if not response_cache.enabled:
+        return None
+    if params.do_sample and params.seed is None:
+        return None
+    key_params = params._asdict()
+    if not params.do_sample:
+        # 貪欲法では結果に影響しないパラメータをキーから除き、ヒット率を上げる（支援付き生成も同じ出力になる）
+        key_params.update(temperature=None, top_p=None, seed=None, assisted=None)
+    return ResponseCache.make_key(params.model_name, prompt, key_params)
+
+def warmup_model(pipe):
+    """最初のリクエストが遅くならないよう、読み込み直後に短い生成を1回実行する"""
+    if config.WARMUP_MAX_NEW_TOKENS <= 0:
+        return
+    print("モデルのウォームアップを実行中...")
+    pipe("こんにちは", max_new_tokens=config.WARMUP_MAX_NEW_TOKENS, do_sample=False)
+
+def model_nbytes(pipe):
+    """モデルの重みとバッファが使用するメモリ量(バイト)を返す
+
+    量子化したLinear層の重みはパラメータではなくstate_dictのパック済みの値として保持されるため、state_dictから数えます。
+    共有されている重み（埋め込みとlm_headなど）は1回だけ数えます。
+    """
+    total, seen = 0, set()
+    for value in pipe.model.state_dict().values():
+        for tensor in (value if isinstance(value, tuple) else (value,)):
+            if not hasattr(tensor, "numel") or tensor.data_ptr() in seen:
+                continue
+            seen.add(tensor.data_ptr())
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+def on_model_event(event, model_name):
+    """モデルの読み込み・追い出しをメトリクスに記録し、追い出したモデルのKVキャッシュを破棄する"""
+    model_events_counter.inc(model=model_name, event=event)
+    if event == "load":
+        warmup_duration = model_registry.loader(model_name).last_warmup_duration
+        if warmup_duration is not None:
+            startup_timer.record(f"{model_name}: warmup", warmup_duration)
+        startup_timer.mark(f"ready: {model_name}")
+        if model_name == config.MODEL_NAME:
+            print(startup_timer.format_report())
+    elif event == "evict":
+        prefix_caches[model_name].clear()
+        chat_sessions.clear_model(model_name)
+        if config.STUB_MODEL:
+            return
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+# モデルごとの読み込みはバックグラウンドで1回だけ実行し、メモリ予算を超えたら最も長く使われていないモデルを解放する
+model_registry = ModelRegistry(
+    config.AVAILABLE_MODELS,
+    load_model,
+    warmup_fn=warmup_model,
+    size_fn=model_nbytes,
+    budget_bytes=int(config.MODEL_MEMORY_BUDGET_MB * 1024 * 1024),
+    warmup_executor=inference_executor,
+    on_event=on_model_event,
+)
+
+# ドラフトモデルはメインモデルと同時に常駐させる（メモリ予算の対象外）
+draft_loader = ModelLoader(
+    lambda: load_model(config.DRAFT_MODEL_NAME),
+    warmup_fn=warmup_model,
+    warmup_executor=inference_executor,
+)
+
+def resolve_assisted(requested):
+    """リクエストの指定とサーバーの設定から支援付き生成を使うかを決める"""
+    if not config.DRAFT_MODEL_NAME:
+        if requested:
+            raise HTTPException(status_code=400, detail="ドラフトモデル (DRAFT_MODEL_NAME) が設定されていません")
+        return False
+    return config.ASSISTED_DECODING if requested is None else requested
+
+def require_real_model():
+    """トークナイザーが必要なエンドポイントはスタブモデルでは使えないため501を返す"""
+    if config.STUB_MODEL:
+        raise HTTPException(status_code=501, detail="スタブモデル (STUB_MODEL=1) ではこのエンドポイントは使用できません。")
+
+def resolve_model_name(requested):
+    """リクエストで指定されたモデル名を検証する。省略時はデフォルトモデル"""
+    model_name = requested or config.MODEL_NAME
+    if model_name not in model_registry:
+        raise HTTPException(
+            status_code=400,
+            detail=f"モデル '{model_name}' は利用できません。利用可能なモデル: {config.AVAILABLE_MODELS}",
+        )
+    return model_name
+
+def resolve_prompt(request, model_name):
+    """prompt、または messages にチャットテンプレートを適用した文字列を、生成に使うプロンプトとして返す
+
+    messages を指定すると、パイプラインにメッセージを渡してローカルで生成する場合と同じプロンプトになります。
+    """
+    if (request.prompt is None) == (request.messages is None):
+        raise HTTPException(status_code=400, detail="prompt と messages のどちらか一方を指定してください。")
+    if request.messages is None:
+        return request.prompt
+    messages = [{"role": message.role, "content": message.content} for message in request.messages]
+    if config.STUB_MODEL:
+        # スタブモデルにはチャットテンプレートがないため、発言を改行でつなぐ
+        return "\n".join(message["content"] for message in messages)
+    require_model_ready(model_name)
+    tokenizer = model_registry.get(model_name).tokenizer
+    prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    # プロンプトは特殊トークン付きでトークン化されるため、テンプレートが付けたBOSを除いて二重にしない
+    if tokenizer.bos_token and prompt.startswith(tokenizer.bos_token) \
+            and tokenizer("")["input_ids"][:1] == [tokenizer.bos_token_id]:
+        prompt = prompt[len(tokenizer.bos_token):]
+    return prompt
+
+def require_model_ready(model_name):
+    """モデルの準備ができていなければ待たずにRetry-After付きの503を返す
+
+    未読み込みのモデルは読み込みをバックグラウンドで開始します。読み込みに失敗したモデルは
+    リクエストのたびに読み込み直さず、再試行は POST /model/load に任せます。
+    """
+    if model_registry.is_ready(model_name):
+        return
+    loader = model_registry.loader(model_name)
+    if loader.state == NOT_LOADED:
+        model_registry.ensure_loaded(model_name)
+    if loader.state == FAILED:
+        detail = f"モデル '{model_name}' の読み込みに失敗しました（{loader.error}）。POST /model/load で再試行してください。"
+    else:
+        detail = f"モデル '{model_name}' を準備中です（状態: {loader.state}）。後でもう一度お試しください。"
+    raise HTTPException(
+        status_code=503,
+        detail=detail,
+        headers={"Retry-After": str(config.MODEL_LOADING_RETRY_AFTER)},
+    )
+
+@contextmanager
+def use_model(model_name):
+    """推論の間モデルを追い出されないように保持し、モデル別のレイテンシを記録する"""
+    start_time = time.perf_counter()
+    with model_registry.use(model_name):
+        yield
+    model_latency_histogram.observe(time.perf_counter() - start_time, model=model_name)
+
+def collect_queue_metrics():
+    """/metrics の出力直前にキューとモデルの状態をGaugeへ反映する"""
+    inflight_gauge.set(admission.pending)
+    queue_depth_gauge.set(scheduler.queue_depth())
+    for model_name, state in model_registry.snapshot()["models"].items():
+        model_ready_gauge.set(1 if state["state"] == "ready" else 0, model=model_name)
+        model_resident_bytes_gauge.set((state["size_bytes"] or 0) if state["state"] == "ready" else 0, model=model_name)
+
+metrics_registry.add_collector(collect_queue_metrics)
+
+def raise_cancelled(token):
+    """取り消されたリクエストのエラーを返す（クライアントの切断は499、サーバー側の取り消しは503）"""
+    if token.reason == CLIENT_DISCONNECTED:
+        # 切断したクライアントには届かないが、アクセスログで区別できるようにする
+        raise HTTPException(status_code=499, detail="クライアントが切断したため生成を中止しました。")
+    raise HTTPException(status_code=503, detail="サーバー側で生成が取り消されました。")
+
+def resolve_deadline(request):
+    """deadline_ms / max_time からリクエストを受け付けた時点を起点とするCancellationTokenを作る"""
+    budgets = [budget for budget in (
+        request.deadline_ms / 1000 if request.deadline_ms is not None else None,
+        request.max_time,
+    ) if budget is not None]
+    if not budgets:
+        return CancellationToken()
+    budget = min(budgets)
+    if budget <= 0:
+        raise HTTPException(status_code=400, detail="deadline_ms / max_time には正の値を指定してください。")
+    return CancellationToken(deadline=time.perf_counter() + budget)
+
+def check_deadline(token, http_request):
+    """推定待ち時間が締め切りまでの残り時間を超えていれば、推論キューに入れずに503を返す
+
+    同じ締め切りで再試行しても間に合う見込みは変わらないため、Retry-After は付けません。
+    """
+    try:
+        admission.check_deadline(token.remaining())
+    except DeadlineUnreachableError as e:
+        annotate(http_request, rejected="deadline_unreachable", estimated_wait=e.estimated_wait, budget=e.budget)
+        raise HTTPException(status_code=503, detail=str(e))
+
+def resolve_profile_mode(http_request, flag):
+    """?profile= または X-Profile ヘッダーからプロファイルのモードを返す（None / "timing" / "trace"）"""
+    value = (flag or http_request.headers.get("x-profile") or "").strip().lower()
+    if value in ("", "0", "false", "off"):
+        return None
+    if value == "trace":
+        require_real_model()
+        return "trace"
+    return "timing"
+
+def build_profile(result, submitted_at, concurrent_requests, trace_path=None):
+    """推論の結果からレスポンスに含めるプロファイルを作る
+
+    queue_wait はスケジューラに投入してから推論スレッドで処理が始まるまでの時間です。
+    バッチにまとめられた場合、フェーズの時間はバッチ全体で共通（batch_size を参照）です。
+    """
+    finished_at = time.perf_counter()
+    if result.profile is None:
+        # キューで待つ間に取り消された・締め切りを過ぎた場合
+        return {"phases": {"queue_wait": finished_at - submitted_at}, "concurrent_requests": concurrent_requests}
+    profile = dict(result.profile)
+    started_at = profile.pop("started_at")
+    phases = {"queue_wait": max(0.0, started_at - submitted_at), **profile.pop("phases")}
+    decode_time = phases["decode"]
+    profile.update(
+        phases=phases,
+        total=finished_at - submitted_at,
+        tokens_per_sec=profile["completion_tokens"] / decode_time if profile["completion_tokens"] and decode_time > 0 else None,
+        # 投入時点の推論待ち・推論中のリクエスト数（自身を含む）。多い場合は他のリクエストとCPUを取り合っている
+        concurrent_requests=concurrent_requests,
+    )
+    if trace_path is not None:
+        profile["trace_path"] = trace_path
+    return profile
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """送信が終わった時点でアドミッションの枠を解放するStreamingResponse
+
+    本文のジェネレーターは一度も開始されないと finally が実行されない（ヘッダーの送信前にクライアントが切断した場合など）ため、
+    ジェネレーター側の解放に加えて、レスポンスの送信処理の終了時にも解放します（解放は1回だけ行われます）。
+    http_request を渡した場合は、ジェネレーターが request.state.stream_started を設定しないまま終わったときに
+    ジェネレーターの代わりにアクセスログを書きます。
+    """
+
+    def __init__(self, content, slot, http_request=None, **kwargs):
+        super().__init__(content, **kwargs)
+        self.slot = slot
+        self.http_request = http_request
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.slot.release()
+            if self.http_request is not None and not self.http_request.state.stream_started:
+                # 本文を送る前にクライアントが切断した（499はクライアントによる切断を表す慣用のステータス）
+                annotate(self.http_request, cancelled=CLIENT_DISCONNECTED)
+                write_access_log(self.http_request, 499)
+
+def raise_server_busy(e, http_request):
+    """ServerBusyErrorをRetry-Afterヘッダー付きの429レスポンスに変換する"""
+    annotate(http_request, rejected="queue_full", pending=admission.pending, retry_after=e.retry_after)
+    raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
 # --- FastAPIエンドポイント定義 ---
 @app.on_event("startup")
 async def startup_event():
-    """起動時にモデルを初期化"""
-    load_model_task()  # バックグラウンドではなく同期的に読み込む
-    if model is None:
-        print("警告: 起動時にモデルの初期化に失敗しました")
-    else:
-        print("起動時にモデルの初期化が完了しました。")
+    """起動時にデフォルトモデルの読み込みをバックグラウンドで開始"""
+    # 読み込みを待たずにサーバーを起動し、準備ができるまでは /health/ready が503を返す
+    startup_timer.mark("server started")
+    model_registry.ensure_loaded(config.MODEL_NAME)
+    if config.DRAFT_MODEL_NAME:
+        draft_loader.start()
+    print("バックグラウンドでモデルの読み込みを開始しました。")
+    scheduler.start()
+    access_log.start()
+    print(f"バッチングスケジューラを開始しました (window={config.BATCH_WINDOW_MS}ms, max_batch_size={config.MAX_BATCH_SIZE})")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """終了時に処理中の生成を取り消し、バッチングスケジューラと推論Executorを停止（応答キャッシュはディスクに書き出す）"""
+    cancellations.cancel_all()
+    await scheduler.stop()
+    inference_executor.shutdown(wait=False, cancel_futures=True)
+    response_cache.close()
+    access_log.stop()
 
 @app.get("/")
 async def root():
@@ -148,75 +1046,447 @@ async def root():
 @app.get("/health")
 async def health_check():
     """ヘルスチェックエンドポイント"""
-    global model
-    if model is None:
-        return {"status": "error", "message": "No model loaded"}
+    if not model_registry.is_ready(config.MODEL_NAME):
+        return {"status": "error", "message": "No model loaded", "model_state": model_registry.loader(config.MODEL_NAME).state}
 
     return {"status": "ok", "model": config.MODEL_NAME}
 
+@app.get("/health/live")
+async def liveness_check():
+    """プロセスとイベントループが応答できるかを返す（モデルの状態には依存しない）"""
+    return {"status": "ok"}
+
+@app.get("/health/ready")
+async def readiness_check():
+    """デフォルトモデルの読み込みとウォームアップが完了し、リクエストを受け付けられるかを返す"""
+    loader = model_registry.loader(config.MODEL_NAME)
+    if not loader.ready:
+        return JSONResponse(
+            status_code=503,
+            content={"status": "not_ready", "model": config.MODEL_NAME, **loader.snapshot()},
+            headers={"Retry-After": str(config.MODEL_LOADING_RETRY_AFTER)},
+        )
+    return {"status": "ready", "model": config.MODEL_NAME, **loader.snapshot()}
+
+@app.post("/model/load", status_code=202)
+async def trigger_model_load(model: Optional[str] = None):
+    """モデルの読み込みを開始する（失敗後の再試行や事前読み込みに使用。実行中の読み込みがあれば共有する）"""
+    model_name = resolve_model_name(model)
+    model_registry.ensure_loaded(model_name)
+    return {"model": model_name, **model_registry.loader(model_name).snapshot()}
+
+@app.get("/startup")
+async def startup_report():
+    """起動時間のフェーズ別の内訳（インポート、トークナイザー、重み、ウォームアップなど）を返す"""
+    return startup_timer.report()
+
+@app.get("/models")
+async def list_models():
+    """利用可能なモデルの状態、メモリ使用量、読み込み・追い出し回数、レイテンシを返す"""
+    return model_registry.snapshot()
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheusのテキスト形式でメトリクスを返す"""
+    return Response(content=metrics_registry.render(), media_type=MetricsRegistry.content_type)
+
+@app.get("/batching/stats")
+async def batching_stats():
+    """マイクロバッチングの統計（キュー待ち時間・バッチサイズ）を返す"""
+    return {
+        "window_ms": config.BATCH_WINDOW_MS,
+        "max_batch_size": config.MAX_BATCH_SIZE,
+        "queue_depth": scheduler.queue_depth(),
+        "admission": admission.snapshot(),
+        **scheduler.stats.snapshot(),
+    }
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """応答キャッシュの統計（ヒット率など）を返す"""
+    return response_cache.snapshot()
+
+@app.get("/access_log/stats")
+async def access_log_stats():
+    """アクセスログの設定と、書き込み待ち・書き込みが追いつかず捨てたレコード数を返す"""
+    return access_log.snapshot()
+
+@app.get("/assisted/stats")
+async def assisted_generation_stats():
+    """支援付き生成の受理率（ドラフトの提案トークンのうちメインモデルが受理した割合）を返す"""
+    return {"draft_model": config.DRAFT_MODEL_NAME or None, **draft_loader.snapshot(), **assisted_stats.snapshot()}
+
+@app.get("/prefix_cache/stats")
+async def prefix_cache_stats():
+    """プレフィックスKVキャッシュの統計（省略できたプレフィルのトークン数など）をモデルごとに返す"""
+    return {model_name: cache.snapshot() for model_name, cache in prefix_caches.items()}
+
 # 簡略化されたエンドポイント
 @app.post("/generate", response_model=GenerationResponse)
-async def generate_simple(request: SimpleGenerationRequest):
-    """単純なプロンプト入力に基づいてテキストを生成"""
-    global model
+async def generate_simple(request: SimpleGenerationRequest, http_request: Request, profile: Optional[str] = None):
+    """単純なプロンプト入力に基づいてテキストを生成
 
-    if model is None:
-        print("generateエンドポイント: モデルが読み込まれていません。読み込みを試みます...")
-        load_model_task()  # 再度読み込みを試みる
-        if model is None:
-            print("generateエンドポイント: モデルの読み込みに失敗しました。")
-            raise HTTPException(status_code=503, detail="モデルが利用できません。後でもう一度お試しください。")
+    ?profile=1（または X-Profile: 1 ヘッダー）を指定すると、キュー待ち・トークン化・プレフィル・デコード・応答の抽出の
+    時間とトークン数をレスポンスの profile に含めます。profile=trace の場合はバッチにまとめずに推論し、
+    torch profilerのトレースを PROFILE_TRACE_DIR に保存します（chrome://tracing や Perfetto で表示できます）。
+    """
+    model_name = resolve_model_name(request.model)
+    token = resolve_deadline(request)
+    profile_mode = resolve_profile_mode(http_request, profile)
 
     try:
         start_time = time.time()
-        print(f"シンプルなリクエストを受信: prompt={request.prompt[:100]}..., max_new_tokens={request.max_new_tokens}")  # 長いプロンプトは切り捨て
-
-        # プロンプトテキストで直接応答を生成
-        print("モデル推論を開始...")
-        outputs = model(
-            request.prompt,
-            max_new_tokens=request.max_new_tokens,
-            do_sample=request.do_sample,
-            temperature=request.temperature,
-            top_p=request.top_p,
+        annotate(http_request, model=model_name, max_new_tokens=request.max_new_tokens, do_sample=request.do_sample)
+
+        params = GenerationParams(
+            model_name,
+            request.max_new_tokens,
+            request.do_sample,
+            request.temperature,
+            request.top_p,
+            request.seed,
+            resolve_assisted(request.assisted),
         )
-        print("モデル推論が完了しました。")
+        prompt = resolve_prompt(request, model_name)
 
-        # アシスタント応答を抽出
-        assistant_response = extract_assistant_response(outputs, request.prompt)
-        print(f"抽出されたアシスタント応答: {assistant_response[:100]}...")  # 長い場合は切り捨て
+        # 決定的なリクエストはキャッシュを確認し、ヒットすれば推論キューに入れずに返す
+        cache_key = response_cache_key(params, prompt)
+        # トレースを取る場合は推論を実行する必要があるため、キャッシュを確認しない
+        if cache_key is not None and profile_mode != "trace":
+            cached_response = await response_cache.get(cache_key)
+            if cached_response is not None:
+                annotate(
+                    http_request, cached=True,
+                    **access_log.body_fields(http_request.state.sample_body, prompt=prompt, response=cached_response),
+                )
+                return GenerationResponse(
+                    generated_text=cached_response,
+                    response_time=time.time() - start_time,
+                    cached=True,
+                    profile={"cached": True} if profile_mode else None,
+                )
+
+        # 同じ生成パラメータのリクエストとまとめてバッチ推論する（応答の抽出もバッチ内で行う）
+        require_model_ready(model_name)
+        check_deadline(token, http_request)
+        trace_path = None
+        with admission.admit(), use_model(model_name):
+            submitted_at, concurrent_requests = time.perf_counter(), admission.pending
+            async with cancellations.watch(http_request, [token]):
+                if profile_mode == "trace":
+                    trace_path = os.path.join(
+                        config.PROFILE_TRACE_DIR, f"generate-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.json"
+                    )
+                    loop = asyncio.get_running_loop()
+                    result = await loop.run_in_executor(
+                        inference_executor, run_traced_generation, params, prompt, token, trace_path
+                    )
+                else:
+                    result = await scheduler.submit(params, (prompt, token))
+        assistant_response, finish_reason = result.text, result.finish_reason
+        if token.reason == CLIENT_DISCONNECTED:
+            annotate(http_request, cancelled=token.reason)
+            raise_cancelled(token)
+        # 締め切りや取り消しで打ち切った途中までの応答はキャッシュしない
+        if cache_key is not None and finish_reason in ("length", "stop"):
+            response_cache.put(cache_key, assistant_response)
 
         end_time = time.time()
         response_time = end_time - start_time
-        print(f"応答生成時間: {response_time:.2f}秒")
+        annotate(
+            http_request,
+            cached=False,
+            finish_reason=finish_reason,
+            prompt_tokens=result.profile["prompt_tokens"] if result.profile else None,
+            completion_tokens=result.profile["completion_tokens"] if result.profile else None,
+            **access_log.body_fields(http_request.state.sample_body, prompt=prompt, response=assistant_response),
+        )
 
         return GenerationResponse(
             generated_text=assistant_response,
-            response_time=response_time
+            response_time=response_time,
+            finish_reason=finish_reason,
+            profile=build_profile(result, submitted_at, concurrent_requests, trace_path) if profile_mode else None,
         )
 
+    except ServerBusyError as e:
+        raise_server_busy(e, http_request)
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"シンプル応答生成中にエラーが発生しました: {e}")
-        traceback.print_exc()
+        annotate(http_request, error=str(e), traceback=traceback.format_exc())
         raise HTTPException(status_code=500, detail=f"応答の生成中にエラーが発生しました: {str(e)}")
 
-def load_model_task():
-    """モデルを読み込むバックグラウンドタスク"""
-    global model
-    print("load_model_task: モデルの読み込みを開始...")
-    # load_model関数を呼び出し、結果をグローバル変数に設定
-    loaded_pipe = load_model()
-    if loaded_pipe:
-        model = loaded_pipe  # グローバル変数を更新
-        print("load_model_task: モデルの読み込みが完了しました。")
-    else:
-        print("load_model_task: モデルの読み込みに失敗しました。")
+# 複数プロンプトのバッチエンドポイント
+@app.post("/generate/batch", response_model=BatchGenerationResponse)
+async def generate_batch(request: BatchGenerationRequest, http_request: Request):
+    """複数のプロンプトをパディングしたバッチで推論し、入力と同じ順序で結果を返す"""
+    model_name = resolve_model_name(request.model)
+    assisted = resolve_assisted(request.assisted)
+
+    if not request.prompts:
+        raise HTTPException(status_code=400, detail="promptsが空です。")
+    if len(request.prompts) > config.MAX_BATCH_PROMPTS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"1リクエストあたりのプロンプト数は最大{config.MAX_BATCH_PROMPTS}件です。",
+        )
+
+    # 共通パラメータと項目ごとのパラメータをまとめる
+    items = []
+    for item in request.prompts:
+        if isinstance(item, str):
+            item = BatchGenerationItem(prompt=item)
+        params = GenerationParams(
+            model_name,
+            item.max_new_tokens if item.max_new_tokens is not None else request.max_new_tokens,
+            item.do_sample if item.do_sample is not None else request.do_sample,
+            item.temperature if item.temperature is not None else request.temperature,
+            item.top_p if item.top_p is not None else request.top_p,
+            item.seed if item.seed is not None else request.seed,
+            assisted,
+        )
+        items.append((params, item.prompt))
+
+    async def run_item(index, params, prompt, cache_key, token):
+        item_start = time.time()
+        generated_text, finish_reason, _ = await scheduler.submit(params, (prompt, token))
+        if cache_key is not None and finish_reason in ("length", "stop"):
+            response_cache.put(cache_key, generated_text)
+        return BatchGenerationResult(
+            index=index,
+            generated_text=generated_text,
+            response_time=time.time() - item_start,
+            finish_reason=finish_reason,
+        )
+
+    try:
+        start_time = time.time()
+        annotate(http_request, model=model_name, prompts=len(items))
+
+        # キャッシュにヒットした項目はそのまま返し、残りだけを推論する
+        results = [None] * len(items)
+        misses = []
+        for index, (params, prompt) in enumerate(items):
+            cache_key = response_cache_key(params, prompt)
+            cached_response = await response_cache.get(cache_key) if cache_key is not None else None
+            if cached_response is not None:
+                results[index] = BatchGenerationResult(
+                    index=index,
+                    generated_text=cached_response,
+                    response_time=time.time() - start_time,
+                    cached=True,
+                )
+            else:
+                misses.append((index, params, prompt, cache_key))
+
+        # 全項目をスケジューラに投入し、同じパラメータのものは最大バッチサイズごとにまとめて推論する
+        if misses:
+            require_model_ready(model_name)
+            tokens = [CancellationToken() for _ in misses]
+            with admission.admit(len(misses)), use_model(model_name):
+                async with cancellations.watch(http_request, tokens):
+                    generated = await asyncio.gather(*(run_item(*miss, token) for miss, token in zip(misses, tokens)))
+            disconnected = [token for token in tokens if token.reason == CLIENT_DISCONNECTED]
+            if disconnected:
+                annotate(http_request, cancelled=CLIENT_DISCONNECTED)
+                raise_cancelled(disconnected[0])
+            for result in generated:
+                results[result.index] = result
+        response_time = time.time() - start_time
+        annotate(
+            http_request,
+            cached=sum(1 for result in results if result.cached),
+            finish_reasons=[result.finish_reason for result in results],
+        )
+
+        return BatchGenerationResponse(results=results, response_time=response_time)
+
+    except ServerBusyError as e:
+        raise_server_busy(e, http_request)
+    except HTTPException:
+        raise
+    except Exception as e:
+        annotate(http_request, error=str(e), traceback=traceback.format_exc())
+        raise HTTPException(status_code=500, detail=f"応答の生成中にエラーが発生しました: {str(e)}")
+
+# マルチターンの会話エンドポイント
+@app.post("/chat", response_model=ChatResponse)
+async def chat(request: ChatRequest, http_request: Request):
+    """セッションIDごとに会話を保持し、チャットテンプレートをサーバー側で適用して応答を生成する
+
+    messages にはこのターンで追加するメッセージ（通常はユーザーの発言1件）のみを指定します。
+    セッションが期限切れで破棄されていた場合は新しいセッションとして扱うため、会話全体を送り直してください。
+    """
+    require_real_model()
+    model_name = resolve_model_name(request.model)
+    if not request.messages:
+        raise HTTPException(status_code=400, detail="messagesが空です。")
+    require_model_ready(model_name)
+
+    try:
+        session = chat_sessions.acquire(request.session_id, model_name)
+    except SessionBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    generate_kwargs = {
+        "max_new_tokens": request.max_new_tokens,
+        "do_sample": request.do_sample,
+        "temperature": request.temperature,
+        "top_p": request.top_p,
+    }
+    try:
+        start_time = time.time()
+        token = CancellationToken()
+        with admission.admit(), use_model(model_name):
+            loop = asyncio.get_running_loop()
+            async with cancellations.watch(http_request, [token]):
+                # 取り消された場合、推論スレッドは会話を更新せずに終了する
+                result = await loop.run_in_executor(
+                    inference_executor,
+                    run_chat_turn,
+                    model_registry.get(model_name),
+                    session,
+                    [{"role": message.role, "content": message.content} for message in request.messages],
+                    generate_kwargs,
+                    token,
+                )
+        if result is None:
+            annotate(http_request, model=model_name, cancelled=token.reason)
+            raise_cancelled(token)
+        annotate(
+            http_request,
+            model=model_name,
+            session_id=session.session_id,
+            turns=session.turns,
+            prompt_tokens=result["prompt_tokens"],
+            reused_tokens=result["reused_tokens"],
+            completion_tokens=result["completion_tokens"],
+            **access_log.body_fields(
+                http_request.state.sample_body, prompt=request.messages[-1].content, response=result["generated_text"]
+            ),
+        )
+        return ChatResponse(
+            session_id=session.session_id,
+            response_time=time.time() - start_time,
+            turns=session.turns,
+            **result,
+        )
+    except ServerBusyError as e:
+        raise_server_busy(e, http_request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        annotate(http_request, error=str(e), traceback=traceback.format_exc())
+        raise HTTPException(status_code=500, detail=f"応答の生成中にエラーが発生しました: {str(e)}")
+    finally:
+        chat_sessions.release(session)
+
+@app.get("/chat/sessions")
+async def chat_session_stats():
+    """チャットセッションの数と、差分トークン化・KV再利用の統計を返す"""
+    return chat_sessions.snapshot()
+
+@app.delete("/chat/{session_id}")
+async def delete_chat_session(session_id: str):
+    """セッションを削除する（生成中のセッションは削除できない）"""
+    if not chat_sessions.delete(session_id):
+        raise HTTPException(status_code=404, detail="セッションが見つからないか、生成中です。")
+    return {"deleted": session_id}
+
+# ストリーミングエンドポイント
+@app.post("/generate/stream")
+async def generate_stream(request: SimpleGenerationRequest, http_request: Request):
+    """生成されたトークンをServer-Sent Eventsで逐次返す
+
+    生成中は `token` イベント、最後に最初のトークンまでの時間と tokens/sec を含む `done` イベントを送信します。
+    """
+    require_real_model()
+    model_name = resolve_model_name(request.model)
+    token = resolve_deadline(request)
+    require_model_ready(model_name)
+    check_deadline(token, http_request)
+    # 400を返しうる検証は全て枠を確保する前に行う
+    assisted = resolve_assisted(request.assisted) and draft_loader.ready
+    prompt = resolve_prompt(request, model_name)
+
+    annotate(http_request, model=model_name, max_new_tokens=request.max_new_tokens, stream=True)
+    generate_kwargs = {
+        "max_new_tokens": request.max_new_tokens,
+        "do_sample": request.do_sample,
+        "temperature": request.temperature,
+        "top_p": request.top_p,
+    }
+    generate_kwargs = with_cancellation(generate_kwargs, [token])
+
+    async def event_stream():
+        http_request.state.stream_started = True
+        timer = PhaseTimer()
+        try:
+            # 送信の中断はクライアントの切断によるため、推論スレッドの生成もステップの間で止める
+            async with cancellations.watch(http_request, [token], interrupted_reason=CLIENT_DISCONNECTED):
+                with use_model(model_name):
+                    pipe = model_registry.get(model_name)
+                    if assisted:
+                        # 受理されたトークンはまとめてストリーマーに渡されるため、複数トークンずつ送信される
+                        generate_kwargs.update(assistant_kwargs(pipe, model_name, draft_loader.model))
+                    async for event in stream_generation(
+                        pipe,
+                        prompt,
+                        generate_kwargs,
+                        inference_executor,
+                        prefix_cache=None if assisted else prefix_caches[model_name],
+                        timer=timer,
+                        guard=random_state.guard(request.do_sample),
+                        finish_reason=lambda completion_tokens: finish_reason_for(
+                            token, completion_tokens, request.max_new_tokens
+                        ),
+                    ):
+                        yield event
+            phase_latency_histogram.observe(timer.queue_wait, phase="queue_wait")
+            observe_generation(timer, None)
+        except Exception as e:
+            annotate(http_request, error=str(e), traceback=traceback.format_exc())
+            yield sse_event("error", {"detail": f"応答の生成中にエラーが発生しました: {str(e)}"})
+        finally:
+            # 切断までに生成したトークンを破棄した分として記録する
+            observe_aborted(token, timer.completion_tokens)
+            slot.release()
+            annotate(
+                http_request,
+                completion_tokens=timer.completion_tokens,
+                cancelled=token.reason,
+                **access_log.body_fields(http_request.state.sample_body, prompt=prompt),
+            )
+            write_access_log(http_request, 200)
+
+    # 枠の確保からレスポンスを返すまでの間に例外を送出する処理を置かない
+    try:
+        slot = admission.slot()
+    except ServerBusyError as e:
+        raise_server_busy(e, http_request)
+    # アクセスログは本文の送信が終わってから書く
+    http_request.state.access_deferred = True
+    http_request.state.stream_started = False
+    return AdmittedStreamingResponse(
+        event_stream(),
+        slot,
+        http_request,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},  # プロキシでのバッファリングを防ぐ
+    )
 
 print("FastAPIエンドポイントを定義しました。")
+startup_timer.mark("app imported")
 
 # --- ngrokでAPIサーバーを実行する関数 ---
 def run_with_ngrok(port=8501):
     """ngrokでFastAPIアプリを実行"""
+    import nest_asyncio
+    import uvicorn
+    from pyngrok import ngrok
+
     nest_asyncio.apply()
 
     ngrok_token = os.environ.get("NGROK_TOKEN")
@@ -261,7 +1531,17 @@ def run_with_ngrok(port=8501):
         print(f"📖 APIドキュメント (Swagger UI): {public_url}/docs")
         print("---------------------------------------------------------------------")
         print("(APIクライアントやブラウザからアクセスするためにこのURLをコピーしてください)")
-        uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")  # ログレベルをinfoに設定
+        if config.WORKERS > 1:
+            from workers import run_workers
+            run_workers(
+                app,
+                port=port,
+                num_workers=config.WORKERS,
+                threads_per_worker=config.TORCH_THREADS_PER_WORKER or None,
+                preload_fn=preload_models,
+            )
+        else:
+            uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")  # ログレベルをinfoに設定
 
     except Exception as e:
         print(f"\n ngrokまたはUvicornの起動中にエラーが発生しました: {e}")
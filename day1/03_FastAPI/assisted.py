@@ -0,0 +1,66 @@
+# assisted.py
+# 小さなドラフトモデルで候補トークンを提案し、メインモデルが1回のフォワードでまとめて検証する支援付き生成（speculative decoding）の計測
+import threading
+from contextlib import contextmanager
+
+
+@contextmanager
+def count_forward_passes(module):
+    """with ブロックの間に現在のスレッドから呼ばれたmoduleのフォワード回数を数える
+
+    同じモデルを別の推論スレッドが同時に使っていても、そのスレッドの呼び出しは数えません。
+    """
+    owner = threading.get_ident()
+    counter = {"calls": 0}
+
+    def hook(_module, _inputs, _output):
+        if threading.get_ident() == owner:
+            counter["calls"] += 1
+
+    handle = module.register_forward_hook(hook)
+    try:
+        yield counter
+    finally:
+        handle.remove()
+
+
+class AssistedStats:
+    """支援付き生成の受理率を集計する（推論スレッドから更新されるためロックで保護する）
+
+    ドラフトモデルは1回のフォワードで1トークンを提案し、メインモデルは1回のフォワードで候補を検証して1トークンを追加します。
+    そのため、受理されたドラフトトークン数 = 生成トークン数 - メインモデルのフォワード回数 となります。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.generated_tokens = 0
+        self.target_forward_passes = 0
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+
+    def record(self, generated_tokens, target_passes, draft_passes):
+        """1回の生成の結果を記録し、受理されたドラフトトークン数を返す"""
+        accepted = max(0, min(generated_tokens - target_passes, draft_passes))
+        with self._lock:
+            self.requests += 1
+            self.generated_tokens += generated_tokens
+            self.target_forward_passes += target_passes
+            self.draft_tokens += draft_passes
+            self.accepted_tokens += accepted
+        return accepted
+
+    def snapshot(self):
+        """統計を辞書形式で返す"""
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "generated_tokens": self.generated_tokens,
+                "draft_tokens": self.draft_tokens,
+                "accepted_tokens": self.accepted_tokens,
+                "acceptance_rate": self.accepted_tokens / self.draft_tokens if self.draft_tokens else 0.0,
+                # メインモデルの1回のフォワードあたりに確定したトークン数（通常のデコードでは1.0）
+                "tokens_per_target_pass": (
+                    self.generated_tokens / self.target_forward_passes if self.target_forward_passes else 0.0
+                ),
+            }
@@ -0,0 +1,228 @@
+# batching.py
+# /generate へのリクエストを短い時間窓で集め、まとめて推論するマイクロバッチングスケジューラ
+import asyncio
+import heapq
+import time
+from collections import deque
+
+
+class _PendingRequest:
+    """キューで待機中の1リクエスト"""
+
+    def __init__(self, key, payload, future):
+        self.key = key
+        self.payload = payload
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+
+
+class BatchStats:
+    """キュー待ち時間とバッチサイズの統計を保持する"""
+
+    def __init__(self, max_samples=1000):
+        self.total_requests = 0
+        self.total_batches = 0
+        self.batch_size_counts = {}  # バッチサイズ -> 実行回数
+        self.queue_wait_samples = deque(maxlen=max_samples)  # 直近のキュー待ち時間(秒)
+        self.batch_duration_samples = deque(maxlen=100)  # 直近のバッチ実行時間(秒)
+
+    def record(self, batch_size, queue_waits):
+        """1回のバッチ実行を記録する"""
+        self.total_batches += 1
+        self.total_requests += batch_size
+        self.batch_size_counts[batch_size] = self.batch_size_counts.get(batch_size, 0) + 1
+        self.queue_wait_samples.extend(queue_waits)
+
+    def record_duration(self, duration):
+        """1回のバッチ実行にかかった時間を記録する"""
+        self.batch_duration_samples.append(duration)
+
+    def avg_batch_duration(self):
+        """直近のバッチ実行時間の平均(秒)を返す"""
+        if not self.batch_duration_samples:
+            return 0.0
+        return sum(self.batch_duration_samples) / len(self.batch_duration_samples)
+
+    def snapshot(self):
+        """統計を辞書形式で返す"""
+        waits = sorted(self.queue_wait_samples)
+
+        def percentile(p):
+            if not waits:
+                return 0.0
+            index = min(len(waits) - 1, int(round(p / 100 * (len(waits) - 1))))
+            return waits[index] * 1000
+
+        return {
+            "total_requests": self.total_requests,
+            "total_batches": self.total_batches,
+            "avg_batch_size": self.total_requests / self.total_batches if self.total_batches else 0.0,
+            "avg_batch_duration_ms": self.avg_batch_duration() * 1000,
+            "batch_size_counts": dict(sorted(self.batch_size_counts.items())),
+            "queue_wait_ms": {
+                "avg": sum(waits) / len(waits) * 1000 if waits else 0.0,
+                "p50": percentile(50),
+                "p90": percentile(90),
+                "p99": percentile(99),
+                "max": waits[-1] * 1000 if waits else 0.0,
+            },
+        }
+
+
+class BatchScheduler:
+    """同じ生成パラメータを持つリクエストを時間窓内で集めて1回の推論にまとめる
+
+    run_batch(key, payloads) はスレッド上で呼び出される同期関数で、
+    payloads と同じ順序で結果のリストを返す必要があります。
+    on_dispatch(key, queue_waits) を指定すると、バッチの実行直前に各リクエストのキュー待ち時間(秒)が渡されます。
+    max_concurrent_batches 件までのバッチを同時に実行します（executor のスレッド数に合わせます）。
+    実行中のバッチが上限に達している間は次のバッチを取り出さないため、その間に届いたリクエストは次のバッチにまとまります。
+    """
+
+    def __init__(self, run_batch, window_ms=10.0, max_batch_size=8, executor=None, on_dispatch=None,
+                 max_concurrent_batches=1):
+        self.run_batch = run_batch
+        self.on_dispatch = on_dispatch
+        self.window = window_ms / 1000
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_concurrent_batches = max(1, max_concurrent_batches)
+        self.executor = executor  # Noneの場合はイベントループのデフォルトExecutorを使用
+        self.stats = BatchStats()
+        self._pending = {}  # key -> deque[_PendingRequest]
+        self._wakeup = None
+        self._worker = None
+        self._slots = None  # 同時に実行するバッチ数の上限
+        self._batch_tasks = set()
+        self._running_since = []  # 実行中のバッチの開始時刻
+
+    def start(self):
+        """バッチ処理ループを開始する"""
+        if self._worker is None:
+            self._wakeup = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.max_concurrent_batches)
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """バッチ処理ループを停止し、待機中のリクエストをキャンセルする"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        for task in list(self._batch_tasks):
+            task.cancel()
+        if self._batch_tasks:
+            await asyncio.gather(*self._batch_tasks, return_exceptions=True)
+        for queue in self._pending.values():
+            for pending in queue:
+                if not pending.future.done():
+                    pending.future.cancel()
+        self._pending.clear()
+
+    def queue_depth(self):
+        """キューで待機中のリクエスト数を返す"""
+        return sum(len(queue) for queue in self._pending.values())
+
+    def estimate_wait(self):
+        """新しいリクエストの推論が始まるまでの推定待ち時間(秒)を返す
+
+        先に待っているリクエストで埋まるバッチを、実行中のバッチの残り時間から順に空いた実行枠へ割り当てたときに、
+        次に枠が空くまでの時間です。新しいリクエスト自身の生成時間は含みません（サーバーが空いていれば0）。
+        """
+        avg = self.stats.avg_batch_duration()
+        now = time.perf_counter()
+        # 実行枠ごとに空くまでの時間（空いている枠は0）
+        free_at = [max(0.0, avg - (now - started_at)) for started_at in self._running_since]
+        free_at += [0.0] * (self.max_concurrent_batches - len(free_at))
+        heapq.heapify(free_at)
+        for _ in range(self.queue_depth() // self.max_batch_size):  # 新しいリクエストは埋まっていないバッチに加わる
+            heapq.heapreplace(free_at, free_at[0] + avg)
+        return free_at[0]
+
+    async def submit(self, key, payload):
+        """リクエストをキューに追加し、バッチ推論の結果を待つ"""
+        if self._worker is None:
+            raise RuntimeError("BatchSchedulerが開始されていません")
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(key, deque()).append(_PendingRequest(key, payload, future))
+        self._wakeup.set()
+        return await future
+
+    async def _next_batch(self):
+        """時間窓が経過するか最大バッチサイズに達したグループを取り出す"""
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            # 最も古いリクエストを持つグループを優先する
+            key = min(self._pending, key=lambda k: self._pending[k][0].enqueued_at)
+            queue = self._pending[key]
+            if len(queue) < self.max_batch_size:
+                remaining = queue[0].enqueued_at + self.window - time.perf_counter()
+                if remaining > 0:
+                    # 新しいリクエストが届くか時間窓が切れるまで待つ
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+            batch = [queue.popleft() for _ in range(min(len(queue), self.max_batch_size))]
+            if not queue:
+                del self._pending[key]
+            return key, batch
+
+    async def _run(self):
+        """実行枠が空くたびに次のバッチを取り出して実行するワーカー"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._slots.acquire()
+            try:
+                key, batch = await self._next_batch()
+            except BaseException:
+                self._slots.release()
+                raise
+            # 待機中に呼び出し元が居なくなったリクエストは除外する
+            batch = [pending for pending in batch if not pending.future.done()]
+            if not batch:
+                self._slots.release()
+                continue
+            task = loop.create_task(self._execute(key, batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _execute(self, key, batch):
+        """1つのバッチを実行して結果を各リクエストに返し、実行枠を解放する"""
+        loop = asyncio.get_running_loop()
+        started_at = time.perf_counter()
+        self._running_since.append(started_at)
+        queue_waits = [started_at - pending.enqueued_at for pending in batch]
+        self.stats.record(len(batch), queue_waits)
+        try:
+            if self.on_dispatch is not None:
+                self.on_dispatch(key, queue_waits)
+            results = await loop.run_in_executor(
+                self.executor, self.run_batch, key, [pending.payload for pending in batch]
+            )
+        except asyncio.CancelledError:
+            for pending in batch:
+                pending.future.cancel()
+            raise
+        except Exception as e:
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(e)
+            return
+        finally:
+            self._running_since.remove(started_at)
+            self.stats.record_duration(time.perf_counter() - started_at)
+            self._slots.release()
+
+        for pending, result in zip(batch, results):
+            if not pending.future.done():
+                pending.future.set_result(result)
@@ -0,0 +1,137 @@
+# benchmark_quantization.py
+# bf16のモデルとint8量子化モデルを同じプロンプトで比較し、生成速度・ピークメモリ・出力の一致度を計測する
+#
+# 使い方:
+#   python benchmark_quantization.py --model google/gemma-2-2b-jpn-it --output results.json
+# 各モードは別プロセスで実行し、ピークRSSが互いに影響しないようにする
+import argparse
+import difflib
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+PROMPTS = [
+    "日本の首都はどこですか？",
+    "機械学習と深層学習の違いを簡潔に説明してください。",
+    "富士山の高さは何メートルですか？",
+    "Pythonでリストを逆順にする方法を教えてください。",
+    "光合成とは何ですか？",
+    "太陽系で一番大きな惑星は何ですか？",
+    "健康的な朝食の例を3つ挙げてください。",
+    "HTTPとHTTPSの違いは何ですか？",
+]
+
+
+def run_mode(model_name, mode, max_new_tokens, cache_dir):
+    """1つのモードでモデルを読み込み、全プロンプトを貪欲法で生成した結果と計測値を返す"""
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    from quantization import load_quantized_model
+
+    load_start = time.perf_counter()
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    if mode == "bf16":
+        model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.bfloat16, low_cpu_mem_usage=True)
+    else:
+        model = load_quantized_model(model_name, mode, cache_dir)
+    model.eval()
+    load_time = time.perf_counter() - load_start
+
+    outputs, completion_tokens, generation_time = [], 0, 0.0
+    for prompt in PROMPTS:
+        messages = [{"role": "user", "content": prompt}]
+        input_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt")
+        start = time.perf_counter()
+        with torch.inference_mode():
+            output_ids = model.generate(input_ids, max_new_tokens=max_new_tokens, do_sample=False)
+        generation_time += time.perf_counter() - start
+        new_ids = output_ids[0, input_ids.shape[1]:]
+        completion_tokens += new_ids.numel()
+        outputs.append({"text": tokenizer.decode(new_ids, skip_special_tokens=True), "ids": new_ids.tolist()})
+
+    return {
+        "mode": mode,
+        "load_time": load_time,
+        "completion_tokens": completion_tokens,
+        "generation_time": generation_time,
+        "tokens_per_sec": completion_tokens / generation_time if generation_time > 0 else 0.0,
+        # Linuxのru_maxrssはKB単位
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "outputs": outputs,
+    }
+
+
+def agreement(baseline_outputs, outputs):
+    """bf16の出力に対する一致度（完全一致率、先頭から一致したトークンの割合、文字列の類似度）を返す"""
+    exact, prefix_ratios, similarities = 0, [], []
+    for base, other in zip(baseline_outputs, outputs):
+        exact += base["ids"] == other["ids"]
+        matched = 0
+        for a, b in zip(base["ids"], other["ids"]):
+            if a != b:
+                break
+            matched += 1
+        prefix_ratios.append(matched / max(len(base["ids"]), 1))
+        similarities.append(difflib.SequenceMatcher(None, base["text"], other["text"]).ratio())
+    n = len(baseline_outputs)
+    return {
+        "exact_match_rate": exact / n,
+        "avg_token_prefix_agreement": sum(prefix_ratios) / n,
+        "avg_text_similarity": sum(similarities) / n,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bf16と量子化モデルの速度・メモリ・出力を比較する")
+    parser.add_argument("--model", default="google/gemma-2-2b-jpn-it")
+    parser.add_argument("--modes", default="bf16,int8", help="カンマ区切り。先頭をベースラインとする")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=None, help="torchのスレッド数")
+    parser.add_argument("--cache-dir", default=os.environ.get("QUANTIZED_CACHE_DIR", "quantized_models"))
+    parser.add_argument("--output", default=None, help="結果を保存するJSONファイル")
+    parser.add_argument("--run-mode", default=None, help=argparse.SUPPRESS)  # 子プロセス用
+    args = parser.parse_args()
+
+    if args.run_mode:
+        if args.threads:
+            import torch
+            torch.set_num_threads(args.threads)
+        result = run_mode(args.model, args.run_mode, args.max_new_tokens, args.cache_dir)
+        print("RESULT " + json.dumps(result, ensure_ascii=False))
+        return
+
+    results = []
+    for mode in args.modes.split(","):
+        print(f"--- {mode} ---")
+        command = [sys.executable, os.path.abspath(__file__), "--run-mode", mode, "--model", args.model,
+                   "--max-new-tokens", str(args.max_new_tokens), "--cache-dir", args.cache_dir]
+        if args.threads:
+            command += ["--threads", str(args.threads)]
+        completed = subprocess.run(command, capture_output=True, text=True, check=True)
+        line = next(l for l in completed.stdout.splitlines() if l.startswith("RESULT "))
+        results.append(json.loads(line[len("RESULT "):]))
+
+    baseline = results[0]
+    for result in results:
+        result["agreement"] = agreement(baseline["outputs"], result["outputs"])
+        result["speedup"] = result["tokens_per_sec"] / baseline["tokens_per_sec"] if baseline["tokens_per_sec"] else None
+
+    print(f"\n{'mode':>6} {'tok/s':>8} {'speedup':>8} {'peakRSS(MB)':>12} {'load(s)':>8} {'exact':>6} {'prefix':>7} {'similar':>8}")
+    for result in results:
+        a = result["agreement"]
+        print(
+            f"{result['mode']:>6} {result['tokens_per_sec']:>8.2f} {result['speedup'] or 0:>8.2f}"
+            f" {result['peak_rss_mb']:>12.0f} {result['load_time']:>8.1f} {a['exact_match_rate']:>6.2f}"
+            f" {a['avg_token_prefix_agreement']:>7.2f} {a['avg_text_similarity']:>8.2f}"
+        )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"結果を {args.output} に保存しました")
+
+
+if __name__ == "__main__":
+    main()
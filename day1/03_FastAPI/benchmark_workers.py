@@ -0,0 +1,143 @@
+# benchmark_workers.py
+# ワーカー数を1からNまで変えてサーバーを起動し、CPU上でのスループットの伸びとメモリ使用量を計測する
+#
+# 使い方:
+#   python benchmark_workers.py --max-workers 4 --requests 32 --concurrency 8 --output results.json
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+PROMPT = "日本の首都はどこですか？一文で答えてください。"
+
+
+def wait_until_ready(url, process, timeout, required_successes):
+    """/health/ready をポーリングし、連続して準備完了が返るまで待つ
+
+    どのワーカーが応答するかはカーネルが決めるため、ワーカー数より十分多く連続で成功したら全ワーカーの準備ができたとみなします。
+    """
+    deadline = time.time() + timeout
+    successes = 0
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("サーバープロセスが終了しました")
+        try:
+            ready = requests.get(f"{url}/health/ready", timeout=2).status_code == 200
+        except requests.RequestException:
+            ready = False
+        successes = successes + 1 if ready else 0
+        if successes >= required_successes:
+            return
+        time.sleep(0.1 if ready else 1)
+    raise TimeoutError(f"{timeout}秒以内にサーバーの準備ができませんでした")
+
+
+def memory_usage(root_pid):
+    """サーバーの全プロセスのRSSとPSSの合計(MB)を返す（Linuxのみ）
+
+    RSSは共有ページを重複して数えるため、コピーオンライトで共有できているかはPSSの合計で確認します。
+    """
+    pids = [root_pid]
+    try:
+        with open(f"/proc/{root_pid}/task/{root_pid}/children") as f:
+            pids += [int(pid) for pid in f.read().split()]
+    except OSError:
+        return None
+    totals = {"rss_mb": 0.0, "pss_mb": 0.0}
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/smaps_rollup") as f:
+                for line in f:
+                    name, value = line.split(":", 1)[0], line.split()[1:2]
+                    if name == "Rss":
+                        totals["rss_mb"] += int(value[0]) / 1024
+                    elif name == "Pss":
+                        totals["pss_mb"] += int(value[0]) / 1024
+        except OSError:
+            continue
+    totals["processes"] = len(pids)
+    return totals
+
+
+def run_load(url, num_requests, concurrency, max_new_tokens):
+    """同時に concurrency 件ずつリクエストを送り、スループットを計測する"""
+    def send(index):
+        # 応答キャッシュに当たらないよう、リクエストごとにプロンプトを変える
+        payload = {"prompt": f"{PROMPT} (#{index})", "max_new_tokens": max_new_tokens, "do_sample": False}
+        start = time.perf_counter()
+        response = requests.post(f"{url}/generate", json=payload, timeout=600)
+        return response.status_code, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(num_requests)))
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latency for status, latency in results if status == 200)
+    return {
+        "requests": num_requests,
+        "succeeded": len(latencies),
+        "elapsed": elapsed,
+        "requests_per_sec": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "avg_latency": sum(latencies) / len(latencies) if latencies else None,
+        "p90_latency": latencies[int(len(latencies) * 0.9)] if latencies else None,
+    }
+
+
+def benchmark(num_workers, args):
+    """指定したワーカー数でサーバーを起動して計測し、終了させる"""
+    env = dict(os.environ, CACHE_MAX_BYTES="0", MAX_BATCH_SIZE=str(args.max_batch_size))
+    command = [sys.executable, "workers.py", "--workers", str(num_workers), "--port", str(args.port)]
+    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+    url = f"http://127.0.0.1:{args.port}"
+    try:
+        startup_start = time.perf_counter()
+        wait_until_ready(url, process, args.startup_timeout, required_successes=num_workers * 5)
+        startup_time = time.perf_counter() - startup_start
+        # 全てのワーカーが最初のリクエストを処理してから計測する
+        run_load(url, num_workers * 2, num_workers, args.max_new_tokens)
+        result = run_load(url, args.requests, args.concurrency, args.max_new_tokens)
+        result.update({"workers": num_workers, "startup_time": startup_time, "memory": memory_usage(process.pid)})
+        return result
+    finally:
+        process.terminate()
+        process.wait(timeout=60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ワーカー数ごとのスループットを計測する")
+    parser.add_argument("--max-workers", type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--max-batch-size", type=int, default=1, help="ワーカー内のマイクロバッチの上限（1でプロセス数の効果のみを計測）")
+    parser.add_argument("--port", type=int, default=8601)
+    parser.add_argument("--startup-timeout", type=float, default=900)
+    parser.add_argument("--output", default=None, help="結果を保存するJSONファイル")
+    args = parser.parse_args()
+
+    results = []
+    for num_workers in range(1, args.max_workers + 1):
+        print(f"--- ワーカー数 {num_workers} ---")
+        results.append(benchmark(num_workers, args))
+
+    baseline = results[0]["requests_per_sec"] or 1.0
+    print(f"\n{'workers':>8} {'req/s':>8} {'speedup':>8} {'avg(s)':>8} {'RSS(MB)':>10} {'PSS(MB)':>10}")
+    for result in results:
+        memory = result["memory"] or {}
+        print(
+            f"{result['workers']:>8} {result['requests_per_sec']:>8.2f} {result['requests_per_sec'] / baseline:>8.2f}"
+            f" {result['avg_latency'] or 0:>8.2f} {memory.get('rss_mb', 0):>10.0f} {memory.get('pss_mb', 0):>10.0f}"
+        )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"結果を {args.output} に保存しました")
+
+
+if __name__ == "__main__":
+    main()
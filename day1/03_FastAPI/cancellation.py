@@ -0,0 +1,106 @@
+# cancellation.py
+# 生成の取り消し（クライアントの切断やサーバーの停止時に、デコードのステップの間で生成を打ち切る）
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager
+
+# 取り消しの理由
+CLIENT_DISCONNECTED = "client_disconnected"
+SERVER_CANCELLED = "server_cancelled"
+DEADLINE_EXCEEDED = "deadline"
+
+
+class CancellationToken:
+    """1件のリクエストの取り消し状態（イベントループから取り消し、推論スレッドから参照する）
+
+    deadline（time.perf_counter()の時刻）を指定すると、その時刻を過ぎた時点で DEADLINE_EXCEEDED として取り消されます。
+    """
+
+    def __init__(self, deadline=None):
+        self._event = threading.Event()
+        self.reason = None
+        self.deadline = deadline
+
+    def cancel(self, reason=SERVER_CANCELLED):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self):
+        if not self._event.is_set() and self.deadline is not None and time.perf_counter() >= self.deadline:
+            self.cancel(DEADLINE_EXCEEDED)
+        return self._event.is_set()
+
+    def remaining(self):
+        """締め切りまでの残り時間(秒)。締め切りがなければNone"""
+        return None if self.deadline is None else self.deadline - time.perf_counter()
+
+
+class CancellationCriteria:
+    """generate()の stopping_criteria に渡し、取り消されたリクエストの行の生成を止める
+
+    tokens はバッチの行と同じ順序のトークンです。行ごとに終了を返すため、バッチ内の他のリクエストの生成は続きます。
+    """
+
+    def __init__(self, tokens):
+        self.tokens = list(tokens)
+
+    def all_cancelled(self):
+        return all(token.cancelled for token in self.tokens)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        import torch
+
+        flags = [token.cancelled for token in self.tokens]
+        if len(flags) != input_ids.shape[0]:
+            # 行とトークンが対応しない場合（1件を複数の系列で生成する場合など）は全て取り消されたときだけ止める
+            flags = [all(flags)] * input_ids.shape[0]
+        return torch.tensor(flags, dtype=torch.bool, device=input_ids.device)
+
+
+class CancellationRegistry:
+    """処理中のリクエストのトークンを保持し、クライアントの切断を監視する"""
+
+    def __init__(self, poll_interval=0.5):
+        self.poll_interval = poll_interval  # 切断を確認する間隔(秒)
+        self._active = set()
+
+    @property
+    def active(self):
+        return len(self._active)
+
+    async def _watch_disconnect(self, request, tokens):
+        while not all(token.cancelled for token in tokens):
+            if await request.is_disconnected():
+                for token in tokens:
+                    token.cancel(CLIENT_DISCONNECTED)
+                return
+            await asyncio.sleep(self.poll_interval)
+
+    @asynccontextmanager
+    async def watch(self, request, tokens, interrupted_reason=SERVER_CANCELLED):
+        """with ブロックの間、クライアントが切断したらトークンを取り消す
+
+        ハンドラ自体が取り消された場合（サーバーの停止など）も interrupted_reason でトークンを取り消してから例外を伝えます。
+        ストリーミングではレスポンスの送信が中断されるのはクライアントの切断によるため、CLIENT_DISCONNECTED を指定します。
+        """
+        tokens = list(tokens)
+        self._active.update(tokens)
+        watcher = asyncio.get_running_loop().create_task(self._watch_disconnect(request, tokens)) if request else None
+        try:
+            yield tokens
+        except (asyncio.CancelledError, GeneratorExit):
+            for token in tokens:
+                token.cancel(interrupted_reason)
+            raise
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            self._active.difference_update(tokens)
+
+    def cancel_all(self, reason=SERVER_CANCELLED):
+        """処理中の全てのリクエストを取り消す（サーバーの停止時など）"""
+        for token in list(self._active):
+            token.cancel(reason)
@@ -0,0 +1,177 @@
+# chat_sessions.py
+# /chat のセッションごとに会話のメッセージとトークン列（任意でKVキャッシュ）を保持し、会話の差分だけをトークン化する
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from prefix_cache import _common_prefix_length
+
+
+class SessionBusyError(Exception):
+    """同じセッションで前のターンの生成が終わっていない"""
+
+
+class ChatSession:
+    """1つの会話の状態
+
+    token_ids はチャットテンプレートを適用した会話全体のトークン列で、ターンごとに差分だけを追加します。
+    kv_ids / past_key_values は直前の生成で使ったトークン列とそのKVキャッシュです（KVを保持する場合のみ）。
+    """
+
+    def __init__(self, session_id, model_name):
+        self.session_id = session_id
+        self.model_name = model_name
+        self.messages = []
+        self.text = ""  # token_ids に対応するテンプレート適用済みのテキスト
+        self.token_ids = []
+        self.kv_ids = []
+        self.past_key_values = None
+        self.busy = False
+        self.turns = 0
+        self.last_used = time.time()
+
+    def prepare_prompt(self, tokenizer, new_messages):
+        """新しいメッセージを加えた会話のプロンプトのトークン列と、差分だけをトークン化できたかを返す
+
+        テンプレートを適用したテキストがこれまでのテキストから始まる場合は、増えた部分だけをトークン化します。
+        そうでない場合（テンプレートが過去の部分を書き換える場合）は会話全体をトークン化し直します。
+        """
+        messages = self.messages + new_messages
+        try:
+            prompt_text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        except Exception as e:  # ロールの順序が不正な場合など（テンプレートの例外の型はモデルごとに異なる）
+            raise ValueError(f"チャットテンプレートを適用できません: {e}") from e
+        if self.token_ids and prompt_text.startswith(self.text):
+            delta_ids = tokenizer(prompt_text[len(self.text):], add_special_tokens=False)["input_ids"]
+            return messages, prompt_text, self.token_ids + delta_ids, True
+        # 先頭のBOSなどはテンプレートに含まれるため、特殊トークンは追加しない
+        prompt_ids = tokenizer(prompt_text, add_special_tokens=False)["input_ids"]
+        return messages, prompt_text, prompt_ids, False
+
+    def checkout_kv(self, prompt_ids):
+        """前のターンのKVキャッシュのうち、プロンプトと一致する部分を切り詰めて返す"""
+        from transformers import DynamicCache
+
+        if self.past_key_values is None:
+            return DynamicCache(), 0
+        # 最後のトークンはロジットを得るために必ずプレフィルする
+        past_key_values = self.past_key_values
+        length = min(
+            _common_prefix_length(self.kv_ids, prompt_ids), len(prompt_ids) - 1, past_key_values.get_seq_length()
+        )
+        self.past_key_values, self.kv_ids = None, []
+        if length <= 0:
+            return DynamicCache(), 0
+        past_key_values.crop(length)
+        return past_key_values, length
+
+    def commit(self, tokenizer, messages, prompt_text, prompt_ids, reply, output_ids=None, past_key_values=None):
+        """生成した応答を会話に追加し、会話のテキストとトークン列を更新する"""
+        self.messages = messages + [{"role": "assistant", "content": reply}]
+        text = tokenizer.apply_chat_template(self.messages, tokenize=False)
+        if text.startswith(prompt_text):
+            self.token_ids = prompt_ids + tokenizer(text[len(prompt_text):], add_special_tokens=False)["input_ids"]
+        else:
+            self.token_ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+        self.text = text
+        if past_key_values is not None:
+            # KVはモデルが実際に処理したトークン列（プロンプト + 生成トークン）に対応する
+            self.kv_ids = list(output_ids)
+            self.past_key_values = past_key_values
+        self.turns += 1
+
+
+class ChatSessionStore:
+    """セッションをLRUで保持し、一定時間使われていないセッションを破棄する
+
+    イベントループのスレッドからのみ呼び出される前提のため、ロックは統計の更新にのみ使用します。
+    """
+
+    def __init__(self, idle_ttl_seconds=600, max_sessions=256, keep_kv=True):
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_sessions = max_sessions
+        self.keep_kv = keep_kv  # セッションごとにKVキャッシュを保持するか（メモリを多く使う）
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+        self.prompt_tokens = 0
+        self.reused_tokens = 0  # KVを再利用してプレフィルを省略したトークン数
+        self.incremental_turns = 0  # 差分だけをトークン化できたターン数
+        self.full_turns = 0
+
+    def _evict_idle(self):
+        now = time.time()
+        for session_id, session in list(self._sessions.items()):
+            if session.busy or now - session.last_used <= self.idle_ttl_seconds:
+                continue
+            del self._sessions[session_id]
+            self.expired += 1
+
+    def acquire(self, session_id, model_name):
+        """セッションを取得して使用中にする。IDがない・期限切れの場合は新しいセッションを作成する"""
+        self._evict_idle()
+        session = self._sessions.get(session_id) if session_id else None
+        if session is not None and session.busy:
+            raise SessionBusyError(f"セッション {session.session_id} は前のターンを生成中です")
+        if session is None or session.model_name != model_name:
+            # モデルが変わった場合はトークン列を引き継げないため、同じIDで新しい会話を始める
+            session = ChatSession(session_id or uuid.uuid4().hex, model_name)
+            self._sessions[session.session_id] = session
+            self.created += 1
+            # 上限を超えた分を古い順に追い出す（使用中のセッションと作成したセッションは除く）
+            for old_id in list(self._sessions):
+                if len(self._sessions) <= self.max_sessions:
+                    break
+                if old_id != session.session_id and not self._sessions[old_id].busy:
+                    del self._sessions[old_id]
+                    self.evicted += 1
+        self._sessions.move_to_end(session.session_id)
+        session.busy = True
+        return session
+
+    def release(self, session):
+        session.busy = False
+        session.last_used = time.time()
+
+    def record(self, prompt_tokens, reused_tokens, incremental):
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.reused_tokens += reused_tokens
+            if incremental:
+                self.incremental_turns += 1
+            else:
+                self.full_turns += 1
+
+    def delete(self, session_id):
+        session = self._sessions.get(session_id)
+        if session is None or session.busy:
+            return False
+        del self._sessions[session_id]
+        return True
+
+    def clear_model(self, model_name):
+        """モデルを解放したときに、そのモデルのセッションのKVキャッシュを破棄する"""
+        for session in self._sessions.values():
+            if session.model_name == model_name and not session.busy:
+                session.past_key_values, session.kv_ids = None, []
+
+    def snapshot(self):
+        """統計を辞書形式で返す"""
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "sessions_with_kv": sum(1 for s in self._sessions.values() if s.past_key_values is not None),
+                "keep_kv": self.keep_kv,
+                "idle_ttl_seconds": self.idle_ttl_seconds,
+                "max_sessions": self.max_sessions,
+                "created": self.created,
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "prompt_tokens": self.prompt_tokens,
+                "reused_tokens": self.reused_tokens,
+                "kv_reuse_rate": self.reused_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+                "incremental_turns": self.incremental_turns,
+                "full_turns": self.full_turns,
+            }
@@ -0,0 +1,117 @@
+# coldstart.py
+# 起動時間を短くするためのヘルパー（起動フェーズの計測と、モデルのローカルスナップショットの作成・読み込み）
+#
+# スナップショットの作成（Dockerイメージのビルド時などに1回だけ実行）:
+#   python coldstart.py google/gemma-2-2b-jpn-it ./model_snapshots
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+# スナップショットが揃っているかの判定に使うファイル
+SNAPSHOT_MARKER = "config.json"
+
+
+class StartupTimer:
+    """起動処理をフェーズごとに計測し、プロセス開始（このモジュールの読み込み）からの経過時間とあわせて記録する
+
+    モデルの読み込みは別スレッドで行われるため、記録はロックで保護します。
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self._phases = []  # (フェーズ名, 所要時間(秒), 開始時刻の経過秒)
+        self._milestones = {}  # マイルストーン名 -> 起動からの経過秒
+        self._lock = threading.Lock()
+
+    def record(self, name, duration, started_at=None):
+        """計測済みのフェーズを記録する"""
+        started_at = started_at if started_at is not None else time.perf_counter() - duration
+        with self._lock:
+            self._phases.append((name, duration, started_at - self.started_at))
+
+    @contextmanager
+    def phase(self, name):
+        """with ブロックの所要時間をフェーズとして記録する"""
+        phase_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - phase_start, phase_start)
+
+    def mark(self, name):
+        """起動からの経過時間を記録する（最初の1回のみ）"""
+        with self._lock:
+            self._milestones.setdefault(name, time.perf_counter() - self.started_at)
+
+    def report(self):
+        """フェーズ別の所要時間とマイルストーンを辞書形式で返す"""
+        with self._lock:
+            return {
+                "phases": [
+                    {"name": name, "duration": duration, "started_at": offset}
+                    for name, duration, offset in self._phases
+                ],
+                "milestones": dict(self._milestones),
+                "elapsed": time.perf_counter() - self.started_at,
+            }
+
+    def format_report(self):
+        """ログ出力用に整形したレポートを返す"""
+        report = self.report()
+        lines = ["起動時間の内訳:"]
+        for phase in report["phases"]:
+            lines.append(f"  {phase['name']:<32} {phase['duration']:8.2f}秒 (開始 +{phase['started_at']:.2f}秒)")
+        for name, offset in report["milestones"].items():
+            lines.append(f"  {name:<32} +{offset:.2f}秒")
+        return "\n".join(lines)
+
+
+def snapshot_path(snapshot_root, model_name):
+    """モデル名に対応するスナップショットのディレクトリを返す"""
+    return os.path.join(snapshot_root, model_name.replace("/", "--"))
+
+
+def find_snapshot(snapshot_root, model_name):
+    """作成済みのスナップショットがあればそのパスを、なければNoneを返す"""
+    if not snapshot_root:
+        return None
+    path = snapshot_path(snapshot_root, model_name)
+    if os.path.isfile(os.path.join(path, SNAPSHOT_MARKER)):
+        return path
+    return None
+
+
+def build_snapshot(model_name, snapshot_root, torch_dtype=None):
+    """モデル・トークナイザー・設定をsafetensors形式でローカルに保存し、保存先のパスを返す
+
+    保存したスナップショットはハブのキャッシュを解決せずに読み込め、重みはメモリマップで読み込まれます。
+    書き込み途中のディレクトリを読み込まないよう、一時ディレクトリに保存してから置き換えます。
+    """
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    path = snapshot_path(snapshot_root, model_name)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name, torch_dtype=torch_dtype or torch.bfloat16, low_cpu_mem_usage=True
+    )
+    tokenizer.save_pretrained(tmp_path)
+    model.save_pretrained(tmp_path, safe_serialization=True)
+    os.makedirs(snapshot_root, exist_ok=True)
+    if os.path.isdir(path):
+        import shutil
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    return path
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("使い方: python coldstart.py <モデル名> <スナップショットの保存先>")
+        sys.exit(1)
+    start = time.perf_counter()
+    saved_path = build_snapshot(sys.argv[1], sys.argv[2])
+    print(f"スナップショットを保存しました: {saved_path} ({time.perf_counter() - start:.1f}秒)")
@@ -0,0 +1,226 @@
+# loadtest.py
+# LLM APIサーバーの負荷試験（同時実行数を固定するクローズドループと、ポアソン到着のオープンループ）
+#
+# 使い方:
+#   # 同時に8件ずつ、合計200件のリクエストを送る
+#   python loadtest.py --url http://localhost:8501 --concurrency 8 --requests 200
+#   # 平均5件/秒のポアソン到着で60秒間リクエストを送り、結果をJSONに保存する
+#   python loadtest.py --url http://localhost:8501 --rate 5 --duration 60 --output results.json
+#   # モデルなしでサーバー自体のオーバーヘッドを計測する場合は、サーバーを STUB_MODEL=1 で起動する
+import argparse
+import importlib.util
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_PROMPTS = [
+    "AIについて100文字で教えてください",
+    "日本の首都はどこですか？",
+    "機械学習と深層学習の違いを簡潔に説明してください。",
+    "富士山の高さは何メートルですか？",
+]
+
+
+def load_client_class():
+    """python-client.py のLLMClientを読み込む（ファイル名にハイフンを含むため直接importできない）"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "python-client.py")
+    spec = importlib.util.spec_from_file_location("python_client", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.LLMClient
+
+
+def percentile(sorted_values, q):
+    """ソート済みの値のq分位点を返す（線形補間）"""
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def latency_summary(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 0.5),
+        "p90": percentile(values, 0.9),
+        "p99": percentile(values, 0.99),
+        "max": values[-1],
+    }
+
+
+class LoadTester:
+    """LLMClientでリクエストを送り、1件ごとの結果を記録する
+
+    requests.Sessionはスレッド間で共有しないよう、スレッドごとにクライアントを作成します。
+    """
+
+    def __init__(self, url, prompts, max_new_tokens, do_sample, stream, unique_prompts):
+        self.client_class = load_client_class()
+        self.url = url
+        self.prompts = prompts
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.stream = stream
+        self.unique_prompts = unique_prompts  # 応答キャッシュに当たらないよう、プロンプトに連番を付ける
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.records = []
+
+    def _client(self):
+        if not hasattr(self._local, "client"):
+            self._local.client = self.client_class(self.url)
+        return self._local.client
+
+    def send(self, index, scheduled_at=None):
+        """1件のリクエストを送る。scheduled_atを指定すると、予定時刻からの経過時間をレイテンシとする
+
+        オープンループでは送信が遅れた時間もレイテンシに含めます（協調的な欠落を避けるため）。
+        """
+        prompt = self.prompts[index % len(self.prompts)]
+        if self.unique_prompts:
+            prompt = f"{prompt} (#{index})"
+        started_at = time.perf_counter()
+        origin = scheduled_at if scheduled_at is not None else started_at
+        record = {"index": index, "ok": False, "status": None, "ttft": None, "completion_tokens": None}
+        try:
+            client = self._client()
+            if self.stream:
+                for event, data in client.generate_stream(
+                    prompt, max_new_tokens=self.max_new_tokens, do_sample=self.do_sample
+                ):
+                    if event == "token" and record["ttft"] is None:
+                        record["ttft"] = time.perf_counter() - origin
+                    elif event == "done":
+                        record["completion_tokens"] = data.get("completion_tokens")
+                    elif event == "error":
+                        raise RuntimeError(data.get("detail"))
+            else:
+                client.generate(prompt, max_new_tokens=self.max_new_tokens, do_sample=self.do_sample)
+            record["ok"] = True
+            record["status"] = 200
+        except Exception as e:
+            record["status"] = getattr(e, "status_code", None)  # LLMClientErrorならHTTPステータスを記録する
+            record["error"] = str(e)[:200]
+        finished_at = time.perf_counter()
+        record["latency"] = finished_at - origin
+        record["send_delay"] = started_at - origin
+        record["finished_at"] = finished_at
+        with self._lock:
+            self.records.append(record)
+        return record
+
+    def run_closed_loop(self, concurrency, num_requests):
+        """concurrency個のスレッドが応答を受け取るたびに次のリクエストを送る"""
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(self.send, range(num_requests)))
+
+    def run_open_loop(self, rate, duration, max_inflight, seed):
+        """平均rate件/秒のポアソン到着（指数分布の到着間隔）で、応答を待たずにリクエストを送る"""
+        rng = random.Random(seed)
+        start = time.perf_counter()
+        scheduled_at = start
+        index = 0
+        with ThreadPoolExecutor(max_workers=max_inflight) as executor:
+            while True:
+                scheduled_at += rng.expovariate(rate)
+                if scheduled_at - start > duration:
+                    break
+                delay = scheduled_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self.send, index, scheduled_at)
+                index += 1
+
+    def summary(self, elapsed):
+        """結果を集計する"""
+        records = self.records
+        ok = [r for r in records if r["ok"]]
+        errors_by_status = {}
+        for r in records:
+            if not r["ok"]:
+                key = str(r["status"]) if r["status"] is not None else "exception"
+                errors_by_status[key] = errors_by_status.get(key, 0) + 1
+        tokens = [r["completion_tokens"] for r in ok if r["completion_tokens"] is not None]
+        return {
+            "requests": len(records),
+            "succeeded": len(ok),
+            "errors": len(records) - len(ok),
+            "error_rate": (len(records) - len(ok)) / len(records) if records else 0.0,
+            "errors_by_status": errors_by_status,
+            "elapsed": elapsed,
+            "throughput_rps": len(ok) / elapsed if elapsed > 0 else 0.0,
+            "throughput_tokens_per_sec": sum(tokens) / elapsed if tokens and elapsed > 0 else None,
+            "latency": latency_summary([r["latency"] for r in ok]),
+            "ttft": latency_summary([r["ttft"] for r in ok if r["ttft"] is not None]),
+            "max_send_delay": max((r["send_delay"] for r in records), default=0.0),
+        }
+
+
+def print_summary(summary):
+    print(f"リクエスト数: {summary['requests']} (成功 {summary['succeeded']}, エラー率 {summary['error_rate']:.1%})")
+    if summary["errors_by_status"]:
+        print(f"エラーの内訳: {summary['errors_by_status']}")
+    print(f"スループット: {summary['throughput_rps']:.2f} req/s")
+    if summary["throughput_tokens_per_sec"] is not None:
+        print(f"生成トークン: {summary['throughput_tokens_per_sec']:.1f} tokens/s")
+    for name in ("latency", "ttft"):
+        stats = summary[name]
+        if stats:
+            print(
+                f"{name:>8}: p50 {stats['p50']:.3f}s  p90 {stats['p90']:.3f}s  p99 {stats['p99']:.3f}s"
+                f"  mean {stats['mean']:.3f}s  max {stats['max']:.3f}s"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM APIサーバーの負荷試験")
+    parser.add_argument("--url", default="http://localhost:8501")
+    parser.add_argument("--concurrency", type=int, default=4, help="クローズドループの同時実行数")
+    parser.add_argument("--requests", type=int, default=100, help="クローズドループで送るリクエスト数")
+    parser.add_argument("--rate", type=float, default=None, help="指定するとポアソン到着のオープンループ（件/秒）")
+    parser.add_argument("--duration", type=float, default=60, help="オープンループの実行時間(秒)")
+    parser.add_argument("--max-inflight", type=int, default=256, help="オープンループの同時リクエストの上限")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--greedy", action="store_true", help="do_sample=Falseで送る")
+    parser.add_argument("--stream", action="store_true", help="/generate/stream を使い、最初のトークンまでの時間を計測する")
+    parser.add_argument("--reuse-prompts", action="store_true", help="同じプロンプトを繰り返し送る（応答キャッシュの効果を含めて計測）")
+    parser.add_argument("--prompts-file", default=None, help="1行に1プロンプトのテキストファイル")
+    parser.add_argument("--seed", type=int, default=0, help="到着間隔の乱数シード")
+    parser.add_argument("--output", default=None, help="設定・集計・リクエストごとの結果を保存するJSONファイル")
+    args = parser.parse_args()
+
+    prompts = DEFAULT_PROMPTS
+    if args.prompts_file:
+        with open(args.prompts_file, encoding="utf-8") as f:
+            prompts = [line.strip() for line in f if line.strip()]
+
+    tester = LoadTester(args.url, prompts, args.max_new_tokens, not args.greedy, args.stream, not args.reuse_prompts)
+    start = time.perf_counter()
+    if args.rate:
+        print(f"オープンループ: {args.rate}件/秒 × {args.duration}秒")
+        tester.run_open_loop(args.rate, args.duration, args.max_inflight, args.seed)
+    else:
+        print(f"クローズドループ: 同時実行数 {args.concurrency}, {args.requests}件")
+        tester.run_closed_loop(args.concurrency, args.requests)
+    summary = tester.summary(time.perf_counter() - start)
+    print_summary(summary)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(
+                {"config": vars(args), "summary": summary, "requests": sorted(tester.records, key=lambda r: r["index"])},
+                f, ensure_ascii=False, indent=2,
+            )
+        print(f"結果を {args.output} に保存しました")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# model_loader.py
+# モデルの読み込みとウォームアップをバックグラウンドで1回だけ実行する（single-flight）
+import asyncio
+import time
+
+# 読み込みの状態
+NOT_LOADED = "not_loaded"
+LOADING = "loading"
+WARMING_UP = "warming_up"
+READY = "ready"
+FAILED = "failed"
+
+
+class ModelLoader:
+    """モデルの読み込み状態を管理し、同時に複数の読み込みが走らないようにする
+
+    load_fn は読み込んだモデルを返す（失敗時はNoneを返すか例外を送出する）同期関数、
+    warmup_fn は読み込んだモデルを受け取り短い推論を行う同期関数です。どちらもスレッド上で実行されます。
+    """
+
+    def __init__(self, load_fn, warmup_fn=None, load_executor=None, warmup_executor=None):
+        self.load_fn = load_fn
+        self.warmup_fn = warmup_fn
+        self.load_executor = load_executor  # Noneの場合はイベントループのデフォルトExecutorを使用
+        self.warmup_executor = warmup_executor
+        self.state = NOT_LOADED
+        self.model = None  # 読み込み済みのモデル
+        self.error = None
+        self.load_count = 0
+        self.last_load_duration = None
+        self.last_warmup_duration = None
+        self._task = None
+
+    @property
+    def ready(self):
+        return self.state == READY
+
+    def start(self):
+        """読み込みを開始する。既に読み込み中・読み込み済みの場合は何もしない"""
+        if self.state == READY:
+            return None
+        if self._task is not None and not self._task.done():
+            return self._task  # 実行中の読み込みを共有する
+        self._task = asyncio.get_running_loop().create_task(self._load())
+        return self._task
+
+    async def _load(self):
+        loop = asyncio.get_running_loop()
+        self.state = LOADING
+        self.error = None
+        self.load_count += 1
+        try:
+            load_start = time.perf_counter()
+            loaded = await loop.run_in_executor(self.load_executor, self.load_fn)
+            self.last_load_duration = time.perf_counter() - load_start
+            if loaded is None:
+                raise RuntimeError("モデルの読み込みに失敗しました")
+
+            if self.warmup_fn is not None:
+                self.state = WARMING_UP
+                warmup_start = time.perf_counter()
+                await loop.run_in_executor(self.warmup_executor, self.warmup_fn, loaded)
+                self.last_warmup_duration = time.perf_counter() - warmup_start
+
+            self.model = loaded
+            self.state = READY
+            print(f"モデルの準備が完了しました (読み込み: {self.last_load_duration:.1f}秒)")
+        except Exception as e:
+            self.state = FAILED
+            self.error = str(e)
+            print(f"モデルの準備に失敗しました: {e}")
+
+    def unload(self):
+        """読み込み済みのモデルへの参照を手放し、未読み込みの状態に戻す"""
+        if self._task is not None and not self._task.done():
+            return False  # 読み込み中は解放しない
+        self.model = None
+        self.state = NOT_LOADED
+        return True
+
+    def snapshot(self):
+        """状態を辞書形式で返す"""
+        return {
+            "state": self.state,
+            "error": self.error,
+            "load_count": self.load_count,
+            "load_duration": self.last_load_duration,
+            "warmup_duration": self.last_warmup_duration,
+        }
@@ -0,0 +1,165 @@
+# model_registry.py
+# 複数のモデルを必要に応じて読み込み、メモリ予算を超えたら最も長く使われていないモデルから追い出すレジストリ
+import gc
+import time
+from contextlib import contextmanager
+from model_loader import ModelLoader
+
+
+class _ModelStats:
+    """モデルごとの読み込み・追い出し回数とリクエストのレイテンシ"""
+
+    def __init__(self):
+        self.loads = 0
+        self.evictions = 0
+        self.requests = 0
+        self.total_latency = 0.0
+        self.size_bytes = None  # 読み込み後に計測したメモリ使用量
+        self.last_used = None
+
+    def snapshot(self):
+        return {
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "requests": self.requests,
+            "avg_latency": self.total_latency / self.requests if self.requests else 0.0,
+            "size_bytes": self.size_bytes,
+            "last_used": self.last_used,
+        }
+
+
+class ModelRegistry:
+    """モデル名ごとのModelLoaderを管理し、常駐するモデルの合計サイズを予算内に保つ
+
+    イベントループのスレッドからのみ呼び出される前提のため、ロックは使用しません。
+    推論中のモデルは use() で参照カウントを持ち、追い出しの対象から外します。
+    """
+
+    def __init__(self, model_names, load_fn, warmup_fn=None, size_fn=None,
+                 budget_bytes=0, warmup_executor=None, on_event=None):
+        self.model_names = list(model_names)
+        self.budget_bytes = budget_bytes  # 0の場合は上限なし
+        self.size_fn = size_fn  # 読み込んだモデルのメモリ使用量(バイト)を返す関数
+        self.on_event = on_event  # on_event(イベント名, モデル名) で "load" / "evict" を通知する
+        self._loaders = {
+            name: ModelLoader(
+                lambda name=name: load_fn(name),
+                warmup_fn=warmup_fn,
+                warmup_executor=warmup_executor,
+            )
+            for name in self.model_names
+        }
+        self._stats = {name: _ModelStats() for name in self.model_names}
+        self._in_use = {name: 0 for name in self.model_names}
+        self._watched_tasks = {}  # 完了時のコールバックを登録済みの読み込みタスク
+
+    def __contains__(self, name):
+        return name in self._loaders
+
+    def loader(self, name):
+        return self._loaders[name]
+
+    def is_ready(self, name):
+        return self._loaders[name].ready
+
+    def get(self, name):
+        """常駐しているモデルを返す（推論スレッドから use() の範囲内で呼び出す）"""
+        model = self._loaders[name].model
+        if model is None:
+            raise RuntimeError(f"モデル '{name}' は読み込まれていません")
+        return model
+
+    def resident_bytes(self, exclude=None):
+        """常駐しているモデルの合計サイズを返す"""
+        return sum(
+            self._stats[name].size_bytes or 0
+            for name, loader in self._loaders.items()
+            if name != exclude and loader.model is not None
+        )
+
+    def ensure_loaded(self, name):
+        """モデルが未読み込みなら読み込みを開始する（既に読み込み中なら共有する）"""
+        loader = self._loaders[name]
+        if loader.ready:
+            return None
+        known_size = self._stats[name].size_bytes
+        if known_size:
+            # 以前に計測したサイズが分かる場合は、読み込む前に空きを作る
+            self._evict_until(self.budget_bytes - known_size, exclude=name)
+        task = loader.start()
+        if task is not None and self._watched_tasks.get(name) is not task:
+            self._watched_tasks[name] = task
+            task.add_done_callback(lambda _, name=name: self._on_loaded(name))
+        return task
+
+    def _on_loaded(self, name):
+        loader = self._loaders[name]
+        if not loader.ready:
+            return
+        stats = self._stats[name]
+        stats.loads += 1
+        stats.last_used = time.time()
+        if self.size_fn is not None:
+            stats.size_bytes = self.size_fn(loader.model)
+        if self.on_event is not None:
+            self.on_event("load", name)
+        # 実際のサイズで予算を超えた場合は、他のモデルを追い出す
+        self._evict_until(self.budget_bytes - (stats.size_bytes or 0), exclude=name)
+
+    def _evict_until(self, target_bytes, exclude=None):
+        """他の常駐モデルの合計がtarget_bytes以下になるまで、使われていないモデルを古い順に追い出す"""
+        if self.budget_bytes <= 0:
+            return
+        candidates = sorted(
+            (name for name, loader in self._loaders.items()
+             if name != exclude and loader.model is not None and self._in_use[name] == 0),
+            key=lambda name: self._stats[name].last_used or 0,
+        )
+        for name in candidates:
+            if self.resident_bytes(exclude=exclude) <= target_bytes:
+                break
+            self.evict(name)
+
+    def evict(self, name):
+        """モデルをメモリから解放する"""
+        if self._in_use[name] > 0 or not self._loaders[name].unload():
+            return False
+        self._stats[name].evictions += 1
+        print(f"モデル '{name}' をメモリから解放しました")
+        if self.on_event is not None:
+            self.on_event("evict", name)
+        gc.collect()
+        return True
+
+    @contextmanager
+    def use(self, name):
+        """推論の間モデルを追い出されないように保持し、レイテンシを記録する"""
+        stats = self._stats[name]
+        self._in_use[name] += 1
+        stats.last_used = time.time()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._in_use[name] -= 1
+            stats.requests += 1
+            stats.total_latency += time.perf_counter() - start_time
+            stats.last_used = time.time()
+            # 推論中で追い出せなかったモデルがあれば、ここで予算内に戻す
+            if self.budget_bytes > 0 and self.resident_bytes() > self.budget_bytes:
+                self._evict_until(self.budget_bytes)
+
+    def snapshot(self):
+        """モデルごとの状態と統計を返す"""
+        return {
+            "budget_bytes": self.budget_bytes,
+            "resident_bytes": self.resident_bytes(),
+            "models": {
+                name: {
+                    **self._loaders[name].snapshot(),
+                    **self._stats[name].snapshot(),
+                    "in_use": self._in_use[name],
+                }
+                for name in self.model_names
+            },
+        }
@@ -0,0 +1,150 @@
+# prefix_cache.py
+# 共通のプレフィックス（システム指示やRAGの前置きなど）を持つプロンプト間でKVキャッシュを再利用する
+import copy
+import threading
+from collections import OrderedDict
+
+
+def _common_prefix_length(a, b):
+    """2つのトークン列の共通プレフィックス長を返す"""
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def _cache_nbytes(cache):
+    """DynamicCacheが保持するテンソルの合計バイト数を返す"""
+    if hasattr(cache, "layers"):  # 新しいtransformersではレイヤーごとにkeys/valuesを保持する
+        tensors = [t for layer in cache.layers for t in (getattr(layer, "keys", None), getattr(layer, "values", None))]
+    else:
+        tensors = list(cache.key_cache) + list(cache.value_cache)
+    return sum(t.numel() * t.element_size() for t in tensors if t is not None and hasattr(t, "numel"))
+
+
+class PrefixCache:
+    """最近処理したプロンプトのpast_key_valuesをメモリ上限付きのLRUで保持する
+
+    推論スレッドから呼び出されるため、内部状態はロックで保護します。
+    """
+
+    def __init__(self, max_bytes, min_tokens=16):
+        self.max_bytes = max_bytes
+        self.min_tokens = min_tokens  # これより短い一致は再利用しない（コピーのコストに見合わないため）
+        self._entries = OrderedDict()  # トークン列(tuple) -> (DynamicCache, バイト数)
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.lookups = 0
+        self.hits = 0
+        self.tokens_saved = 0  # 再利用によりプレフィルを省略したトークン数の合計
+        self.tokens_total = 0  # 参照したプロンプトのトークン数の合計
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _find(self, input_ids):
+        """最長の共通プレフィックスを持つエントリとその長さを返す（ロック取得済みで呼び出す）"""
+        best_key, best_length = None, 0
+        for key in self._entries:
+            length = _common_prefix_length(key, input_ids)
+            if length > best_length:
+                best_key, best_length = key, length
+        # 最後のトークンはロジットを得るために必ずプレフィルする
+        best_length = min(best_length, len(input_ids) - 1)
+        if best_length < self.min_tokens:
+            return None, 0
+        return best_key, best_length
+
+    def match_length(self, input_ids):
+        """再利用できるプレフィックスのトークン数を返す（統計は更新しない）"""
+        with self._lock:
+            return self._find(input_ids)[1]
+
+    def _shares_prefix(self, a, b):
+        """aのプレフィルでbのKVを再利用できるだけの共通プレフィックスがあるか"""
+        return min(_common_prefix_length(a, b), len(b) - 1) >= self.min_tokens
+
+    def plan_warmup(self, sequences):
+        """キャッシュにヒットしないプロンプトのトークン列を、1件ずつ推論する順番に分ける
+
+        互いに共通プレフィックスを持つプロンプトの最初の1件（leaders）を先に推論してKVを登録すれば、
+        残り（followers）はそのKVを再利用できます。共通プレフィックスを持たないもの（others）はまとめて推論できます。
+        それぞれ sequences の位置のリストを返します。
+        """
+        leaders, followers, others = [], [], []
+        for i, sequence in enumerate(sequences):
+            if any(self._shares_prefix(sequences[leader], sequence) for leader in leaders):
+                followers.append(i)
+            elif any(self._shares_prefix(sequence, other) for j, other in enumerate(sequences) if j > i):
+                leaders.append(i)
+            else:
+                others.append(i)
+        return leaders, followers, others
+
+    def checkout(self, input_ids):
+        """生成に渡すpast_key_valuesと、再利用したトークン数を返す
+
+        一致するプレフィックスがあればそのKVをコピーして切り詰めたものを、なければ空のキャッシュを返します。
+        """
+        from transformers import DynamicCache  # 起動を速くするため、使用時に読み込む
+
+        with self._lock:
+            self.lookups += 1
+            self.tokens_total += len(input_ids)
+            key, length = self._find(input_ids)
+            if key is None:
+                return DynamicCache(), 0
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.tokens_saved += length
+            source = self._entries[key][0]
+            # 生成中にキャッシュが更新されるため、保存済みのエントリはコピーして渡す
+            past_key_values = copy.deepcopy(source)
+        past_key_values.crop(length)
+        return past_key_values, length
+
+    def commit(self, input_ids, past_key_values):
+        """生成に使ったpast_key_valuesをプロンプト部分だけに切り詰めて保存する"""
+        if past_key_values.get_seq_length() < len(input_ids):
+            return  # モデルが渡したキャッシュを使わなかった場合は保存しない
+        past_key_values.crop(len(input_ids))
+        size = _cache_nbytes(past_key_values)
+        if size > self.max_bytes:
+            return
+        key = tuple(input_ids)
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (past_key_values, size)
+            self.current_bytes += size
+            # 上限を超えた分を古い順に追い出す
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        """全てのエントリを削除する（モデルを解放したときに使用）"""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def snapshot(self):
+        """統計を辞書形式で返す"""
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "min_tokens": self.min_tokens,
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "prefix_tokens_saved": self.tokens_saved,
+                "prompt_tokens_total": self.tokens_total,
+                "evictions": self.evictions,
+            }
@@ -2,9 +2,38 @@
 # このコードは、ngrokで公開されたAPIにアクセスするPythonクライアントの例です
 
 import requests
+import asyncio
 import json
+import random
 import time
 
+# 時間をおいて再試行すれば成功する可能性があるステータスコード（キュー満杯・モデル準備中）
+RETRYABLE_STATUS_CODES = (429, 503)
+
+class LLMClientError(Exception):
+    """APIが200以外を返したときの例外"""
+
+    def __init__(self, status_code, detail, retry_after=None):
+        super().__init__(f"API error: {status_code} - {detail}")
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after  # Retry-Afterヘッダーの秒数（ある場合）
+
+    @property
+    def retryable(self):
+        return self.status_code in RETRYABLE_STATUS_CODES
+
+def _retry_after_seconds(headers):
+    """Retry-Afterヘッダーを秒数として返す（ない・解釈できない場合はNone）"""
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+def _raise_for_status(response):
+    if response.status_code != 200:
+        raise LLMClientError(response.status_code, response.text, _retry_after_seconds(response.headers))
+
 class LLMClient:
     """LLM API クライアントクラス"""
     
@@ -28,7 +57,8 @@ class LLMClient:
         response = self.session.get(f"{self.api_url}/health")
         return response.json()
     
-    def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True):
+    def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True, seed=None, model=None, assisted=None,
+                 deadline_ms=None, profile=None):
         """
         テキスト生成
         
@@ -38,6 +68,11 @@ class LLMClient:
             temperature (float, optional): 温度パラメータ
             top_p (float, optional): top-p サンプリングのパラメータ
             do_sample (bool, optional): サンプリングを行うかどうか
+            seed (int, optional): 乱数シード（指定するとサンプリング結果もサーバーでキャッシュされます）
+            model (str, optional): 使用するモデル名（AVAILABLE_MODELS に含まれるもの。省略時はデフォルトモデル）
+            assisted (bool, optional): ドラフトモデルによる支援付き生成を使うか（省略時はサーバーの設定に従う）
+            deadline_ms (float, optional): 応答までの時間の上限(ミリ秒)。超えると途中までの応答を finish_reason="deadline" で返します
+            profile (str, optional): "1" でフェーズ別の時間とトークン数を結果の profile に含め、"trace" ではサーバーにtorch profilerのトレースも保存します
         
         Returns:
             dict: 生成結果
@@ -49,10 +84,57 @@ class LLMClient:
             "top_p": top_p,
             "do_sample": do_sample
         }
+        if seed is not None:
+            payload["seed"] = seed
+        if model is not None:
+            payload["model"] = model
+        if assisted is not None:
+            payload["assisted"] = assisted
+        if deadline_ms is not None:
+            payload["deadline_ms"] = deadline_ms
         
         start_time = time.time()
         response = self.session.post(
             f"{self.api_url}/generate",
+            json=payload,
+            params={"profile": profile} if profile else None
+        )
+        total_time = time.time() - start_time
+        
+        if response.status_code == 200:
+            result = response.json()
+            result["total_request_time"] = total_time
+            result["request_id"] = response.headers.get("X-Request-ID")  # サーバーのアクセスログと照合するためのID
+            return result
+        else:
+            _raise_for_status(response)
+
+    def generate_batch(self, prompts, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True):
+        """
+        複数プロンプトのテキスト生成
+        
+        Args:
+            prompts (list): プロンプト文字列、または項目ごとのパラメータを含む辞書
+                ({"prompt": ..., "max_new_tokens": ...}) のリスト
+            max_new_tokens (int, optional): 生成する最大トークン数（全項目共通）
+            temperature (float, optional): 温度パラメータ（全項目共通）
+            top_p (float, optional): top-p サンプリングのパラメータ（全項目共通）
+            do_sample (bool, optional): サンプリングを行うかどうか（全項目共通）
+        
+        Returns:
+            dict: 入力と同じ順序の生成結果 (results) と全体の処理時間
+        """
+        payload = {
+            "prompts": prompts,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "do_sample": do_sample
+        }
+        
+        start_time = time.time()
+        response = self.session.post(
+            f"{self.api_url}/generate/batch",
             json=payload
         )
         total_time = time.time() - start_time
@@ -62,7 +144,211 @@ class LLMClient:
             result["total_request_time"] = total_time
             return result
         else:
-            raise Exception(f"API error: {response.status_code} - {response.text}")
+            _raise_for_status(response)
+
+    def generate_stream(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True, deadline_ms=None):
+        """
+        ストリーミングでのテキスト生成
+        
+        Args:
+            prompt (str): プロンプト文字列
+            max_new_tokens (int, optional): 生成する最大トークン数
+            temperature (float, optional): 温度パラメータ
+            top_p (float, optional): top-p サンプリングのパラメータ
+            do_sample (bool, optional): サンプリングを行うかどうか
+            deadline_ms (float, optional): 応答までの時間の上限(ミリ秒)
+        
+        Yields:
+            tuple: (イベント名, データ) の組。トークンごとに "token"、最後に統計を含む "done" が返されます
+        """
+        payload = {
+            "prompt": prompt,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "do_sample": do_sample
+        }
+        if deadline_ms is not None:
+            payload["deadline_ms"] = deadline_ms
+        
+        with self.session.post(f"{self.api_url}/generate/stream", json=payload, stream=True) as response:
+            if response.status_code != 200:
+                _raise_for_status(response)
+            
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    yield event, json.loads(line[len("data:"):].strip())
+
+    def chat(self, message, session_id=None, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True):
+        """
+        セッションを使ったチャット（会話の履歴はサーバー側で保持されます）
+        
+        Args:
+            message (str): ユーザーの発言
+            session_id (str, optional): 前のターンで返されたセッションID（省略時は新しい会話を開始）
+            max_new_tokens (int, optional): 生成する最大トークン数
+            temperature (float, optional): 温度パラメータ
+            top_p (float, optional): top-p サンプリングのパラメータ
+            do_sample (bool, optional): サンプリングを行うかどうか
+        
+        Returns:
+            dict: 生成結果（次のターンで使う session_id を含む）
+        """
+        payload = {
+            "messages": [{"role": "user", "content": message}],
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "do_sample": do_sample
+        }
+        if session_id is not None:
+            payload["session_id"] = session_id
+        
+        response = self.session.post(f"{self.api_url}/chat", json=payload)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            _raise_for_status(response)
+
+class AsyncLLMClient:
+    """asyncio用のLLM API クライアント
+
+    1つのHTTP接続プールを共有し、同時に送信中のリクエスト数を max_inflight 件までに制限します。
+    429 / 503 と接続エラーは、Retry-Afterまたは指数バックオフ（ジッター付き）の時間をおいて再試行します。
+    httpx が必要です（pip install httpx）。
+    """
+    
+    def __init__(self, api_url, max_inflight=8, max_retries=3, backoff_base=0.5, backoff_max=30.0, timeout=300.0):
+        """
+        初期化
+        
+        Args:
+            api_url (str): API のベース URL（ngrok URL）
+            max_inflight (int, optional): 同時に送信するリクエストの最大数
+            max_retries (int, optional): 429 / 503 / 接続エラー時の最大再試行回数
+            backoff_base (float, optional): バックオフの基準時間(秒)。再試行のたびに2倍になる
+            backoff_max (float, optional): バックオフの最大時間(秒)
+            timeout (float, optional): 1リクエストのタイムアウト(秒)
+        """
+        try:
+            import httpx
+        except ImportError as e:
+            raise ImportError("AsyncLLMClient には httpx が必要です。pip install httpx でインストールしてください。") from e
+        
+        self.api_url = api_url.rstrip('/')
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._httpx = httpx
+        self._client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_inflight, max_keepalive_connections=max_inflight),
+        )
+        self._semaphore = asyncio.Semaphore(max_inflight)
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+    
+    async def aclose(self):
+        """接続プールを閉じる"""
+        await self._client.aclose()
+    
+    def _backoff(self, attempt, retry_after=None):
+        """再試行までの待ち時間を返す（Full Jitter。Retry-Afterがあればそれ以上待つ）"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, retry_after + random.uniform(0, self.backoff_base))
+        return delay
+    
+    async def _request(self, method, path, payload=None):
+        """リクエストを送り、レスポンスのJSONを返す。再試行可能なエラーは待ってから再送する"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                # 待機中は同時実行数の枠を他のリクエストに譲る
+                async with self._semaphore:
+                    response = await self._client.request(method, f"{self.api_url}{path}", json=payload)
+                _raise_for_status(response)
+                return response.json()
+            except LLMClientError as e:
+                if not e.retryable or attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._backoff(attempt, e.retry_after))
+            except self._httpx.TransportError:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+    
+    async def health_check(self):
+        """
+        ヘルスチェック
+        
+        Returns:
+            dict: ヘルスチェック結果
+        """
+        return await self._request("GET", "/health")
+    
+    async def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True, seed=None, model=None,
+                       deadline_ms=None):
+        """
+        テキスト生成（引数は LLMClient.generate と同じ）
+        
+        Returns:
+            dict: 生成結果（再試行を含む total_request_time 付き）
+        """
+        payload = {
+            "prompt": prompt,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "do_sample": do_sample
+        }
+        if seed is not None:
+            payload["seed"] = seed
+        if model is not None:
+            payload["model"] = model
+        if deadline_ms is not None:
+            payload["deadline_ms"] = deadline_ms
+        
+        start_time = time.time()
+        result = await self._request("POST", "/generate", payload)
+        result["total_request_time"] = time.time() - start_time
+        return result
+    
+    async def generate_many(self, prompts, return_exceptions=False, **generate_kwargs):
+        """
+        複数のプロンプトを並行して生成し、完了した順に結果を返す
+        
+        同時に送信するのは max_inflight 件までです。
+        
+        Args:
+            prompts (list): プロンプト文字列のリスト
+            return_exceptions (bool, optional): Trueなら失敗したリクエストの例外を結果として返す。Falseなら最初の失敗で残りを取り消して送出する
+            **generate_kwargs: generate() に渡す生成パラメータ
+        
+        Yields:
+            tuple: (入力のインデックス, 生成結果または例外) の組
+        """
+        async def run(index, prompt):
+            try:
+                return index, await self.generate(prompt, **generate_kwargs)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                return index, e
+        
+        tasks = [asyncio.ensure_future(run(index, prompt)) for index, prompt in enumerate(prompts)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
 
 # 使用例
 if __name__ == "__main__":
@@ -79,9 +365,52 @@ if __name__ == "__main__":
     
     # 単一の質問
     print("Simple question:")
-    result = client.generate([
-        {"prompt": "AIについて100文字で教えてください"}
-    ])
+    result = client.generate("AIについて100文字で教えてください")
     print(f"Response: {result['generated_text']}")
     print(f"Model processing time: {result['response_time']:.2f}s")
-    print(f"Total request time: {result['total_request_time']:.2f}s")    
\ No newline at end of file
+    print(f"Total request time: {result['total_request_time']:.2f}s")
+    print()
+    
+    # 複数の質問をまとめて送信
+    print("Batch questions:")
+    result = client.generate_batch([
+        "AIについて100文字で教えてください",
+        {"prompt": "機械学習について50文字で教えてください", "max_new_tokens": 128},
+    ])
+    for item in result["results"]:
+        print(f"[{item['index']}] Response: {item['generated_text']} ({item['response_time']:.2f}s)")
+    print(f"Total request time: {result['total_request_time']:.2f}s")
+    print()
+    
+    # ストリーミング
+    print("Streaming:")
+    for event, data in client.generate_stream("AIについて100文字で教えてください"):
+        if event == "token":
+            print(data["text"], end="", flush=True)
+        elif event == "done":
+            print()
+            print(f"Time to first token: {data['time_to_first_token'] or 0:.2f}s")
+            print(f"Tokens/sec: {data['tokens_per_sec']:.2f}")
+    print()
+    
+    # セッションを使ったチャット（2ターン目は前の会話のトークン列とKVキャッシュを再利用）
+    print("Chat:")
+    result = client.chat("日本の首都はどこですか？")
+    print(f"Response: {result['generated_text']}")
+    result = client.chat("その都市の人口はどれくらいですか？", session_id=result["session_id"])
+    print(f"Response: {result['generated_text']}")
+    print(f"Prompt tokens: {result['prompt_tokens']} (reused: {result['reused_tokens']})")
+    print()
+    
+    # 非同期クライアントで複数の質問を並行して送信（完了した順に表示）
+    async def run_many():
+        async with AsyncLLMClient(NGROK_URL, max_inflight=4) as async_client:
+            prompts = [f"{topic}について50文字で教えてください" for topic in ("AI", "機械学習", "深層学習", "強化学習")]
+            async for index, result in async_client.generate_many(prompts, return_exceptions=True):
+                if isinstance(result, Exception):
+                    print(f"[{index}] Error: {result}")
+                else:
+                    print(f"[{index}] Response: {result['generated_text']} ({result['total_request_time']:.2f}s)")
+    
+    print("Async generate_many:")
+    asyncio.run(run_many())
\ No newline at end of file
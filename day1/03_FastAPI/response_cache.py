@@ -0,0 +1,160 @@
+# response_cache.py
+# 決定的な生成リクエスト（do_sample=False またはシード指定あり）の応答を再利用するためのキャッシュ
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ResponseCache:
+    """バイト数上限付きのLRUキャッシュ（TTLとディスク層は任意）
+
+    イベントループのスレッドからのみ呼び出される前提のため、ロックは使用しません。
+    ディスク層の読み書きはイベントループをブロックしないよう専用のスレッドで行い、
+    ディスク層にあるキーはメモリ上の索引で管理します（索引にないキーはファイルを開かずにミスと判定します）。
+    """
+
+    def __init__(self, max_bytes, ttl_seconds=None, disk_dir=None):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds or None
+        self.disk_dir = disk_dir or None
+        self._entries = OrderedDict()  # key -> (value, created_at, size)
+        self.current_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._disk_keys = set()
+        self._disk_executor = None
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_keys = {name[:-len(".json")] for name in os.listdir(self.disk_dir) if name.endswith(".json")}
+            # スレッドを1つにして、同じキーの書き込みと読み込みの順序を保つ
+            self._disk_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache-disk")
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def make_key(model_name, prompt, params):
+        """モデル名・プロンプト・生成パラメータからキャッシュキーを作成する"""
+        raw = json.dumps(
+            {"model": model_name, "prompt": prompt, "params": params},
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _is_expired(self, created_at):
+        return self.ttl_seconds is not None and time.time() - created_at > self.ttl_seconds
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    async def get(self, key):
+        """キャッシュされた応答を返す。見つからない場合はNone"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, created_at, _ = entry
+            if not self._is_expired(created_at):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self._remove(key)
+            self.expirations += 1
+
+        if key in self._disk_keys:
+            loop = asyncio.get_running_loop()
+            record = await loop.run_in_executor(self._disk_executor, self._read_disk, key)
+            if record is not None and not self._is_expired(record["created_at"]):
+                # ディスク層でヒットしたものはメモリ層に昇格させる
+                self._store(key, record["value"], record["created_at"])
+                self.hits += 1
+                self.disk_hits += 1
+                return record["value"]
+            self._disk_keys.discard(key)
+            if record is not None:
+                self.expirations += 1
+                self._disk_executor.submit(self._remove_disk, key)
+
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """応答をキャッシュに保存する（ディスクへの書き込みは待たない）"""
+        created_at = time.time()
+        if self._store(key, value, created_at) and self.disk_dir:
+            self._disk_keys.add(key)
+            self._disk_executor.submit(self._write_disk, key, value, created_at)
+
+    def close(self):
+        """書き込み待ちの応答をディスクに書き出してから、ディスク層のスレッドを停止する"""
+        if self._disk_executor is not None:
+            self._disk_executor.shutdown(wait=True)
+
+    def _store(self, key, value, created_at):
+        size = len(key) + len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return False  # 単体で上限を超える応答はキャッシュしない
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, created_at, size)
+        self.current_bytes += size
+        # 上限を超えた分を古い順に追い出す
+        while self.current_bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+        return True
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def _read_disk(self, key):
+        """ディスク層のレコードを返す。読めない場合はNone（ディスク層のスレッドで呼び出す）"""
+        try:
+            with open(self._disk_path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _remove_disk(self, key):
+        try:
+            os.remove(self._disk_path(key))
+        except OSError:
+            pass
+
+    def _write_disk(self, key, value, created_at):
+        path = self._disk_path(key)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"value": value, "created_at": created_at}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)  # 書き込み途中のファイルを読まないように置き換える
+        except OSError as e:
+            print(f"キャッシュのディスク書き込みに失敗しました: {e}")
+
+    def snapshot(self):
+        """統計を辞書形式で返す"""
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "disk_dir": self.disk_dir,
+            "disk_entries": len(self._disk_keys),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,60 @@
+# seeding.py
+# シード指定の生成を再現可能にするため、プロセス全体で共有する乱数の状態を使う生成を排他制御する
+import threading
+from contextlib import contextmanager, nullcontext
+
+
+class RandomStateLock:
+    """乱数の状態を使う生成の排他制御
+
+    transformers.set_seed は全スレッドで共有する乱数の状態を設定し、サンプリングはその状態から乱数を取り出します。
+    推論スレッドが複数ある場合、他のスレッドのサンプリングが乱数を取り出すとシード指定の生成の結果が変わるため、
+    シード指定の生成は他のサンプリングと同時に実行しません。シード指定のないサンプリング同士は同時に実行できます。
+    シード指定の生成が待っている間は、新しいサンプリングを開始しません（シード指定の生成が待たされ続けないように）。
+    """
+
+    def __init__(self, set_seed):
+        self.set_seed = set_seed  # 乱数のシードを設定する関数
+        self._condition = threading.Condition()
+        self._sampling = 0  # 実行中のシード指定のないサンプリングの数
+        self._seeded = False  # シード指定の生成を実行中か
+        self._seeded_waiting = 0
+
+    @contextmanager
+    def seeded(self, seed):
+        """シードを設定し、終わるまで他のサンプリングを実行させない"""
+        with self._condition:
+            self._seeded_waiting += 1
+            while self._seeded or self._sampling:
+                self._condition.wait()
+            self._seeded_waiting -= 1
+            self._seeded = True
+        try:
+            self.set_seed(seed)
+            yield
+        finally:
+            with self._condition:
+                self._seeded = False
+                self._condition.notify_all()
+
+    @contextmanager
+    def sampling(self):
+        """シード指定のないサンプリングの間、シード指定の生成を実行させない"""
+        with self._condition:
+            while self._seeded or self._seeded_waiting:
+                self._condition.wait()
+            self._sampling += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._sampling -= 1
+                self._condition.notify_all()
+
+    def guard(self, do_sample, seed=None):
+        """生成の引数に応じたコンテキストマネージャーを返す（貪欲法は乱数を使わないため排他制御しない）"""
+        if seed is not None:
+            return self.seeded(seed)
+        if do_sample:
+            return self.sampling()
+        return nullcontext()
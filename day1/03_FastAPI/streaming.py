@@ -0,0 +1,164 @@
+# streaming.py
+# 生成されたトークンをデコードされた順にServer-Sent Events (SSE) で送信するためのヘルパー
+import asyncio
+import json
+import time
+from contextlib import nullcontext
+from functools import lru_cache
+
+
+def sse_event(event, data):
+    """SSE形式のイベント文字列を作成する"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class PhaseTimer:
+    """generate()にストリーマーとして渡し、トークン化・プレフィル・デコードの境界時刻を記録する
+
+    generate()は最初にプロンプトのトークン列を、その後は生成したトークンを1ステップごとに put() に渡します。
+    transformersのBaseStreamerと同じ put() / end() を持つため、起動時にtransformersを読み込まずに定義できます。
+    pad_token_id を指定すると、バッチの行ごとの生成トークン数（生成を終えた行に詰められるパディングを除く）を row_completion_tokens に記録します。
+    """
+
+    def __init__(self, pad_token_id=None):
+        self.created_at = time.perf_counter()
+        self.started_at = self.created_at  # トークン化の開始（start()で推論スレッド上の開始時刻に更新できる）
+        self.prompt_at = None  # generate()の開始（プレフィルの開始）
+        self.first_token_at = None  # 最初のトークンの生成（デコードの開始）
+        self.finished_at = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.pad_token_id = pad_token_id
+        self.row_completion_tokens = None
+
+    def start(self):
+        """推論スレッドで処理を始めた時刻を記録する（作成からの差がキュー待ち時間になる）"""
+        self.started_at = time.perf_counter()
+
+    @property
+    def queue_wait(self):
+        return self.started_at - self.created_at
+
+    def put(self, value):
+        now = time.perf_counter()
+        if self.prompt_at is None:
+            self.prompt_at = now
+            self.prompt_tokens = value.numel()
+            if self.pad_token_id is not None:
+                self.row_completion_tokens = [0] * (value.shape[0] if value.dim() > 1 else 1)
+            return
+        if self.first_token_at is None:
+            self.first_token_at = now
+        self.completion_tokens += value.numel()
+        if self.row_completion_tokens is not None:
+            rows = value.reshape(len(self.row_completion_tokens), -1)
+            for row, count in enumerate((rows != self.pad_token_id).sum(dim=1).tolist()):
+                self.row_completion_tokens[row] += count
+
+    def end(self):
+        self.finished_at = time.perf_counter()
+
+    def phases(self, extracted_at=None):
+        """各フェーズの所要時間(秒)を返す。extracted_atは応答の抽出が終わった時刻"""
+        prompt_at = self.prompt_at or self.started_at
+        finished_at = self.finished_at or time.perf_counter()
+        first_token_at = self.first_token_at or finished_at
+        return {
+            "tokenization": prompt_at - self.started_at,
+            "prefill": first_token_at - prompt_at,
+            "decode": finished_at - first_token_at,
+            "extraction": (extracted_at - finished_at) if extracted_at else 0.0,
+        }
+
+
+@lru_cache(maxsize=None)
+def async_text_streamer_class():
+    """AsyncTextStreamerクラスを返す（起動を速くするため、transformersは最初のストリーミング時に読み込む）"""
+    from transformers import TextStreamer
+
+    class AsyncTextStreamer(TextStreamer):
+        """推論スレッドでデコードされたテキストをイベントループのasyncio.Queueへ渡すストリーマー"""
+
+        def __init__(self, tokenizer, loop, timer=None, **decode_kwargs):
+            super().__init__(tokenizer, skip_prompt=True, **decode_kwargs)
+            self.loop = loop
+            self.queue = asyncio.Queue()
+            self.timer = timer  # フェーズの計測用（任意）
+            self.completion_tokens = 0
+            self.first_token_at = None
+
+        def put(self, value):
+            """トークンを受け取るたびに生成トークン数と最初のトークンの時刻を記録する"""
+            if self.timer is not None:
+                self.timer.put(value)
+            if not (self.skip_prompt and self.next_tokens_are_prompt):
+                if self.first_token_at is None:
+                    self.first_token_at = time.perf_counter()
+                self.completion_tokens += value.numel()
+            super().put(value)
+
+        def end(self):
+            if self.timer is not None:
+                self.timer.end()
+            super().end()
+
+        def on_finalized_text(self, text, stream_end=False):
+            """デコード済みテキストをスレッドセーフにキューへ追加する"""
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, (text, stream_end))
+
+    return AsyncTextStreamer
+
+
+async def stream_generation(
+    pipe, prompt, generate_kwargs, executor, prefix_cache=None, timer=None, finish_reason=None, guard=None
+):
+    """プロンプトから生成を行い、トークンごとのSSEイベントと最終統計イベントを順に返す
+
+    finish_reason は生成トークン数から終了理由を返す関数で、指定すると done イベントに含めます。
+    guard は推論スレッドで生成を囲むコンテキストマネージャー（乱数の状態の排他制御など）です。
+    """
+    loop = asyncio.get_running_loop()
+    streamer = async_text_streamer_class()(pipe.tokenizer, loop, timer=timer, skip_special_tokens=True)
+    started_at = time.perf_counter()
+
+    def run():
+        if timer is not None:
+            timer.start()
+        inputs = pipe.tokenizer(prompt, return_tensors="pt").to(pipe.model.device)
+        try:
+            with guard if guard is not None else nullcontext():
+                if prefix_cache is not None and prefix_cache.enabled:
+                    # 共通プレフィックスのKVを再利用し、異なる最初のトークンからプレフィルする
+                    input_ids = inputs["input_ids"][0].tolist()
+                    past_key_values, _ = prefix_cache.checkout(input_ids)
+                    pipe.model.generate(**inputs, streamer=streamer, past_key_values=past_key_values, **generate_kwargs)
+                    prefix_cache.commit(input_ids, past_key_values)
+                else:
+                    pipe.model.generate(**inputs, streamer=streamer, **generate_kwargs)
+        except Exception:
+            # 例外時もストリームを終了させ、呼び出し側で例外を受け取れるようにする
+            streamer.on_finalized_text("", stream_end=True)
+            raise
+
+    generation = loop.run_in_executor(executor, run)
+    while True:
+        text, stream_end = await streamer.queue.get()
+        if text:
+            yield sse_event("token", {"text": text})
+        if stream_end:
+            break
+    await generation  # 推論中の例外をここで送出する
+    reason = finish_reason(streamer.completion_tokens) if finish_reason is not None else None
+
+    finished_at = time.perf_counter()
+    total_time = finished_at - started_at
+    ttft = (streamer.first_token_at - started_at) if streamer.first_token_at else None
+    # 生成速度はデコードの時間で割る（非ストリーミングのプロファイルと揃える）
+    decode_time = (finished_at - streamer.first_token_at) if streamer.first_token_at else 0.0
+    yield sse_event("done", {
+        "time_to_first_token": ttft,
+        "completion_tokens": streamer.completion_tokens,
+        "tokens_per_sec": streamer.completion_tokens / decode_time if decode_time > 0 else 0.0,
+        "response_time": total_time,
+        **({"finish_reason": reason} if reason is not None else {}),
+    })
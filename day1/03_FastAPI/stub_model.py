@@ -0,0 +1,71 @@
+# stub_model.py
+# transformersのpipelineの代わりに使う決定的なスタブモデル（GPUやモデルの重みなしでサーバー自体のオーバーヘッドを計測するため）
+import hashlib
+import time
+
+# 応答の生成に使う語彙（プロンプトのハッシュから決定的に選ぶ）
+_WORDS = ["これは", "スタブ", "モデル", "の", "応答", "です", "。", "テスト", "用", "に", "生成", "した", "文章", "、"]
+
+
+class _StubTokens:
+    """PhaseTimerなどのストリーマーに渡すトークン列の代わり（numel()のみ実装）"""
+
+    def __init__(self, count):
+        self.count = count
+
+    def numel(self):
+        return self.count
+
+
+class _StubModel:
+    """model_nbytesなどから参照されるモデルの代わり"""
+
+    device = "cpu"
+
+    def state_dict(self):
+        return {}
+
+
+class StubPipeline:
+    """text-generationパイプラインと同じ呼び出し方で、一定の遅延のあとに決定的な応答を返す
+
+    プレフィルにprefill_ms、1ステップごとにtoken_msだけ待ちます。バッチで呼び出した場合もステップごとの待ち時間は同じため、
+    GPUでのバッチ推論のように1件あたりのコストが下がります。
+    """
+
+    def __init__(self, prefill_ms=20.0, token_ms=5.0, max_tokens=32):
+        self.prefill_ms = prefill_ms
+        self.token_ms = token_ms
+        self.max_tokens = max_tokens
+        self.model = _StubModel()
+        self.tokenizer = None  # トークナイザーを使う機能（プレフィックスキャッシュ、/chat、ストリーミング）は使用できない
+
+    def _reply(self, prompt, n_tokens):
+        digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+        return "".join(_WORDS[digest[i % len(digest)] % len(_WORDS)] for i in range(n_tokens))
+
+    def __call__(self, prompts, max_new_tokens=256, streamer=None, batch_size=None, stopping_criteria=None,
+                 **generate_kwargs):
+        single = isinstance(prompts, str)
+        prompts = [prompts] if single else list(prompts)
+        n_tokens = max(1, min(max_new_tokens, self.max_tokens))
+
+        if streamer is not None:
+            streamer.put(_StubTokens(sum(len(prompt) for prompt in prompts)))
+        time.sleep(self.prefill_ms / 1000)
+        generated = 0
+        while generated < n_tokens:
+            # generate()と同じく、全ての行が取り消されたらステップの間で終了する
+            if stopping_criteria and any(criteria.all_cancelled() for criteria in stopping_criteria):
+                break
+            time.sleep(self.token_ms / 1000)
+            generated += 1
+            if streamer is not None:
+                streamer.put(_StubTokens(len(prompts)))
+        if streamer is not None:
+            streamer.end()
+        n_tokens = max(1, generated)
+
+        # パイプラインと同じく、プロンプトに続けて生成したテキストを返す
+        outputs = [[{"generated_text": prompt + self._reply(prompt, n_tokens)}] for prompt in prompts]
+        return outputs[0] if single else outputs
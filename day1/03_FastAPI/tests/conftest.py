@@ -0,0 +1,5 @@
+import os
+import sys
+
+# テスト対象のモジュール（03_FastAPI直下）をimportできるようにする
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
@@ -0,0 +1,39 @@
+import json
+
+from access_log import AccessLogger
+
+
+def test_body_fields_without_sampling_records_only_lengths():
+    logger = AccessLogger("", max_body_chars=3)
+    assert logger.body_fields(False, prompt="hello", response=None) == {"prompt_chars": 5}
+
+
+def test_body_fields_truncates_sampled_bodies():
+    logger = AccessLogger("", max_body_chars=3)
+    assert logger.body_fields(True, prompt="hello", response="ok") == {
+        "prompt_chars": 5,
+        "prompt": "hel",
+        "prompt_truncated": True,
+        "response_chars": 2,
+        "response": "ok",
+    }
+
+
+def test_log_writes_one_json_line_per_record(tmp_path):
+    path = tmp_path / "access.jsonl"
+    logger = AccessLogger(str(path))
+    logger.log({"path": "/ignored"})  # 開始前のレコードは捨てる
+    logger.start()
+    logger.log({"path": "/generate", "status": 200})
+    logger.log({"path": "/health", "status": 200})
+    logger.stop()  # キューに残ったレコードを書き出す
+    records = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    assert [record["path"] for record in records] == ["/generate", "/health"]
+    assert all("ts" in record for record in records)
+
+
+def test_disabled_logger_does_nothing():
+    logger = AccessLogger("")
+    logger.start()
+    logger.log({"path": "/generate"})
+    assert logger.snapshot()["path"] is None
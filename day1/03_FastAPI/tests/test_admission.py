@@ -0,0 +1,72 @@
+import pytest
+
+from admission import AdmissionController, DeadlineUnreachableError, ServerBusyError
+from batching import BatchScheduler
+
+
+def test_acquire_rejects_when_full():
+    admission = AdmissionController(2, estimate_wait=lambda: 2.4)
+    admission.acquire(2)
+    with pytest.raises(ServerBusyError) as excinfo:
+        admission.acquire()
+    assert excinfo.value.retry_after == 3  # 推定待ち時間の切り上げ
+    assert admission.snapshot()["rejected_total"] == 1
+    admission.release(2)
+    admission.acquire()
+    assert admission.pending == 1
+
+
+def test_admit_releases_on_exception():
+    admission = AdmissionController(1)
+    with pytest.raises(ValueError):
+        with admission.admit():
+            assert admission.pending == 1
+            raise ValueError
+    assert admission.pending == 0
+
+
+def test_slot_is_released_only_once():
+    """ストリーミングのように解放の経路が複数あっても、枠は1回だけ解放される"""
+    admission = AdmissionController(1)
+    slot = admission.slot()
+    assert admission.pending == 1
+    slot.release()  # 本文のジェネレーターの finally
+    slot.release()  # レスポンスの送信処理の終了時
+    assert admission.pending == 0
+    # 解放した枠は次のリクエストが使える
+    admission.slot().release()
+    assert admission.pending == 0
+
+
+def test_slot_raises_when_full():
+    admission = AdmissionController(1)
+    admission.slot()
+    with pytest.raises(ServerBusyError):
+        admission.slot()
+    assert admission.pending == 1
+
+
+def test_deadline_is_accepted_on_idle_server():
+    """サーバーが空いていれば、平均の生成時間より短い締め切りでも受け付ける（締め切りで途中までの応答を返す）"""
+    scheduler = BatchScheduler(lambda key, payloads: payloads, max_batch_size=4)
+    scheduler.stats.record_duration(3.0)
+    admission = AdmissionController(10, estimate_wait=scheduler.estimate_wait)
+    admission.check_deadline(1.0)
+    assert admission.snapshot()["deadline_rejected_total"] == 0
+
+
+def test_deadline_is_rejected_when_queue_wait_exceeds_budget():
+    scheduler = BatchScheduler(lambda key, payloads: payloads, max_batch_size=1)
+    scheduler.stats.record_duration(3.0)
+    scheduler._pending["k"] = [object()]
+    admission = AdmissionController(10, estimate_wait=scheduler.estimate_wait)
+    with pytest.raises(DeadlineUnreachableError) as excinfo:
+        admission.check_deadline(1.0)
+    assert excinfo.value.estimated_wait == pytest.approx(3.0)
+    assert excinfo.value.budget == 1.0
+    assert admission.snapshot()["deadline_rejected_total"] == 1
+
+
+def test_no_deadline_is_never_rejected():
+    admission = AdmissionController(10, estimate_wait=lambda: 100.0)
+    admission.check_deadline(None)
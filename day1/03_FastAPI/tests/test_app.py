@@ -0,0 +1,114 @@
+# app.py のアドミッション制御と締め切りの判定（fastapiがない環境ではスキップする）
+import asyncio
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")  # TestClient が使用する
+os.environ["STUB_MODEL"] = "1"  # モデルを読み込まない
+
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import app as server
+from cancellation import CancellationToken
+
+
+@pytest.fixture(autouse=True)
+def reset_state():
+    server.scheduler.stats.batch_duration_samples.clear()
+    server.scheduler._pending.clear()
+    server.admission.pending = 0
+    yield
+    server.scheduler._pending.clear()
+
+
+def fake_request():
+    """annotate() が記録するアクセスログの項目だけを持つリクエストの代わり"""
+    return SimpleNamespace(state=SimpleNamespace(access={}))
+
+
+def test_deadline_shorter_than_generation_is_accepted_on_idle_server():
+    server.scheduler.stats.record_duration(3.0)
+    token = CancellationToken(deadline=time.perf_counter() + 1.0)
+    server.check_deadline(token, fake_request())
+
+
+def test_unreachable_deadline_is_rejected_without_retry_after():
+    server.scheduler.stats.record_duration(3.0)
+    server.scheduler._pending["k"] = [object()] * server.scheduler.max_batch_size
+    token = CancellationToken(deadline=time.perf_counter() + 1.0)
+    request = fake_request()
+    with pytest.raises(HTTPException) as excinfo:
+        server.check_deadline(token, request)
+    assert excinfo.value.status_code == 503
+    assert not (excinfo.value.headers or {}).get("Retry-After")
+    assert request.state.access["rejected"] == "deadline_unreachable"
+
+
+def test_stream_validation_error_does_not_leak_admission_slot(monkeypatch):
+    """assisted=true でドラフトモデルがない場合の400で、枠が解放されずに残らない"""
+    monkeypatch.setattr(server, "require_real_model", lambda: None)
+    monkeypatch.setattr(server, "require_model_ready", lambda model_name: None)
+    client = TestClient(server.app)
+    for _ in range(server.config.MAX_QUEUE_SIZE + 1):
+        response = client.post("/generate/stream", json={"prompt": "hi", "assisted": True})
+        assert response.status_code == 400
+    assert server.admission.pending == 0
+
+
+def test_stream_slot_is_released_when_body_never_starts():
+    """ヘッダーの送信前にクライアントが切断し、本文のジェネレーターが開始されなくても枠を解放する"""
+    started = []
+
+    async def body():
+        started.append(True)
+        yield b"data: {}\n\n"
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        raise OSError("client disconnected")
+
+    slot = server.admission.slot()
+    response = server.AdmittedStreamingResponse(body(), slot, media_type="text/event-stream")
+    scope = {"type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "method": "POST", "headers": []}
+    with pytest.raises(Exception):
+        asyncio.run(response(scope, receive, send))
+    assert not started
+    assert slot.released
+    assert server.admission.pending == 0
+
+
+def test_stream_access_log_is_written_when_body_never_starts(monkeypatch):
+    """本文のジェネレーターが開始されず、その finally でアクセスログを書けない場合も1行を書く"""
+    records = []
+    monkeypatch.setattr(server.access_log, "log", records.append)
+
+    async def body():
+        yield b"data: {}\n\n"
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        raise OSError("client disconnected")
+
+    http_request = SimpleNamespace(
+        scope={},
+        method="POST",
+        url=SimpleNamespace(path="/generate/stream"),
+        client=None,
+        state=SimpleNamespace(request_id="r1", started_at=time.perf_counter(), access={}, stream_started=False),
+    )
+    response = server.AdmittedStreamingResponse(body(), server.admission.slot(), http_request, media_type="text/event-stream")
+    scope = {"type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "method": "POST", "headers": []}
+    with pytest.raises(Exception):
+        asyncio.run(response(scope, receive, send))
+    assert [(record["request_id"], record["status"], record["cancelled"]) for record in records] == [
+        ("r1", 499, "client_disconnected")
+    ]
@@ -0,0 +1,176 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from batching import BatchScheduler
+
+
+def run_scheduler(coro_factory, run_batch, **kwargs):
+    """スケジューラを開始してからcoro_factory(scheduler)を実行し、停止する"""
+
+    async def main():
+        scheduler = BatchScheduler(run_batch, **kwargs)
+        scheduler.start()
+        try:
+            return await coro_factory(scheduler)
+        finally:
+            await scheduler.stop()
+
+    return asyncio.run(main())
+
+
+def test_requests_within_window_are_batched():
+    """時間窓の中で届いた同じキーのリクエストは1回の推論にまとめられる"""
+    batches = []
+
+    def run_batch(key, payloads):
+        batches.append((key, list(payloads)))
+        return [payload * 2 for payload in payloads]
+
+    async def scenario(scheduler):
+        return await asyncio.gather(*(scheduler.submit("k", i) for i in range(3)))
+
+    results = run_scheduler(scenario, run_batch, window_ms=50, max_batch_size=8)
+    assert results == [0, 2, 4]
+    assert batches == [("k", [0, 1, 2])]
+
+
+def test_max_batch_size_splits_batches():
+    """最大バッチサイズを超えた分は次のバッチになる"""
+    sizes = []
+
+    def run_batch(key, payloads):
+        sizes.append(len(payloads))
+        return payloads
+
+    async def scenario(scheduler):
+        return await asyncio.gather(*(scheduler.submit("k", i) for i in range(5)))
+
+    results = run_scheduler(scenario, run_batch, window_ms=50, max_batch_size=2)
+    assert results == [0, 1, 2, 3, 4]
+    assert sizes == [2, 2, 1]
+
+
+def test_different_keys_are_not_mixed():
+    """生成パラメータ（キー）が異なるリクエストは別のバッチになる"""
+    batches = []
+
+    def run_batch(key, payloads):
+        batches.append((key, list(payloads)))
+        return payloads
+
+    async def scenario(scheduler):
+        return await asyncio.gather(scheduler.submit("a", 1), scheduler.submit("b", 2), scheduler.submit("a", 3))
+
+    run_scheduler(scenario, run_batch, window_ms=50, max_batch_size=8)
+    assert sorted(batches) == [("a", [1, 3]), ("b", [2])]
+
+
+def test_batch_exception_is_propagated_to_every_request():
+    def run_batch(key, payloads):
+        raise RuntimeError("boom")
+
+    async def scenario(scheduler):
+        return await asyncio.gather(
+            scheduler.submit("k", 1), scheduler.submit("k", 2), return_exceptions=True
+        )
+
+    results = run_scheduler(scenario, run_batch, window_ms=10)
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_stats_record_batch_sizes_and_queue_waits():
+    def run_batch(key, payloads):
+        return payloads
+
+    async def scenario(scheduler):
+        await asyncio.gather(*(scheduler.submit("k", i) for i in range(3)))
+        return scheduler.stats.snapshot()
+
+    snapshot = run_scheduler(scenario, run_batch, window_ms=20, max_batch_size=8)
+    assert snapshot["total_requests"] == 3
+    assert snapshot["total_batches"] == 1
+    assert snapshot["batch_size_counts"] == {3: 1}
+    # 最初のリクエストは時間窓の分だけ待つ
+    assert snapshot["queue_wait_ms"]["max"] >= 15
+
+
+def test_batches_run_concurrently_up_to_max_concurrent_batches():
+    running = []
+    max_running = []
+    lock = threading.Lock()
+
+    def run_batch(key, payloads):
+        with lock:
+            running.append(key)
+            max_running.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(key)
+        return payloads
+
+    async def scenario(scheduler):
+        return await asyncio.gather(*(scheduler.submit(key, key) for key in "abcd"))
+
+    results = run_scheduler(scenario, run_batch, window_ms=0, max_batch_size=1, max_concurrent_batches=2)
+    assert results == list("abcd")
+    assert max(max_running) == 2
+
+
+def test_submit_before_start_raises():
+    scheduler = BatchScheduler(lambda key, payloads: payloads)
+    with pytest.raises(RuntimeError):
+        asyncio.run(scheduler.submit("k", 1))
+
+
+def test_estimate_wait_is_zero_on_idle_server():
+    """何も実行していなければ、平均バッチ時間が長くても待ち時間は0と推定する"""
+    scheduler = BatchScheduler(lambda key, payloads: payloads, max_batch_size=4)
+    scheduler.stats.record_duration(3.0)
+    assert scheduler.estimate_wait() == 0.0
+
+
+def test_estimate_wait_counts_full_batches_queued_ahead():
+    scheduler = BatchScheduler(lambda key, payloads: payloads, max_batch_size=2)
+    scheduler.stats.record_duration(3.0)
+    # 新しいリクエストは埋まっていないバッチに加わるため、埋まったバッチの数だけ待つ
+    scheduler._pending["k"] = [object()] * 5
+    assert scheduler.estimate_wait() == pytest.approx(2 * 3.0)
+
+
+def test_estimate_wait_counts_remaining_time_of_running_batch():
+    started = threading.Event()
+    release = threading.Event()
+
+    def run_batch(key, payloads):
+        started.set()
+        release.wait(5)
+        return payloads
+
+    async def scenario(scheduler):
+        scheduler.stats.record_duration(1.0)
+        task = asyncio.ensure_future(scheduler.submit("k", 1))
+        while not started.is_set():
+            await asyncio.sleep(0.005)
+        await asyncio.sleep(0.2)
+        during = scheduler.estimate_wait()
+        release.set()
+        await task
+        return during, scheduler.estimate_wait()
+
+    during, after = run_scheduler(scenario, run_batch, window_ms=0)
+    assert 0.0 < during <= 0.8 + 0.05
+    assert after == 0.0
+
+
+def test_estimate_wait_spreads_queued_batches_over_concurrent_slots():
+    scheduler = BatchScheduler(lambda key, payloads: payloads, max_batch_size=2, max_concurrent_batches=2)
+    scheduler.stats.record_duration(3.0)
+    now = time.perf_counter()
+    scheduler._running_since = [now - 1.0]  # 1つの枠は残り約2秒、もう1つの枠は空いている
+    assert scheduler.estimate_wait() == 0.0
+    # 埋まったバッチ2つは空いている枠（3秒後に空く）と実行中の枠（約5秒後に空く）に入る
+    scheduler._pending["k"] = [object()] * 4
+    assert scheduler.estimate_wait() == pytest.approx(3.0, abs=0.05)
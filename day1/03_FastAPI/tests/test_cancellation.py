@@ -0,0 +1,102 @@
+import asyncio
+import time
+
+import pytest
+
+from cancellation import (
+    CLIENT_DISCONNECTED,
+    DEADLINE_EXCEEDED,
+    SERVER_CANCELLED,
+    CancellationCriteria,
+    CancellationRegistry,
+    CancellationToken,
+)
+
+
+class DisconnectingRequest:
+    """is_disconnected() だけを持つリクエストの代わり（指定回数の確認の後に切断する）"""
+
+    def __init__(self, disconnect_after):
+        self.checks = 0
+        self.disconnect_after = disconnect_after
+
+    async def is_disconnected(self):
+        self.checks += 1
+        return self.checks > self.disconnect_after
+
+
+def test_first_cancel_reason_wins():
+    token = CancellationToken()
+    assert not token.cancelled
+    token.cancel(CLIENT_DISCONNECTED)
+    token.cancel(SERVER_CANCELLED)
+    assert token.cancelled
+    assert token.reason == CLIENT_DISCONNECTED
+
+
+def test_deadline_cancels_token():
+    token = CancellationToken(deadline=time.perf_counter() + 0.01)
+    assert not token.cancelled
+    assert 0 < token.remaining() <= 0.01
+    time.sleep(0.02)
+    assert token.cancelled
+    assert token.reason == DEADLINE_EXCEEDED
+
+
+def test_remaining_without_deadline_is_none():
+    assert CancellationToken().remaining() is None
+
+
+def test_criteria_all_cancelled():
+    tokens = [CancellationToken(), CancellationToken()]
+    criteria = CancellationCriteria(tokens)
+    tokens[0].cancel()
+    assert not criteria.all_cancelled()
+    tokens[1].cancel()
+    assert criteria.all_cancelled()
+
+
+def test_watch_cancels_tokens_when_client_disconnects():
+    registry = CancellationRegistry(poll_interval=0.01)
+    token = CancellationToken()
+
+    async def scenario():
+        async with registry.watch(DisconnectingRequest(disconnect_after=2), [token]):
+            assert registry.active == 1
+            while not token.cancelled:
+                await asyncio.sleep(0.01)
+        return registry.active
+
+    assert asyncio.run(scenario()) == 0
+    assert token.reason == CLIENT_DISCONNECTED
+
+
+def test_watch_cancels_tokens_when_handler_is_cancelled():
+    registry = CancellationRegistry(poll_interval=0.01)
+    token = CancellationToken()
+
+    async def handler():
+        async with registry.watch(None, [token]):
+            await asyncio.sleep(10)
+
+    async def scenario():
+        task = asyncio.ensure_future(handler())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+    assert token.reason == SERVER_CANCELLED
+
+
+def test_cancel_all_cancels_active_tokens():
+    registry = CancellationRegistry()
+    tokens = [CancellationToken(), CancellationToken()]
+
+    async def scenario():
+        async with registry.watch(None, tokens):
+            registry.cancel_all()
+
+    asyncio.run(scenario())
+    assert all(token.reason == SERVER_CANCELLED for token in tokens)
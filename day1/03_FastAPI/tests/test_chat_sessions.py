@@ -0,0 +1,58 @@
+import pytest
+
+from chat_sessions import ChatSessionStore, SessionBusyError
+
+
+def test_new_session_is_created_and_reused():
+    store = ChatSessionStore()
+    session = store.acquire(None, "m")
+    store.release(session)
+    assert store.acquire(session.session_id, "m") is session
+    assert store.snapshot()["created"] == 1
+
+
+def test_busy_session_is_rejected():
+    store = ChatSessionStore()
+    session = store.acquire(None, "m")
+    with pytest.raises(SessionBusyError):
+        store.acquire(session.session_id, "m")
+    assert not store.delete(session.session_id)  # 使用中のセッションは削除しない
+
+
+def test_model_change_starts_new_conversation():
+    store = ChatSessionStore()
+    session = store.acquire("s", "m1")
+    session.messages.append({"role": "user", "content": "hi"})
+    store.release(session)
+    renewed = store.acquire("s", "m2")
+    assert renewed is not session
+    assert renewed.session_id == "s"
+    assert renewed.messages == []
+
+
+def test_idle_sessions_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("chat_sessions.time.time", lambda: now[0])
+    store = ChatSessionStore(idle_ttl_seconds=10)
+    session = store.acquire(None, "m")
+    store.release(session)
+    now[0] += 20
+    assert store.acquire(session.session_id, "m") is not session
+    assert store.snapshot()["expired"] == 1
+
+
+def test_lru_eviction_skips_busy_sessions():
+    store = ChatSessionStore(max_sessions=2)
+    busy = store.acquire("busy", "m")
+    idle = store.acquire("idle", "m")
+    store.release(idle)
+    store.acquire("new", "m")
+    snapshot = store.snapshot()
+    assert snapshot["sessions"] == 2
+    assert snapshot["evicted"] == 1
+    assert busy.busy
+    # 追い出されたため新しいセッションになる。他が全て使用中なら、作成したセッション自体は追い出さない
+    renewed = store.acquire("idle", "m")
+    assert renewed is not idle
+    assert renewed.busy
+    assert store.snapshot()["sessions"] == 3
@@ -0,0 +1,60 @@
+from prefix_cache import PrefixCache, _common_prefix_length
+
+
+class FakeCache:
+    """DynamicCacheの代わり（commit() が使う get_seq_length() / crop() と空の layers のみ）"""
+
+    def __init__(self, length):
+        self.length = length
+        self.layers = []
+
+    def get_seq_length(self):
+        return self.length
+
+    def crop(self, length):
+        self.length = min(self.length, length)
+
+
+def test_common_prefix_length():
+    assert _common_prefix_length([1, 2, 3], [1, 2, 4]) == 2
+    assert _common_prefix_length([1, 2], [1, 2, 3]) == 2
+    assert _common_prefix_length([], [1]) == 0
+
+
+def test_match_length_uses_longest_prefix():
+    cache = PrefixCache(max_bytes=1024, min_tokens=2)
+    cache.commit([1, 2, 3, 4], FakeCache(6))
+    cache.commit([1, 2, 9], FakeCache(3))
+    assert cache.match_length([1, 2, 3, 4, 5, 6]) == 4
+    assert cache.match_length([1, 2, 9, 9]) == 3
+    assert cache.match_length([7, 8, 9]) == 0
+
+
+def test_last_token_is_always_prefilled():
+    """プロンプト全体が一致しても、最後のトークンはロジットを得るために再利用しない"""
+    cache = PrefixCache(max_bytes=1024, min_tokens=1)
+    cache.commit([1, 2, 3], FakeCache(3))
+    assert cache.match_length([1, 2, 3]) == 2
+
+
+def test_short_matches_are_not_reused():
+    cache = PrefixCache(max_bytes=1024, min_tokens=3)
+    cache.commit([1, 2, 3, 4], FakeCache(4))
+    assert cache.match_length([1, 2, 7, 8]) == 0
+    assert cache.match_length([1, 2, 3, 8]) == 3
+
+
+def test_commit_ignores_caches_shorter_than_prompt():
+    cache = PrefixCache(max_bytes=1024, min_tokens=1)
+    cache.commit([1, 2, 3], FakeCache(1))
+    assert cache.snapshot()["entries"] == 0
+
+
+def test_plan_warmup_runs_one_prompt_per_shared_prefix_first():
+    cache = PrefixCache(max_bytes=1 << 20, min_tokens=4)
+    system = [1, 2, 3, 4, 5]
+    sequences = [system + [10], [7, 8, 9, 10, 11, 12], system + [11], system + [12], [20, 21, 22, 23, 24]]
+    leaders, followers, others = cache.plan_warmup(sequences)
+    assert leaders == [0]  # 最初の1件のKVを登録すれば、同じプレフィックスの残りが再利用できる
+    assert followers == [2, 3]
+    assert others == [1, 4]
@@ -0,0 +1,85 @@
+import asyncio
+import os
+
+from response_cache import ResponseCache
+
+
+def get(cache, key):
+    return asyncio.run(cache.get(key))
+
+
+def test_make_key_depends_on_model_prompt_and_params():
+    key = ResponseCache.make_key("m", "p", {"a": 1})
+    assert key == ResponseCache.make_key("m", "p", {"a": 1})
+    assert key != ResponseCache.make_key("m2", "p", {"a": 1})
+    assert key != ResponseCache.make_key("m", "p", {"a": 2})
+
+
+def test_lru_eviction_by_bytes():
+    cache = ResponseCache(max_bytes=30)
+    cache.put("a", "x" * 10)  # キーと値で11バイト
+    cache.put("b", "x" * 10)
+    assert get(cache, "a") == "x" * 10  # aを最近使ったものにする
+    cache.put("c", "x" * 10)
+    assert get(cache, "b") is None
+    assert get(cache, "a") is not None
+    assert get(cache, "c") is not None
+    assert cache.snapshot()["evictions"] == 1
+    assert cache.current_bytes <= cache.max_bytes
+
+
+def test_value_larger_than_capacity_is_not_cached():
+    cache = ResponseCache(max_bytes=5)
+    cache.put("a", "x" * 10)
+    assert get(cache, "a") is None
+    assert cache.current_bytes == 0
+
+
+def test_ttl_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("response_cache.time.time", lambda: now[0])
+    cache = ResponseCache(max_bytes=100, ttl_seconds=10)
+    cache.put("a", "value")
+    now[0] += 5
+    assert get(cache, "a") == "value"
+    now[0] += 10
+    assert get(cache, "a") is None
+    assert cache.snapshot()["expirations"] == 1
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    cache = ResponseCache(max_bytes=100, disk_dir=str(tmp_path))
+    cache.put("a", "value")
+    cache.close()  # 書き込み待ちの応答を書き出す
+
+    restarted = ResponseCache(max_bytes=100, disk_dir=str(tmp_path))
+    assert get(restarted, "a") == "value"
+    assert restarted.snapshot()["disk_hits"] == 1
+    # 2回目はメモリ層でヒットする
+    assert get(restarted, "a") == "value"
+    assert restarted.snapshot()["disk_hits"] == 1
+    restarted.close()
+
+
+def test_disk_miss_does_not_open_files(tmp_path, monkeypatch):
+    """ディスク層の索引にないキーは、ファイルを開かずにミスと判定する"""
+    cache = ResponseCache(max_bytes=100, disk_dir=str(tmp_path))
+    monkeypatch.setattr(cache, "_read_disk", lambda key: (_ for _ in ()).throw(AssertionError("opened")))
+    assert get(cache, "missing") is None
+    assert cache.snapshot()["misses"] == 1
+    cache.close()
+
+
+def test_expired_disk_entry_is_removed(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("response_cache.time.time", lambda: now[0])
+    cache = ResponseCache(max_bytes=100, ttl_seconds=10, disk_dir=str(tmp_path))
+    cache.put("a", "value")
+    cache.close()
+
+    now[0] += 20
+    restarted = ResponseCache(max_bytes=100, ttl_seconds=10, disk_dir=str(tmp_path))
+    assert get(restarted, "a") is None
+    restarted.close()
+    assert restarted.snapshot()["expirations"] == 1
+    assert not os.listdir(tmp_path)
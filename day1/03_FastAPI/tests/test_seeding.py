@@ -0,0 +1,92 @@
+import threading
+import time
+
+from seeding import RandomStateLock
+
+
+def run_in_thread(func):
+    thread = threading.Thread(target=func)
+    thread.start()
+    return thread
+
+
+def test_seed_is_set_inside_guard():
+    seeds = []
+    lock = RandomStateLock(seeds.append)
+    with lock.guard(do_sample=True, seed=42):
+        assert seeds == [42]
+    with lock.guard(do_sample=True), lock.guard(do_sample=False):
+        pass  # シード指定のないサンプリングと貪欲法はシードを設定しない
+    assert seeds == [42]
+
+
+def test_seeded_generation_waits_for_running_sampling():
+    events = []
+    lock = RandomStateLock(lambda seed: events.append("seed"))
+    sampling_started = threading.Event()
+    finish_sampling = threading.Event()
+
+    def sampling():
+        with lock.guard(do_sample=True):
+            sampling_started.set()
+            finish_sampling.wait(5)
+            events.append("sampling done")
+
+    def seeded():
+        with lock.guard(do_sample=True, seed=1):
+            events.append("seeded")
+
+    threads = [run_in_thread(sampling)]
+    sampling_started.wait(5)
+    threads.append(run_in_thread(seeded))
+    time.sleep(0.05)
+    assert events == []
+    finish_sampling.set()
+    for thread in threads:
+        thread.join(5)
+    assert events == ["sampling done", "seed", "seeded"]
+
+
+def test_sampling_does_not_start_while_seeded_generation_is_waiting():
+    events = []
+    lock = RandomStateLock(lambda seed: None)
+    first_started = threading.Event()
+    finish_first = threading.Event()
+
+    def first():
+        with lock.guard(do_sample=True):
+            first_started.set()
+            finish_first.wait(5)
+
+    def seeded():
+        with lock.guard(do_sample=True, seed=1):
+            events.append("seeded")
+
+    def second():
+        with lock.guard(do_sample=True):
+            events.append("second")
+
+    threads = [run_in_thread(first)]
+    first_started.wait(5)
+    threads.append(run_in_thread(seeded))
+    time.sleep(0.05)
+    threads.append(run_in_thread(second))
+    time.sleep(0.05)
+    assert events == []  # 後から来たサンプリングはシード指定の生成を追い越さない
+    finish_first.set()
+    for thread in threads:
+        thread.join(5)
+    assert events == ["seeded", "second"]
+
+
+def test_greedy_generation_is_not_blocked():
+    lock = RandomStateLock(lambda seed: None)
+    done = []
+
+    def greedy():
+        with lock.guard(do_sample=False):
+            done.append(True)
+
+    with lock.guard(do_sample=True, seed=1):
+        run_in_thread(greedy).join(1)
+        assert done
@@ -0,0 +1,101 @@
+# workers.py
+# 複数のワーカープロセスでAPIサーバーを実行する（モデルの重みは親プロセスで1回だけ読み込み、fork後はコピーオンライトで共有する）
+#
+# 単体で実行する場合（ngrokを使わずにローカルで起動）:
+#   python workers.py --workers 4 --port 8501
+import argparse
+import gc
+import multiprocessing
+import os
+import signal
+import socket
+
+
+def default_threads_per_worker(num_workers):
+    """CPUコア数をワーカー数で分けたtorchのスレッド数を返す"""
+    return max(1, (os.cpu_count() or 1) // num_workers)
+
+
+def _worker_main(app, sock, worker_index, threads_per_worker, log_level):
+    """子プロセスでtorchのスレッド数を設定し、共有ソケットでuvicornを実行する"""
+    import uvicorn
+
+    try:
+        import torch
+        # ワーカー同士でコアを奪い合わないよう、プロセスごとにスレッド数を制限する
+        torch.set_num_threads(threads_per_worker)
+    except ImportError:
+        pass  # スタブモデルで実行する場合
+    print(f"ワーカー{worker_index}を開始しました (pid={os.getpid()}, torchスレッド数={threads_per_worker})")
+    server = uvicorn.Server(uvicorn.Config(app, log_level=log_level))
+    server.run(sockets=[sock])
+
+
+def run_workers(app, host="0.0.0.0", port=8501, num_workers=2, threads_per_worker=None,
+                preload_fn=None, log_level="info"):
+    """num_workers個のプロセスで同じアプリを実行し、全てのワーカーが終了するまで待つ
+
+    preload_fn はfork前に親プロセスで1回だけ呼び出されます（モデルの重みの読み込みなど）。
+    重みのテンソルはfork後に書き換えられないため、各ワーカーは同じ物理ページを共有し、メモリ使用量はほぼ1プロセス分になります。
+    親プロセスでは推論を行わないでください（OpenMPのスレッドプールがfork後の子プロセスで使えなくなるため）。
+    """
+    threads_per_worker = threads_per_worker or default_threads_per_worker(num_workers)
+    # 全てのワーカーが同じソケットでacceptし、接続はカーネルによって振り分けられる
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    if preload_fn is not None:
+        preload_fn()
+    # 既存のオブジェクトをGCの対象外にし、子プロセスのGCが共有ページに書き込まないようにする
+    gc.collect()
+    gc.freeze()
+
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(
+            target=_worker_main,
+            args=(app, sock, index, threads_per_worker, log_level),
+            name=f"llm-worker-{index}",
+        )
+        for index in range(num_workers)
+    ]
+    for process in processes:
+        process.start()
+    print(f"{num_workers}個のワーカーで http://{host}:{port} を待ち受けています (pid={[p.pid for p in processes]})")
+
+    def stop_workers(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    previous_handlers = {sig: signal.signal(sig, stop_workers) for sig in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for sig, handler in previous_handlers.items():
+            signal.signal(sig, handler)
+        sock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="複数のワーカープロセスでLLM APIサーバーを実行する")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WORKERS", "2")))
+    parser.add_argument("--threads-per-worker", type=int, default=None)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8501)
+    args = parser.parse_args()
+
+    import app as app_module
+
+    run_workers(
+        app_module.app,
+        host=args.host,
+        port=args.port,
+        num_workers=args.workers,
+        threads_per_worker=args.threads_per_worker,
+        preload_fn=app_module.preload_models,
+    )